@@ -38,7 +38,73 @@ quark_opts = [
     cfg.StrOpt("default_ipam_strategy",
                default="ANY",
                help=_("Default IPAM strategy to use when"
-                      "none is provided."))
+                      "none is provided.")),
+    cfg.BoolOpt("ipam_free_range_index",
+                default=False,
+                help=_("Find new IP addresses through the per-subnet "
+                       "free range index instead of probing candidate "
+                       "addresses one at a time.")),
+    cfg.IntOpt("mac_lease_size",
+               default=0,
+               help=_("Number of MAC addresses each worker reserves from "
+                      "a range at a time. 0 disables MAC leasing.")),
+    cfg.IntOpt("mac_lease_timeout",
+               default=600,
+               help=_("Time in seconds after which a MAC address lease "
+                      "that has not been renewed may be reclaimed.")),
+    cfg.BoolOpt("ipam_reuse_queue",
+                default=False,
+                help=_("Queue deallocated IP addresses for reuse and pop "
+                       "them by primary key instead of scanning for them.")),
+    cfg.BoolOpt("async_notifications",
+                default=False,
+                help=_("Send IP address and subnet notifications from a "
+                       "background green thread once the transaction "
+                       "that raised them commits.")),
+    cfg.IntOpt("notification_queue_size",
+               default=10000,
+               help=_("Number of notifications that may wait to be sent "
+                      "before new ones are dropped.")),
+    cfg.IntOpt("notification_batch_size",
+               default=100,
+               help=_("Maximum number of notifications sent per wake up "
+                      "of the notification thread.")),
+    cfg.IntOpt("notification_flush_timeout",
+               default=10,
+               help=_("Time in seconds to spend sending queued "
+                      "notifications at shutdown.")),
+    cfg.BoolOpt("backend_outbox",
+                default=False,
+                help=_("Record network driver calls for port and network "
+                       "creates and port deletes in the request's "
+                       "transaction and run them from background workers "
+                       "instead of while holding it.")),
+    cfg.IntOpt("backend_op_workers",
+               default=4,
+               help=_("Green threads running recorded backend "
+                      "operations.")),
+    cfg.IntOpt("backend_op_poll_interval",
+               default=1,
+               help=_("Time in seconds an idle backend operation worker "
+                      "waits before looking for work again.")),
+    cfg.IntOpt("backend_op_max_attempts",
+               default=10,
+               help=_("Number of times a backend operation is tried before "
+                      "it is marked failed.")),
+    cfg.IntOpt("backend_op_retry_interval",
+               default=2,
+               help=_("Time in seconds before a failed backend operation "
+                      "is retried, doubled for every further attempt.")),
+    cfg.IntOpt("backend_op_timeout",
+               default=300,
+               help=_("Time in seconds after which a running backend "
+                      "operation is assumed abandoned by its worker.")),
+    cfg.BoolOpt("tenant_counts",
+                default=False,
+                help=_("Keep per tenant counts of networks, subnets and "
+                       "ports and answer tenant wide count requests, like "
+                       "the quota checks, from them. The counts are "
+                       "approximate."))
 ]
 
 
@@ -19,6 +19,8 @@ from neutron.api import extensions
 from neutron.common import exceptions
 from neutron import manager
 from neutron.openstack.common import log as logging
+import webob
+
 LOG = logging.getLogger(__name__)
 
 
@@ -38,6 +40,20 @@ class Diagnostician(object):
             functools.partial(self.diag_not_implemented, res))(
                 req.context, id, input['diag'])
 
+    def metrics(self, input, req, id):
+        """Reports the driver call metrics of driver id, * for all.
+
+        The IP policy cache counters are reported alongside them.
+        {"metrics": "text"} returns them in the Prometheus text format.
+        """
+        if not req.context.is_admin:
+            raise exceptions.NotAuthorized()
+        if input['metrics'] == 'text':
+            return webob.Response(
+                body=self.plugin.dump_driver_metrics(req.context, id),
+                content_type='text/plain')
+        return self.plugin.diagnose_drivers(req.context, id, input['metrics'])
+
 
 class Diagnostics(extensions.ExtensionDescriptor):
     def get_name(self):
@@ -56,7 +72,12 @@ class Diagnostics(extensions.ExtensionDescriptor):
         return "never"
 
     def get_actions(self):
-        diagnose = Diagnostician(manager.NeutronManager.get_plugin()).diagnose
+        diagnostician = Diagnostician(manager.NeutronManager.get_plugin())
         resources = ['port', 'subnet', 'network']
-        return (extensions.ActionExtension('%ss' % res, 'diag',
-                functools.partial(diagnose, res)) for res in resources)
+        actions = [extensions.ActionExtension(
+                   '%ss' % res, 'diag',
+                   functools.partial(diagnostician.diagnose, res))
+                   for res in resources]
+        actions.append(extensions.ActionExtension('networks', 'metrics',
+                                                  diagnostician.metrics))
+        return actions
@@ -0,0 +1,208 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Quark backend operation outbox.
+
+With backend_outbox enabled, plugin calls that need the network driver
+record a BackendOperation in their own transaction instead of calling the
+driver while holding it. Worker green threads then claim the recorded
+operations, run them against the driver with retries, one at a time per
+resource, and record their results.
+"""
+
+import datetime
+import json
+import os
+import socket
+
+import eventlet
+from neutron import context as neutron_context
+from neutron.openstack.common import log as logging
+from neutron.openstack.common import timeutils
+from oslo.config import cfg
+
+from quark.db import api as db_api
+from quark.drivers import registry
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+OPERATIONS = {}
+FAILURES = {}
+
+
+def operation(name):
+    def register(f):
+        OPERATIONS[name] = f
+        return f
+    return register
+
+
+def failure(name):
+    """Registers what to do when an operation is given up on."""
+    def register(f):
+        FAILURES[name] = f
+        return f
+    return register
+
+
+def enqueue(context, operation, resource_id, network_plugin, **payload):
+    payload["tenant_id"] = context.tenant_id
+    return db_api.backend_op_create(context, operation=operation,
+                                    resource_id=resource_id,
+                                    network_plugin=network_plugin,
+                                    payload=json.dumps(payload))
+
+
+@operation("create_network")
+def _create_network(context, driver, payload):
+    driver.create_network(context, payload["network_name"],
+                          network_id=payload["network_id"],
+                          phys_type=payload["phys_type"],
+                          phys_net=payload["phys_net"],
+                          segment_id=payload["segment_id"])
+
+
+@operation("create_port")
+def _create_port(context, driver, payload):
+    backend_port = driver.create_port(
+        context, payload["network_id"], port_id=payload["port_id"],
+        security_groups=payload["security_groups"],
+        allowed_pairs=payload["allowed_pairs"])
+    port = db_api.port_find(context, id=[payload["port_id"]],
+                            scope=db_api.ONE)
+    if port:
+        db_api.port_update(context, port, backend_key=backend_port["uuid"])
+    return backend_port
+
+
+@failure("create_port")
+def _create_port_failed(context, payload):
+    port = db_api.port_find(context, id=[payload["port_id"]],
+                            scope=db_api.ONE)
+    if port:
+        db_api.port_update(context, port, status="ERROR")
+
+
+@operation("delete_port")
+def _delete_port(context, driver, payload):
+    backend_key = payload["backend_key"]
+    if backend_key == payload["port_id"]:
+        # NOTE(jkoelker) The port was deleted before the worker recorded
+        #                its real backend key, find it on the create.
+        created = db_api.backend_op_find(context,
+                                         resource_id=payload["port_id"],
+                                         operation="create_port",
+                                         state="done", scope=db_api.ONE)
+        if not created:
+            return
+        backend_key = json.loads(created["result"])["uuid"]
+    driver.delete_port(context, backend_key)
+
+
+class BackendOperationWorker(object):
+    """Runs recorded backend operations from green threads."""
+    def __init__(self):
+        self._started = False
+        self.owner = None
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        if self._started:
+            return
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        for i in xrange(CONF.QUARK.backend_op_workers):
+            eventlet.spawn_n(self._run)
+        self._started = True
+
+    def _run(self):
+        while True:
+            try:
+                ran = self.run_once()
+            except Exception:
+                LOG.exception("Failed to run backend operations")
+                ran = 0
+            if not ran:
+                eventlet.sleep(CONF.QUARK.backend_op_poll_interval)
+
+    def run_once(self, limit=10):
+        """Claims and runs up to limit operations.
+
+        Returns the number of operations run.
+        """
+        context = neutron_context.get_admin_context()
+        stale_before = timeutils.utcnow() - datetime.timedelta(
+            seconds=CONF.QUARK.backend_op_timeout)
+        ran = 0
+        for op in db_api.backend_op_runnable(context, stale_before,
+                                             limit=limit):
+            with context.session.begin():
+                claimed = db_api.backend_op_claim(context, op, self.owner)
+            if claimed:
+                self._execute(context, op)
+                ran += 1
+        return ran
+
+    def _execute(self, context, op):
+        payload = json.loads(op["payload"])
+        op_context = neutron_context.Context(None, payload["tenant_id"],
+                                             is_admin=True)
+        handler = OPERATIONS[op["operation"]]
+        driver = registry.DRIVER_REGISTRY.get_driver(op["network_plugin"])
+        try:
+            # NOTE(jkoelker) Drivers that keep rows of their own write them
+            #                in this transaction, it holds no IPAM locks.
+            with op_context.session.begin():
+                result = handler(op_context, driver, payload)
+        except Exception as e:
+            self._retry(context, op, e)
+            return
+
+        with context.session.begin():
+            db_api.backend_op_finish(context, op, self.owner, state="done",
+                                     result=json.dumps(result, default=str),
+                                     last_error=None)
+        self.succeeded += 1
+
+    def _retry(self, context, op, error):
+        attempts = op["attempts"]
+        with context.session.begin():
+            if attempts >= CONF.QUARK.backend_op_max_attempts:
+                LOG.error("Giving up on %s of %s after %d attempts: %s" %
+                          (op["operation"], op["resource_id"], attempts,
+                           error))
+                db_api.backend_op_finish(context, op, self.owner,
+                                         state="failed",
+                                         last_error=str(error))
+                if op["operation"] in FAILURES:
+                    FAILURES[op["operation"]](context,
+                                              json.loads(op["payload"]))
+                self.failed += 1
+                return
+
+            delay = CONF.QUARK.backend_op_retry_interval * 2 ** (attempts - 1)
+            LOG.warning("%s of %s failed, retrying in %d seconds: %s" %
+                        (op["operation"], op["resource_id"], delay, error))
+            db_api.backend_op_finish(
+                context, op, self.owner, state="pending",
+                last_error=str(error),
+                run_at=timeutils.utcnow() + datetime.timedelta(seconds=delay))
+            self.retried += 1
+
+
+WORKER = BackendOperationWorker()
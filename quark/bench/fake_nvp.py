@@ -0,0 +1,405 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Fake NVP controller.
+
+Implements the part of the NVP REST API quark uses, lswitches, lswitch
+ports, security profiles and transport zones with tag queries, relations
+and paging, against in-memory state. Serve it over HTTP and point
+NVP.controller_connection at it, or set NVP.connection_class to
+quark.bench.fake_nvp.FakeConnection to use it in-process. Latency, error
+injection and background objects that grow the result sets are set in the
+FAKE_NVP group.
+"""
+
+import BaseHTTPServer
+import copy
+import json
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+import uuid
+
+import aiclib
+from neutron.openstack.common import log as logging
+from oslo.config import cfg
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+fake_nvp_opts = [
+    cfg.StrOpt("bind_host", default="127.0.0.1",
+               help=_("Address the fake controller listens on.")),
+    cfg.IntOpt("bind_port", default=8080,
+               help=_("Port the fake controller listens on.")),
+    cfg.FloatOpt("latency", default=0.0,
+                 help=_("Seconds added to every request.")),
+    cfg.FloatOpt("latency_jitter", default=0.0,
+                 help=_("Upper bound of a random number of seconds added "
+                        "to every request on top of the latency.")),
+    cfg.DictOpt("call_latency", default={},
+                help=_("Seconds added to requests of a method on a "
+                       "collection instead of latency, e.g. "
+                       "GET_lport:0.05,POST_lswitch:0.2")),
+    cfg.FloatOpt("error_rate", default=0.0,
+                 help=_("Fraction of requests failed with error_status.")),
+    cfg.IntOpt("error_status", default=503,
+               help=_("HTTP status of injected errors.")),
+    cfg.IntOpt("max_page_length", default=1000,
+               help=_("Most results returned by one page of a query.")),
+    cfg.ListOpt("transport_zones", default=[],
+                help=_("Uuids of the transport zones the controller "
+                       "starts with.")),
+    cfg.StrOpt("background_tenant", default="fake-background",
+               help=_("Tenant owning the background objects.")),
+    cfg.IntOpt("background_lswitches", default=0,
+               help=_("Lswitches created up front.")),
+    cfg.IntOpt("background_lports", default=0,
+               help=_("Lports created up front on each background "
+                      "lswitch.")),
+    cfg.IntOpt("background_profiles", default=0,
+               help=_("Security profiles created up front.")),
+]
+
+CONF.register_opts(fake_nvp_opts, "FAKE_NVP")
+
+_LIST_PARAMS = ("tag", "tag_scope", "relations")
+
+
+class FakeNVP(object):
+    """In-memory NVP controller state and request handling."""
+    def __init__(self, latency=0.0, latency_jitter=0.0, call_latency=None,
+                 error_rate=0.0, error_status=503, max_page_length=1000):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.call_latency = call_latency or {}
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_page_length = max_page_length
+        self._lock = threading.Lock()
+        self.tables = {"lswitch": {}, "lport": {}, "security-profile": {},
+                       "transport-zone": {}}
+        self.calls = {}
+        self.errors = 0
+
+    @classmethod
+    def from_config(klass):
+        conf = CONF.FAKE_NVP
+        fake = klass(latency=conf.latency,
+                     latency_jitter=conf.latency_jitter,
+                     call_latency=dict((k, float(v)) for k, v in
+                                       conf.call_latency.items()),
+                     error_rate=conf.error_rate,
+                     error_status=conf.error_status,
+                     max_page_length=conf.max_page_length)
+        for zone in conf.transport_zones:
+            fake.tables["transport-zone"][zone] = dict(
+                uuid=zone, display_name=zone, tags=[],
+                type="TransportZoneConfig")
+        fake.populate(conf.background_tenant, conf.background_lswitches,
+                      conf.background_lports, conf.background_profiles)
+        return fake
+
+    def populate(self, tenant_id, lswitches=0, lports=0, profiles=0):
+        """Creates objects for tenant_id that only serve to fill queries."""
+        tags = [dict(scope="os_tid", tag=tenant_id)]
+        for i in xrange(lswitches):
+            switch = self._create("lswitch", None,
+                                  dict(display_name="background-%d" % i,
+                                       tags=tags))
+            for j in xrange(lports):
+                self._create("lport", switch["uuid"], dict(tags=tags))
+        for i in xrange(profiles):
+            self._create("security-profile", None,
+                         dict(display_name="background-%d" % i, tags=tags))
+
+    def stats(self):
+        return dict(calls=dict(self.calls), errors=self.errors,
+                    objects=dict((name, len(table)) for name, table in
+                                 self.tables.items()))
+
+    def _delay(self, key):
+        delay = self.call_latency.get(key, self.latency)
+        if self.latency_jitter:
+            delay += random.uniform(0, self.latency_jitter)
+        if delay:
+            time.sleep(delay)
+
+    def request(self, method, path, data=None):
+        """Handles one request, returning the HTTP status and the body."""
+        parts = [p for p in path.split("/") if p][1:]
+        if not parts:
+            return 404, "Not found: %s" % path
+        collection = parts[2:3] == ["lport"] and "lport" or parts[0]
+        key = "%s_%s" % (method, collection)
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+        self._delay(key)
+
+        if collection == "login":
+            return 200, {}
+        if self.error_rate and random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return self.error_status, "Injected failure"
+        try:
+            with self._lock:
+                return self._dispatch(method, parts, data or {})
+        except KeyError as e:
+            return 404, "Not found: %s" % e
+        except (TypeError, ValueError) as e:
+            return 400, "Bad request: %s" % e
+
+    def _dispatch(self, method, parts, data):
+        collection = parts[0]
+        lswitch = None
+        if parts[2:3] == ["lport"]:
+            collection, lswitch = "lport", parts[1]
+            parts = parts[2:]
+        if collection not in self.tables:
+            raise KeyError(collection)
+        table = self.tables[collection]
+
+        if len(parts) == 1:
+            if method == "POST":
+                if lswitch is not None and \
+                        lswitch not in self.tables["lswitch"]:
+                    raise KeyError(lswitch)
+                return 201, self._view(collection,
+                                       self._create(collection, lswitch,
+                                                    data))
+            if method == "GET":
+                return 200, self._query(collection, lswitch, data)
+            return 405, "Method not allowed"
+
+        obj = table[parts[1]]
+        if lswitch not in (None, "*") and obj["_lswitch"] != lswitch:
+            raise KeyError(parts[1])
+        if len(parts) == 3:
+            if parts[2] == "status":
+                return 200, self._status(collection, obj)
+            if parts[2] == "statistic":
+                return 200, dict(rx_packets=0, rx_bytes=0, rx_errors=0,
+                                 tx_packets=0, tx_bytes=0, tx_errors=0)
+            raise KeyError(parts[2])
+        if method == "GET":
+            return 200, self._view(collection, obj)
+        if method == "PUT":
+            data.pop("uuid", None)
+            obj.update(data)
+            return 200, self._view(collection, obj)
+        if method == "DELETE":
+            if collection == "lswitch":
+                for lport in self._lports(obj["uuid"]):
+                    del self.tables["lport"][lport["uuid"]]
+            del table[obj["uuid"]]
+            return 204, None
+        return 405, "Method not allowed"
+
+    def _create(self, collection, lswitch, data):
+        obj = dict(uuid=str(uuid.uuid4()), display_name=None, tags=[])
+        if collection == "lswitch":
+            obj.update(transport_zones=[], port_isolation_enabled=False,
+                       type="LogicalSwitchConfig")
+        elif collection == "lport":
+            obj.update(_lswitch=lswitch,
+                       portno=len(self._lports(lswitch)) + 1,
+                       admin_status_enabled=True, allowed_address_pairs=[],
+                       security_profiles=[], mirror_targets=[],
+                       queue_uuid=None, type="LogicalSwitchPortConfig")
+        elif collection == "security-profile":
+            obj.update(logical_port_ingress_rules=[],
+                       logical_port_egress_rules=[],
+                       type="SecurityProfileConfig")
+        obj.update((k, v) for k, v in data.items() if k != "uuid")
+        self.tables[collection][obj["uuid"]] = obj
+        return obj
+
+    def _lports(self, lswitch):
+        return [lport for lport in self.tables["lport"].values()
+                if lport["_lswitch"] == lswitch]
+
+    def _view(self, collection, obj, relations=()):
+        view = dict((k, copy.deepcopy(v)) for k, v in obj.items()
+                    if not k.startswith("_"))
+        if relations:
+            view["_relations"] = dict(
+                (relation, self._relation(collection, obj, relation))
+                for relation in relations)
+        return view
+
+    def _status(self, collection, obj):
+        if collection == "lswitch":
+            count = len(self._lports(obj["uuid"]))
+            return dict(lport_count=count, lport_admin_up_count=count,
+                        lport_fabric_up_count=count,
+                        lport_link_up_count=count, fabric_status=True,
+                        type="LogicalSwitchStatus")
+        lswitch = self.tables["lswitch"][obj["_lswitch"]]
+        return dict(link_status_up=True, fabric_status_up=True,
+                    admin_status_up=obj["admin_status_enabled"],
+                    lswitch=self._view("lswitch", lswitch),
+                    type="LogicalPortStatus")
+
+    def _relation(self, collection, obj, relation):
+        if relation in ("LogicalSwitchStatus", "LogicalPortStatus"):
+            return self._status(collection, obj)
+        if relation == "LogicalSwitchConfig":
+            return self._view("lswitch",
+                              self.tables["lswitch"][obj["_lswitch"]])
+        if relation == "LogicalPortAttachment":
+            return obj.get("_attachment", dict(type="NoAttachment"))
+        raise ValueError("unknown relation %s" % relation)
+
+    def _matches(self, collection, obj, lswitch, params):
+        if lswitch not in (None, "*") and obj["_lswitch"] != lswitch:
+            return False
+        if params.get("uuid") and obj["uuid"] != params["uuid"]:
+            return False
+        tags = set((t["scope"], t["tag"]) for t in obj["tags"])
+        for pair in zip(params.get("tag_scope", []), params.get("tag", [])):
+            if pair not in tags:
+                return False
+        profile = params.get("security_profile_uuid")
+        if profile:
+            negate = profile.startswith("!=")
+            member = profile.lstrip("!=") in obj.get("security_profiles",
+                                                     [])
+            if member == negate:
+                return False
+        return True
+
+    def _query(self, collection, lswitch, params):
+        for name in _LIST_PARAMS:
+            value = params.get(name, [])
+            if not isinstance(value, list):
+                value = [value]
+            params[name] = value
+        matched = sorted((obj for obj in self.tables[collection].values()
+                          if self._matches(collection, obj, lswitch,
+                                           params)),
+                         key=lambda obj: obj["uuid"])
+        length = min(int(params.get("_page_length") or
+                         self.max_page_length), self.max_page_length)
+        start = int(params.get("_page_cursor") or 0)
+        page = matched[start:start + length]
+        results = dict(result_count=len(matched),
+                       results=[self._view(collection, obj,
+                                           params["relations"])
+                                for obj in page])
+        if start + length < len(matched):
+            results["page_cursor"] = str(start + length)
+        return results
+
+
+_CONTROLLERS = {}
+_CONTROLLERS_LOCK = threading.Lock()
+
+
+def controller(address):
+    """Returns the in-process fake controller for an address."""
+    with _CONTROLLERS_LOCK:
+        if address not in _CONTROLLERS:
+            _CONTROLLERS[address] = FakeNVP.from_config()
+        return _CONTROLLERS[address]
+
+
+class FakeConnection(aiclib.nvp.Connection):
+    """aiclib connection that sends requests to an in-process FakeNVP."""
+    def __init__(self, uri, poolmanager=None, username="admin",
+                 password="admin", **kwargs):
+        self.fake = controller(urlparse.urlparse(uri).netloc)
+
+    def _action(self, entity, method, resource):
+        if entity is None:
+            return
+        status, body = self.fake.request(
+            method, resource, json.loads(json.dumps(entity._unroll())))
+        self.handle_status_code(status, iserror=status >= 300,
+                                message=body)
+        return body
+
+
+def _params(query):
+    params = urlparse.parse_qs(query, keep_blank_values=True)
+    return dict((k, k in _LIST_PARAMS and v or v[0])
+                for k, v in params.items())
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self):
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.getheader("content-length") or 0)
+        raw = length and self.rfile.read(length) or ""
+        if url.path.endswith("/login"):
+            data = None
+        elif raw:
+            data = json.loads(raw)
+        else:
+            data = _params(url.query)
+
+        status, body = self.server.fake.request(self.command, url.path,
+                                                data)
+        content_type = "application/json"
+        if body is None:
+            body = ""
+        elif isinstance(body, basestring):
+            content_type = "text/plain"
+        else:
+            body = json.dumps(body)
+        self.send_response(status)
+        if url.path.endswith("/login"):
+            self.send_header("Set-Cookie", "nvp_sessionid=fake")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+
+class FakeNVPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fake):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.fake = fake
+
+
+def main():
+    CONF(sys.argv[1:], project="neutron")
+    logging.setup("quark")
+    server = FakeNVPServer((CONF.FAKE_NVP.bind_host,
+                            CONF.FAKE_NVP.bind_port), FakeNVP.from_config())
+    LOG.info("Fake NVP controller listening on %s:%d" %
+             server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.fake.stats(), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+IPAM throughput benchmark.
+
+Builds a network with a v4 and a v6 subnet and a MAC address range, then
+drives the IPAM strategies through allocate and deallocate cycles and
+reports throughput, latency percentiles, SQL statements per operation and
+time spent in locking statements as JSON. Point database.connection at a
+local MySQL to measure that instead of sqlite.
+"""
+
+import json
+import sys
+import time
+
+import eventlet
+import netaddr
+from neutron import context as neutron_context
+from neutron.db import api as neutron_db_api
+from neutron.openstack.common.db.sqlalchemy import session as neutron_session
+from neutron.openstack.common import log as logging
+from neutron.openstack.common import uuidutils
+from oslo.config import cfg
+from sqlalchemy import event
+
+from quark.db import api as db_api
+from quark.db import models
+from quark import ipam
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+bench_opts = [
+    cfg.ListOpt("strategies", default=["ANY", "BOTH", "BOTH_REQUIRED"],
+                help=_("IPAM strategies to benchmark.")),
+    cfg.IntOpt("allocations", default=1000,
+               help=_("Ports to allocate and deallocate per strategy.")),
+    cfg.IntOpt("concurrency", default=1,
+               help=_("Green threads issuing operations at once.")),
+    cfg.FloatOpt("fill", default=0.0,
+                 help=_("Fraction of the v4 subnet allocated up front.")),
+    cfg.IntOpt("policy_size", default=0,
+               help=_("Addresses excluded by IP policy at the start of "
+                      "each subnet.")),
+    cfg.StrOpt("v4_cidr", default="10.0.0.0/16",
+               help=_("CIDR of the v4 subnet.")),
+    cfg.StrOpt("v6_cidr", default="fd00::/64",
+               help=_("CIDR of the v6 subnet.")),
+    cfg.StrOpt("output", default=None,
+               help=_("File to write the JSON report to, stdout if unset.")),
+    cfg.BoolOpt("drop_tables", default=False,
+                help=_("Allow dropping and recreating the quark tables of a "
+                       "database other than sqlite."))
+]
+
+
+class StatementCounter(object):
+    """Counts SQL statements and the time spent in locking ones."""
+    def __init__(self, engine):
+        self.statements = 0
+        self.lock_wait = 0.0
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault("bench_started", []).append(time.time())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        elapsed = time.time() - conn.info["bench_started"].pop()
+        self.statements += 1
+        if "FOR UPDATE" in statement.upper():
+            self.lock_wait += elapsed
+
+    def reset(self):
+        self.statements = 0
+        self.lock_wait = 0.0
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _report(latencies, elapsed, counter):
+    ops = len(latencies)
+    ordered = sorted(latencies)
+    return {
+        "operations": ops,
+        "seconds": elapsed,
+        "operations_per_second": ops / elapsed if elapsed else 0.0,
+        "latency_ms": dict((name, _percentile(ordered, fraction) * 1000)
+                           for name, fraction in (("p50", 0.5),
+                                                  ("p90", 0.9),
+                                                  ("p99", 0.99),
+                                                  ("max", 1.0))),
+        "statements_per_operation": (float(counter.statements) / ops
+                                     if ops else 0.0),
+        "lock_wait_ms": counter.lock_wait * 1000}
+
+
+def _policy(context, size):
+    if not size:
+        return None
+    return db_api.ip_policy_create(
+        context, exclude=[dict(offset=0, length=size)])
+
+
+def build_network(context, strategy):
+    """Creates the network, subnets and MAC range one run works against."""
+    with context.session.begin():
+        net = db_api.network_create(context, id=uuidutils.generate_uuid(),
+                                    name="bench", ipam_strategy=strategy,
+                                    network_plugin="BASE",
+                                    tenant_id=context.tenant_id)
+        for cidr in (CONF.v4_cidr, CONF.v6_cidr):
+            ipnet = netaddr.IPNetwork(cidr)
+            db_api.subnet_create(context, network_id=net["id"],
+                                 cidr=cidr, ip_version=ipnet.version,
+                                 ip_policy=_policy(context,
+                                                   CONF.policy_size))
+        first = netaddr.EUI("00:16:3e:00:00:00").value
+        db_api.mac_address_range_create(
+            context, cidr="00:16:3e:00:00:00/24", first_address=first,
+            last_address=first + 2 ** 24 - 1, next_auto_assign_mac=first)
+
+    fill = int(netaddr.IPNetwork(CONF.v4_cidr).size * CONF.fill)
+    v4 = db_api.subnet_find(context, network_id=[net["id"]], ip_version=4,
+                            scope=db_api.ONE)
+    with context.session.begin():
+        first_ip = netaddr.IPNetwork(CONF.v4_cidr).first
+        for offset in xrange(CONF.policy_size,
+                             CONF.policy_size + fill):
+            db_api.ip_address_create(
+                context, address=netaddr.IPAddress(first_ip + offset),
+                subnet_id=v4["id"], network_id=net["id"], version=4)
+    return net
+
+
+def _timed(latencies, fn, *args):
+    started = time.time()
+    result = fn(*args)
+    latencies.append(time.time() - started)
+    return result
+
+
+def _allocate(net, ipam_driver):
+    context = neutron_context.get_admin_context()
+    port_id = uuidutils.generate_uuid()
+    with context.session.begin():
+        addresses = ipam_driver.allocate_ip_address(context, net["id"],
+                                                    port_id, 0)
+        mac = ipam_driver.allocate_mac_address(context, net["id"], port_id,
+                                               0)
+        port = db_api.port_create(context, id=port_id,
+                                  network_id=net["id"],
+                                  mac_address=mac["address"],
+                                  backend_key=port_id,
+                                  addresses=addresses)
+    return port["id"]
+
+
+def _deallocate(port_id, ipam_driver):
+    context = neutron_context.get_admin_context()
+    with context.session.begin():
+        port = db_api.port_find(context, id=[port_id], scope=db_api.ONE)
+        ipam_driver.deallocate_ip_address(context, port)
+        ipam_driver.deallocate_mac_address(context, port["mac_address"])
+        db_api.port_delete(context, port)
+
+
+def run_strategy(strategy, counter):
+    engine = neutron_session.get_engine()
+    models.BASEV2.metadata.drop_all(engine)
+    models.BASEV2.metadata.create_all(engine)
+    models.IP_POLICY_CACHE.clear()
+
+    context = neutron_context.get_admin_context()
+    net = build_network(context, strategy)
+    ipam_driver = ipam.IPAM_REGISTRY.get_strategy(strategy)
+    pool = eventlet.GreenPool(CONF.concurrency)
+    results = {}
+
+    latencies = []
+    counter.reset()
+    started = time.time()
+    port_ids = list(pool.imap(lambda i: _timed(latencies, _allocate, net,
+                                               ipam_driver),
+                              xrange(CONF.allocations)))
+    results["allocate"] = _report(latencies, time.time() - started, counter)
+
+    latencies = []
+    counter.reset()
+    started = time.time()
+    for _ in pool.imap(lambda port_id: _timed(latencies, _deallocate,
+                                              port_id, ipam_driver),
+                       port_ids):
+        pass
+    results["deallocate"] = _report(latencies, time.time() - started,
+                                    counter)
+    return results
+
+
+def main():
+    CONF.register_cli_opts(bench_opts)
+    CONF(sys.argv[1:], project="neutron")
+    logging.setup("quark")
+    if not (CONF.database.connection.startswith("sqlite") or
+            CONF.drop_tables):
+        sys.exit("Every run drops the quark tables, pass --drop_tables to "
+                 "run against %s" % CONF.database.connection)
+    neutron_db_api.configure_db()
+    counter = StatementCounter(neutron_session.get_engine())
+
+    report = {"config": dict((opt.dest, CONF[opt.dest])
+                             for opt in bench_opts),
+              "connection": CONF.database.connection.split(":")[0],
+              "strategies": {}}
+    for strategy in CONF.strategies:
+        LOG.info("Benchmarking IPAM strategy %s" % strategy)
+        report["strategies"][strategy] = run_strategy(strategy, counter)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if CONF.output:
+        with open(CONF.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,10 @@ from alembic import context
 from sqlalchemy import engine_from_config, pool
 from logging import config as logging_config
 
+from quark.db import models
+# NOTE(jkoelker) Imported for the tables the driver adds to the metadata
+from quark.drivers import optimized_nvp_driver  # noqa
+
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -13,9 +17,7 @@ logging_config.fileConfig(config.config_file_name)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
-# from myapp import mymodel
-# target_metadata = mymodel.Base.metadata
-target_metadata = None
+target_metadata = models.BASEV2.metadata
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -36,7 +38,7 @@ def run_migrations_offline():
 
     """
     url = config.get_main_option("sqlalchemy.url")
-    context.configure(url=url)
+    context.configure(url=url, target_metadata=target_metadata)
 
     with context.begin_transaction():
         context.run_migrations()
@@ -0,0 +1,41 @@
+"""Keep allocation counts on subnets and MAC address ranges
+
+Revision ID: 14a7d2583299
+Revises: d3a5455cf81c
+Create Date: 2026-10-16 21:03:47.215903
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '14a7d2583299'
+down_revision = 'd3a5455cf81c'
+
+
+def upgrade():
+    op.add_column("quark_subnets",
+                  sa.Column("allocated_count", sa.Integer(),
+                            nullable=False, server_default="0"))
+    # NOTE(jkoelker) NULL means not computed yet, subnets fill it in the
+    #                next time they are chosen for an allocation.
+    op.add_column("quark_subnets",
+                  sa.Column("policy_excluded_count", sa.BigInteger()))
+    op.add_column("quark_mac_address_ranges",
+                  sa.Column("allocated_count", sa.Integer(),
+                            nullable=False, server_default="0"))
+
+    op.execute("UPDATE quark_subnets SET allocated_count = "
+               "(SELECT COUNT(*) FROM quark_ip_addresses "
+               "WHERE quark_ip_addresses.subnet_id = quark_subnets.id)")
+    op.execute("UPDATE quark_mac_address_ranges SET allocated_count = "
+               "(SELECT COUNT(*) FROM quark_mac_addresses "
+               "WHERE quark_mac_addresses.mac_address_range_id = "
+               "quark_mac_address_ranges.id)")
+
+
+def downgrade():
+    op.drop_column("quark_mac_address_ranges", "allocated_count")
+    op.drop_column("quark_subnets", "policy_excluded_count")
+    op.drop_column("quark_subnets", "allocated_count")
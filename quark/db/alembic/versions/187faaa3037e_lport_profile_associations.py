@@ -0,0 +1,69 @@
+"""Track the security profiles and rule counts of NVP lports
+
+Revision ID: 187faaa3037e
+Revises: 3a4d90b40510
+Create Date: 2026-10-16 21:10:33.605712
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '187faaa3037e'
+down_revision = '3a4d90b40510'
+
+
+def upgrade():
+    op.create_table(
+        "quark_nvp_driver_lport_security_profile_associations",
+        sa.Column("lport_id", sa.String(length=36), nullable=False),
+        sa.Column("profile_id", sa.String(length=36), nullable=False),
+        sa.ForeignKeyConstraint(["lport_id"],
+                                ["quark_nvp_driver_lswitchport.id"]),
+        sa.ForeignKeyConstraint(["profile_id"],
+                                ["quark_nvp_driver_security_profile.id"]),
+        mysql_engine="InnoDB")
+    op.create_index("idx_quark_nvp_driver_lport_profile",
+                    "quark_nvp_driver_lport_security_profile_associations",
+                    ["profile_id"])
+    op.add_column("quark_nvp_driver_security_profile",
+                  sa.Column("rule_count", sa.Integer(), nullable=False,
+                            server_default="0"))
+    op.add_column("quark_nvp_driver_lswitchport",
+                  sa.Column("rule_count", sa.Integer(), nullable=False,
+                            server_default="0"))
+
+    # NOTE(jkoelker) A profile's id is its security group's id and an
+    #                lport's port_id is its port's backend_key.
+    op.execute("UPDATE quark_nvp_driver_security_profile SET rule_count = "
+               "(SELECT COUNT(*) FROM quark_security_group_rule "
+               "WHERE quark_security_group_rule.group_id = "
+               "quark_nvp_driver_security_profile.id)")
+    op.execute("INSERT INTO "
+               "quark_nvp_driver_lport_security_profile_associations "
+               "(lport_id, profile_id) "
+               "SELECT lport.id, profile.id "
+               "FROM quark_nvp_driver_lswitchport lport "
+               "JOIN quark_ports port ON port.backend_key = lport.port_id "
+               "JOIN quark_port_security_group_associations port_group "
+               "ON port_group.port_id = port.id "
+               "JOIN quark_nvp_driver_security_profile profile "
+               "ON profile.id = port_group.group_id")
+    op.execute("UPDATE quark_nvp_driver_lswitchport SET rule_count = "
+               "(SELECT COALESCE(SUM(profile.rule_count), 0) "
+               "FROM quark_nvp_driver_lport_security_profile_associations "
+               "association "
+               "JOIN quark_nvp_driver_security_profile profile "
+               "ON profile.id = association.profile_id "
+               "WHERE association.lport_id = "
+               "quark_nvp_driver_lswitchport.id)")
+
+
+def downgrade():
+    op.drop_column("quark_nvp_driver_lswitchport", "rule_count")
+    op.drop_column("quark_nvp_driver_security_profile", "rule_count")
+    op.drop_index("idx_quark_nvp_driver_lport_profile",
+                  table_name="quark_nvp_driver_lport_security_profile_"
+                             "associations")
+    op.drop_table("quark_nvp_driver_lport_security_profile_associations")
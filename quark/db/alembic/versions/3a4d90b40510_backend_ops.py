@@ -0,0 +1,54 @@
+"""Add the backend operation outbox and port status
+
+Revision ID: 3a4d90b40510
+Revises: 89c228075340
+Create Date: 2026-10-16 21:09:05.337481
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3a4d90b40510'
+down_revision = '89c228075340'
+
+
+def upgrade():
+    op.create_table(
+        "quark_backend_ops",
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("id", sa.String(length=36), nullable=False),
+        sa.Column("resource_id", sa.String(length=36), nullable=False),
+        sa.Column("sequence", sa.Integer(), nullable=False,
+                  server_default="0"),
+        sa.Column("network_plugin", sa.String(length=36), nullable=False),
+        sa.Column("operation", sa.String(length=64), nullable=False),
+        sa.Column("payload", sa.Text(), nullable=True),
+        sa.Column("state", sa.String(length=16), nullable=False,
+                  server_default="pending"),
+        sa.Column("attempts", sa.Integer(), nullable=False,
+                  server_default="0"),
+        sa.Column("result", sa.Text(), nullable=True),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.Column("owner", sa.String(length=255), nullable=True),
+        sa.Column("run_at", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        mysql_engine="InnoDB")
+    op.create_index("ix_quark_backend_ops_state", "quark_backend_ops",
+                    ["state"])
+    op.create_index("idx_quark_backend_ops_resource_sequence",
+                    "quark_backend_ops", ["resource_id", "sequence"],
+                    unique=True)
+    # NOTE(jkoelker) NULL reads as ACTIVE, which every existing port is.
+    op.add_column("quark_ports", sa.Column("status", sa.String(length=16)))
+
+
+def downgrade():
+    op.drop_column("quark_ports", "status")
+    op.drop_index("idx_quark_backend_ops_resource_sequence",
+                  table_name="quark_backend_ops")
+    op.drop_index("ix_quark_backend_ops_state",
+                  table_name="quark_backend_ops")
+    op.drop_table("quark_backend_ops")
@@ -0,0 +1,29 @@
+"""Add the per tenant resource counts
+
+Revision ID: 5049d724ceaa
+Revises: 67dc75bacc48
+Create Date: 2026-10-16 09:14:03.118764
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5049d724ceaa'
+down_revision = '67dc75bacc48'
+
+
+def upgrade():
+    op.create_table(
+        "quark_tenant_counts",
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("tenant_id", sa.String(length=255), nullable=False),
+        sa.Column("resource", sa.String(length=255), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("tenant_id", "resource"),
+        mysql_engine="InnoDB")
+
+
+def downgrade():
+    op.drop_table("quark_tenant_counts")
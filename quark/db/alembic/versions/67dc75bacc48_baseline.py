@@ -0,0 +1,22 @@
+"""Baseline quark schema
+
+Revision ID: 67dc75bacc48
+Revises: None
+Create Date: 2026-10-16 09:12:41.501233
+
+Databases created from the models before the migration chain existed
+are stamped here with "alembic stamp 67dc75bacc48" and upgraded to head.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '67dc75bacc48'
+down_revision = None
+
+
+def upgrade():
+    pass
+
+
+def downgrade():
+    pass
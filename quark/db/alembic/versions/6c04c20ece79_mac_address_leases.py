@@ -0,0 +1,36 @@
+"""Add the per worker MAC address range leases
+
+Revision ID: 6c04c20ece79
+Revises: a5afa8c1ae39
+Create Date: 2026-10-16 21:06:19.064528
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '6c04c20ece79'
+down_revision = 'a5afa8c1ae39'
+
+
+def upgrade():
+    op.create_table(
+        "quark_mac_address_leases",
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("id", sa.String(length=36), nullable=False),
+        sa.Column("mac_address_range_id", sa.String(length=36),
+                  nullable=False),
+        sa.Column("first_address", sa.BigInteger(), nullable=False),
+        sa.Column("last_address", sa.BigInteger(), nullable=False),
+        sa.Column("owner", sa.String(length=255), nullable=False),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["mac_address_range_id"],
+                                ["quark_mac_address_ranges.id"],
+                                ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+        mysql_engine="InnoDB")
+
+
+def downgrade():
+    op.drop_table("quark_mac_address_leases")
@@ -0,0 +1,47 @@
+"""Add the deallocated IP address reuse queue
+
+Revision ID: 89c228075340
+Revises: 6c04c20ece79
+Create Date: 2026-10-16 21:07:40.918253
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '89c228075340'
+down_revision = '6c04c20ece79'
+
+
+def upgrade():
+    op.create_table(
+        "quark_reusable_ip_addresses",
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("id", sa.String(length=36), nullable=False),
+        sa.Column("ip_address_id", sa.String(length=36), nullable=False),
+        sa.Column("network_id", sa.String(length=36), nullable=False),
+        sa.Column("version", sa.Integer(), nullable=True),
+        sa.Column("deallocated_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["ip_address_id"], ["quark_ip_addresses.id"],
+                                ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+        mysql_engine="InnoDB")
+    op.create_index("ix_quark_reusable_ip_addresses_network_id",
+                    "quark_reusable_ip_addresses", ["network_id"])
+
+    # NOTE(jkoelker) Queue what is already deallocated, the same rows
+    #                ip_reuse_queue_sweep would pick up. Each address id
+    #                doubles as its entry's id.
+    op.execute("INSERT INTO quark_reusable_ip_addresses "
+               "(created_at, id, ip_address_id, network_id, version, "
+               "deallocated_at) "
+               "SELECT deallocated_at, id, id, network_id, version, "
+               "deallocated_at FROM quark_ip_addresses "
+               "WHERE _deallocated = 1 AND deallocated_at IS NOT NULL")
+
+
+def downgrade():
+    op.drop_index("ix_quark_reusable_ip_addresses_network_id",
+                  table_name="quark_reusable_ip_addresses")
+    op.drop_table("quark_reusable_ip_addresses")
@@ -0,0 +1,61 @@
+"""Index the hot lookup predicates
+
+Revision ID: 95aa364eba8a
+Revises: 187faaa3037e
+Create Date: 2026-10-16 09:15:27.940112
+
+"""
+
+from alembic import op
+
+from quark.db import custom_types
+
+# revision identifiers, used by Alembic.
+revision = '95aa364eba8a'
+down_revision = '187faaa3037e'
+
+INDEXES = (
+    ("idx_quark_ip_addresses_reuse", "quark_ip_addresses",
+     ["network_id", "_deallocated", "deallocated_at"]),
+    ("idx_quark_ip_addresses_network_address", "quark_ip_addresses",
+     ["network_id", "address"]),
+    ("idx_quark_ip_addresses_subnet_address", "quark_ip_addresses",
+     ["subnet_id", "address"]),
+    ("idx_quark_ip_free_ranges_subnet", "quark_ip_free_ranges",
+     ["subnet_id", "first_address"]),
+    ("idx_quark_subnets_tenant_network", "quark_subnets",
+     ["tenant_id", "network_id"]),
+    ("idx_quark_security_groups_tenant", "quark_security_groups",
+     ["tenant_id"]),
+    ("idx_quark_ports_tenant_network", "quark_ports",
+     ["tenant_id", "network_id"]),
+    ("idx_quark_ports_device_id", "quark_ports", ["device_id"]),
+    ("idx_quark_mac_addresses_reuse", "quark_mac_addresses",
+     ["deallocated", "deallocated_at"]),
+    ("idx_quark_networks_tenant", "quark_networks", ["tenant_id"]),
+    ("idx_quark_nvp_driver_lswitchport_port",
+     "quark_nvp_driver_lswitchport", ["port_id"]),
+    ("idx_quark_nvp_driver_lswitch_network", "quark_nvp_driver_lswitch",
+     ["network_id", "port_count"]),
+    ("idx_quark_nvp_driver_lswitch_nvp_id", "quark_nvp_driver_lswitch",
+     ["nvp_id"]),
+)
+
+
+# NOTE(jkoelker) INET is a BLOB on MySQL, these only index a prefix of it
+PREFIXED = ("idx_quark_ip_addresses_network_address",
+            "idx_quark_ip_addresses_subnet_address",
+            "idx_quark_ip_free_ranges_subnet")
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        kwargs = {}
+        if name in PREFIXED:
+            kwargs["mysql_length"] = custom_types.INET_INDEX_LENGTH
+        op.create_index(name, table, columns, **kwargs)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,23 @@
+"""Version IP policies for the compiled policy cache
+
+Revision ID: a5afa8c1ae39
+Revises: 14a7d2583299
+Create Date: 2026-10-16 21:05:02.730144
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a5afa8c1ae39'
+down_revision = '14a7d2583299'
+
+
+def upgrade():
+    op.add_column("quark_ip_policy",
+                  sa.Column("revision", sa.Integer(), server_default="0"))
+
+
+def downgrade():
+    op.drop_column("quark_ip_policy", "revision")
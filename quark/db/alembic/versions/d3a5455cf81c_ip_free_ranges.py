@@ -0,0 +1,40 @@
+"""Add the per subnet free range index
+
+Revision ID: d3a5455cf81c
+Revises: 5049d724ceaa
+Create Date: 2026-10-16 21:02:11.482317
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from quark.db import custom_types
+
+# revision identifiers, used by Alembic.
+revision = 'd3a5455cf81c'
+down_revision = '5049d724ceaa'
+
+
+def upgrade():
+    op.create_table(
+        "quark_ip_free_ranges",
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("id", sa.String(length=36), nullable=False),
+        sa.Column("subnet_id", sa.String(length=36), nullable=False),
+        sa.Column("first_address", custom_types.INET(), nullable=False),
+        sa.Column("last_address", custom_types.INET(), nullable=False),
+        sa.ForeignKeyConstraint(["subnet_id"], ["quark_subnets.id"],
+                                ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+        mysql_engine="InnoDB")
+    # NOTE(jkoelker) Existing subnets build their index the first time they
+    #                allocate from it.
+    op.add_column("quark_subnets",
+                  sa.Column("free_ranges_built", sa.Boolean(),
+                            server_default="0"))
+
+
+def downgrade():
+    op.drop_column("quark_subnets", "free_ranges_built")
+    op.drop_table("quark_ip_free_ranges")
@@ -19,20 +19,85 @@ import inspect
 from neutron.openstack.common import log as logging
 from neutron.openstack.common import timeutils
 from neutron.openstack.common import uuidutils
+from neutron.openstack.common.db import exception as db_exc
+from oslo.config import cfg
+import sqlalchemy as sa
+from sqlalchemy.ext import compiler
 from sqlalchemy import event
 from sqlalchemy import func as sql_func
-from sqlalchemy import and_, orm, or_
+from sqlalchemy import and_, exists, orm, or_
+from sqlalchemy.sql import expression
 
 from quark.db import models
+from quark import exceptions as q_exc
 from quark import network_strategy
 
 
+CONF = cfg.CONF
 STRATEGY = network_strategy.STRATEGY
 LOG = logging.getLogger(__name__)
 
 ONE = "one"
 ALL = "all"
 
+BACKEND_OP_CREATE_ATTEMPTS = 3
+
+# NOTE(jkoelker) Columns each API attribute sorts by. Attributes the views
+#                build from a constant map to None and don't change the
+#                order. id always breaks ties, and only the keys listings
+#                are commonly sorted by have an index behind them.
+SORT_KEYS = {
+    models.Network: {"id": "id", "name": "name", "tenant_id": "tenant_id",
+                     "ipam_strategy": "ipam_strategy",
+                     "admin_state_up": None, "status": None},
+    models.Port: {"id": "id", "name": "name", "tenant_id": "tenant_id",
+                  "network_id": "network_id", "device_id": "device_id",
+                  "device_owner": "device_owner",
+                  "mac_address": "mac_address",
+                  "admin_state_up": "admin_state_up", "status": "status"},
+    models.Subnet: {"id": "id", "name": "name", "tenant_id": "tenant_id",
+                    "network_id": "network_id", "ip_version": "ip_version",
+                    "cidr": "_cidr", "enable_dhcp": None},
+    models.SecurityGroup: {"id": "id", "name": "name",
+                           "description": "description",
+                           "tenant_id": "tenant_id"},
+    models.SecurityGroupRule: {"id": "id", "security_group_id": "group_id",
+                               "tenant_id": "tenant_id",
+                               "direction": "direction",
+                               "ethertype": "ethertype",
+                               "protocol": "protocol",
+                               "port_range_min": "port_range_min",
+                               "port_range_max": "port_range_max",
+                               "remote_ip_prefix": "remote_ip_prefix",
+                               "remote_group_id": "remote_group_id"},
+}
+
+# NOTE(jkoelker) Columns each API attribute is built from. Relationships
+#                and constants need none, attributes missing here need
+#                the whole row.
+FIELD_COLUMNS = {
+    models.Network: {"id": (), "name": ("name",), "tenant_id": ("tenant_id",),
+                     "ipam_strategy": ("ipam_strategy",),
+                     "admin_state_up": (), "status": (), "shared": (),
+                     "subnets": ()},
+    models.Port: {"id": (), "name": ("name",), "tenant_id": ("tenant_id",),
+                  "network_id": ("network_id",),
+                  "mac_address": ("mac_address",),
+                  "admin_state_up": ("admin_state_up",),
+                  "status": ("status",), "device_id": ("device_id",),
+                  "device_owner": ("device_owner",), "bridge": ("bridge",),
+                  "security_groups": (), "fixed_ips": ()},
+    models.Subnet: {"id": (), "name": ("name",), "tenant_id": ("tenant_id",),
+                    "network_id": ("network_id",), "shared": ("network_id",),
+                    "ip_version": ("ip_version",), "cidr": ("_cidr",),
+                    "enable_dhcp": (), "dns_nameservers": (),
+                    "host_routes": (), "gateway_ip": ()},
+    models.SecurityGroup: {"id": (), "name": ("name",),
+                           "description": ("description",),
+                           "tenant_id": ("tenant_id",),
+                           "security_group_rules": ()},
+}
+
 
 # NOTE(jkoelker) init event listener that will ensure id is filled in
 #                on object creation (prior to commit).
@@ -128,6 +193,106 @@ def _model_query(context, model, filters, fields=None):
     return model_filters
 
 
+def _after(column, value, ascending):
+    """Criterion for the rows sorting after value on column.
+
+    NULL sorts before any value, as MySQL and sqlite order it.
+    """
+    if ascending:
+        if value is None:
+            return column != None  # noqa
+        return column > value
+    if value is None:
+        return None
+    return or_(column < value, column == None)  # noqa
+
+
+def _same(column, value):
+    if value is None:
+        return column == None  # noqa
+    return column == value
+
+
+def _paginate(query, limit=None, sorts=None, marker=None,
+              page_reverse=False):
+    """Orders query by sorts and returns the limit rows after marker.
+
+    sorts is a list of (key, ascending) pairs and marker the id of the
+    last row of the previous page. Rather than an OFFSET, the page starts
+    with a comparison against the marker row's sort keys, so each page
+    costs the same however deep into the listing it is. With page_reverse
+    the page before the marker is returned, in reverse order. The marker
+    is looked up through query, so it has to be a row of the listing.
+    """
+    model = query.column_descriptions[0]["type"]
+    columns = SORT_KEYS.get(model, {"id": "id"})
+    sorts = list(sorts or [])
+    if "id" not in [key for key, ascending in sorts]:
+        sorts.append(("id", True))
+    for key, ascending in sorts:
+        if key not in columns:
+            raise q_exc.InvalidSortKey(key=key,
+                                       keys=", ".join(sorted(columns)))
+    sorts = [(getattr(model, columns[key]), ascending != page_reverse)
+             for key, ascending in sorts if columns[key]]
+
+    if marker:
+        marker_row = query.enable_eagerloads(False).order_by(None).\
+            filter(model.id == marker).first()
+        if not marker_row:
+            raise q_exc.MarkerNotFound(marker=marker)
+        after = []
+        for i, (column, ascending) in enumerate(sorts):
+            criterion = _after(column, getattr(marker_row, column.key),
+                               ascending)
+            if criterion is None:
+                continue
+            criteria = [_same(c, getattr(marker_row, c.key))
+                        for c, a in sorts[:i]]
+            criteria.append(criterion)
+            after.append(and_(*criteria))
+        query = query.filter(or_(*after))
+
+    for column, ascending in sorts:
+        if ascending:
+            query = query.order_by(column.asc())
+        else:
+            query = query.order_by(column.desc())
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def _project(query, model, fields=None, eager=None):
+    """Loads only what the API attributes in fields are built from.
+
+    eager maps attributes to the relationships they are built from, which
+    are joined eagerly when the attribute is asked for. The columns no
+    attribute needs are deferred, so an id only listing never reads more
+    than the index. Without fields, or with an attribute FIELD_COLUMNS
+    doesn't know, the whole row and every eager relationship is loaded.
+    """
+    eager = eager or {}
+    columns = FIELD_COLUMNS.get(model, {})
+    if not fields or [field for field in fields if field not in columns]:
+        relationships = set(eager.values())
+        if relationships:
+            query = query.options(*[orm.joinedload(relationship)
+                                    for relationship in relationships])
+        return query
+
+    needed = set(["id"])
+    for field in fields:
+        needed.update(columns[field])
+    options = [orm.joinedload(relationship) for relationship in
+               set(eager[field] for field in fields if field in eager)]
+    options.extend(orm.defer(prop.key) for prop in
+                   orm.class_mapper(model).iterate_properties
+                   if isinstance(prop, orm.ColumnProperty) and
+                   prop.key not in needed)
+    return query.options(*options)
+
+
 def scoped(f):
     def wrapped(*args, **kwargs):
         scope = None
@@ -135,6 +300,9 @@ def scoped(f):
             scope = kwargs.pop("scope")
         if scope not in [None, ALL, ONE]:
             raise Exception("Invalid scope")
+        page = dict((key, kwargs.pop(key)) for key in
+                    ("limit", "sorts", "marker", "page_reverse")
+                    if key in kwargs)
         _listify(kwargs)
 
         res = f(*args, **kwargs)
@@ -142,6 +310,8 @@ def scoped(f):
             return
         if "order_by" in kwargs:
             res = res.order_by(kwargs["order_by"])
+        if page.get("limit") or page.get("sorts") or page.get("marker"):
+            res = _paginate(res, **page)
 
         if scope == ALL:
             if isinstance(res, list):
@@ -156,9 +326,9 @@ def scoped(f):
 
 
 @scoped
-def port_find(context, **filters):
-    query = context.session.query(models.Port).\
-        options(orm.joinedload(models.Port.ip_addresses))
+def port_find(context, fields=None, **filters):
+    query = _project(context.session.query(models.Port), models.Port,
+                     fields, {"fixed_ips": models.Port.ip_addresses})
     model_filters = _model_query(context, models.Port, filters)
 
     if filters.get("ip_address_id"):
@@ -172,9 +342,7 @@ def port_find(context, **filters):
 
 
 def port_count_all(context, **filters):
-    query = context.session.query(sql_func.count(models.Port.id))
-    model_filters = _model_query(context, models.Port, filters)
-    return query.filter(*model_filters).scalar()
+    return count(context, models.Port, **filters)
 
 
 def port_create(context, **port_dict):
@@ -184,6 +352,7 @@ def port_create(context, **port_dict):
     if "addresses" in port_dict:
         port["ip_addresses"].extend(port_dict["addresses"])
     context.session.add(port)
+    _adjust_tenant_count(context, models.Port, port["tenant_id"], 1)
     return port
 
 
@@ -197,6 +366,7 @@ def port_update(context, port, **kwargs):
 
 def port_delete(context, port):
     context.session.delete(port)
+    _adjust_tenant_count(context, models.Port, port["tenant_id"], -1)
 
 
 def ip_address_update(context, address, **kwargs):
@@ -205,6 +375,110 @@ def ip_address_update(context, address, **kwargs):
     return address
 
 
+def _adjust_tenant_count(context, model, tenant_id, delta):
+    # NOTE(jkoelker) Counters missing a row are left alone, count seeds
+    #                them from the table the first time it is asked
+    if not CONF.QUARK.tenant_counts or not tenant_id:
+        return
+    query = context.session.query(models.TenantCount).filter(
+        models.TenantCount.tenant_id == tenant_id,
+        models.TenantCount.resource == model.__tablename__)
+    query.update({"count": models.TenantCount.count + delta},
+                 synchronize_session=False)
+
+
+def _counted_tenant(context, filters):
+    """Returns the tenant a count is for, if it filters on nothing else."""
+    filters = dict((key, value) for key, value in filters.items() if value)
+    tenant_ids = filters.pop("tenant_id", None)
+    if filters:
+        return None
+    if tenant_ids is None:
+        return not context.is_admin and context.tenant_id or None
+    if not isinstance(tenant_ids, (list, tuple)):
+        tenant_ids = [tenant_ids]
+    if len(tenant_ids) == 1:
+        return tenant_ids[0]
+
+
+class _InsertFromSelect(expression.Executable, expression.ClauseElement):
+    def __init__(self, table, select):
+        self.table = table
+        self.select = select
+
+
+@compiler.compiles(_InsertFromSelect)
+def _visit_insert_from_select(element, compiler, **kw):
+    return "INSERT INTO %s (%s) %s" % (
+        compiler.process(element.table, asfrom=True),
+        ", ".join(compiler.preparer.quote(c.name, c.quote)
+                  for c in element.table.c),
+        compiler.process(element.select))
+
+
+def _seed_tenant_count(context, model, tenant_id):
+    """Writes the TenantCount of a tenant and returns it.
+
+    The count is an INSERT ... SELECT, so on InnoDB it waits for the
+    writes on the tenant's rows in flight, the ones whose counter update
+    found no row, and counts them. Losing the race to another seed only
+    rolls back the savepoint.
+    """
+    counts = models.TenantCount.__table__
+    values = {"created_at": sa.literal(timeutils.utcnow()),
+              "tenant_id": sa.literal(tenant_id),
+              "resource": sa.literal(model.__tablename__),
+              "count": sql_func.count()}
+    select = sa.select([values[c.name] for c in counts.c]).\
+        where(model.__table__.c.tenant_id == tenant_id)
+    try:
+        with context.session.begin_nested():
+            context.session.execute(_InsertFromSelect(counts, select))
+    except db_exc.DBDuplicateEntry:
+        pass
+    return context.session.query(models.TenantCount).populate_existing().\
+        get((tenant_id, model.__tablename__))
+
+
+def count(context, model, approximate=False, **filters):
+    """Counts the rows the find function of model returns for filters.
+
+    The filters are the ones the find functions take and the count is a
+    COUNT(*) over the same criteria, which the tenant, network and device
+    indexes cover. With approximate and tenant_counts set, counts of all
+    of a tenant's rows come from its TenantCount instead, seeded the first
+    time.
+    """
+    finds = {models.Network: network_find, models.Subnet: subnet_find,
+             models.Port: port_find}
+    tenant_id = None
+    if approximate and CONF.QUARK.tenant_counts:
+        tenant_id = _counted_tenant(context, filters)
+    if tenant_id:
+        counter = context.session.query(models.TenantCount).get(
+            (tenant_id, model.__tablename__))
+        if not counter:
+            counter = _seed_tenant_count(context, model, tenant_id)
+        if counter:
+            return max(counter.count, 0)
+
+    query = finds[model](context, **filters)
+    total = 0
+    if query is not None:
+        total = query.with_entities(sql_func.count()).\
+            select_from(model.__table__).scalar()
+    return total
+
+
+def _adjust_allocated_count(context, model, model_id, delta):
+    if not model_id:
+        return
+    query = context.session.query(model).filter(model.id == model_id)
+    query.update({"allocated_count":
+                  sql_func.coalesce(model.allocated_count, 0) + delta},
+                 synchronize_session=False)
+
+
 def ip_address_create(context, **address_dict):
     ip_address = models.IPAddress()
     address = address_dict.pop("address")
@@ -215,9 +489,92 @@ def ip_address_create(context, **address_dict):
     ip_address["_deallocated"] = 0
     ip_address["allocated_at"] = timeutils.utcnow()
     context.session.add(ip_address)
+    _adjust_allocated_count(context, models.Subnet,
+                            address_dict.get("subnet_id"), 1)
     return ip_address
 
 
+def ip_address_delete(context, address):
+    _adjust_allocated_count(context, models.Subnet, address.get("subnet_id"),
+                            -1)
+    context.session.delete(address)
+
+
+def ip_reuse_queue_push(context, address):
+    entry = models.ReusableIPAddress()
+    entry.update(dict(ip_address_id=address["id"],
+                      network_id=address["network_id"],
+                      version=address["version"],
+                      deallocated_at=address["deallocated_at"]))
+    context.session.add(entry)
+    return entry
+
+
+def ip_reuse_queue_peek(context, network_id, version, reuse_after, limit=5):
+    reuse = (timeutils.utcnow() -
+             datetime.timedelta(seconds=reuse_after))
+    Reusable = models.ReusableIPAddress
+    query = context.session.query(Reusable).filter(
+        Reusable.network_id == network_id,
+        Reusable.version.in_(version),
+        Reusable.deallocated_at <= reuse)
+    return query.order_by(Reusable.deallocated_at).limit(limit).all()
+
+
+def ip_reuse_queue_pop(context, entry):
+    """Deletes entry by primary key, True if this caller removed it."""
+    query = context.session.query(models.ReusableIPAddress).filter(
+        models.ReusableIPAddress.id == entry["id"])
+    popped = query.delete(synchronize_session=False)
+    if popped:
+        context.session.expunge(entry)
+    return popped == 1
+
+
+def ip_reuse_queue_sweep(context, limit=None):
+    """Queues deallocated addresses that have no reuse entry yet.
+
+    Returns the number of addresses queued.
+    """
+    Reusable = models.ReusableIPAddress
+    query = context.session.query(models.IPAddress).outerjoin(
+        Reusable, Reusable.ip_address_id == models.IPAddress.id)
+    query = query.filter(models.IPAddress._deallocated == 1)
+    query = query.filter(models.IPAddress.deallocated_at != None)  # noqa
+    query = query.filter(Reusable.id == None)  # noqa
+    if limit:
+        query = query.limit(limit)
+    queued = 0
+    for address in query:
+        ip_reuse_queue_push(context, address)
+        queued += 1
+    return queued
+
+
+def ip_reuse_queue_prune(context, limit=None):
+    """Drops entries whose address has been allocated again since.
+
+    Returns the number of entries dropped.
+    """
+    Reusable = models.ReusableIPAddress
+    query = context.session.query(Reusable).join(
+        models.IPAddress, Reusable.ip_address_id == models.IPAddress.id)
+    query = query.filter(models.IPAddress._deallocated != 1)
+    if limit:
+        query = query.limit(limit)
+    pruned = 0
+    for entry in query:
+        if ip_reuse_queue_pop(context, entry):
+            pruned += 1
+    return pruned
+
+
+def ip_address_count_by_subnet(context):
+    query = context.session.query(models.IPAddress.subnet_id,
+                                  sql_func.count(models.IPAddress.id))
+    return dict(query.group_by(models.IPAddress.subnet_id))
+
+
 @scoped
 def ip_address_find(context, lock_mode=False, **filters):
     query = context.session.query(models.IPAddress)
@@ -248,6 +605,71 @@ def ip_address_find(context, lock_mode=False, **filters):
     return query.filter(*model_filters)
 
 
+@scoped
+def ip_free_range_find(context, lock_mode=False, **filters):
+    query = context.session.query(models.IPFreeRange)
+    if lock_mode:
+        # NOTE(jkoelker) Ranges already in the session may be stale after a
+        #                lost claim, overwrite them with what was just read.
+        query = query.with_lockmode("update").populate_existing()
+    model_filters = _model_query(context, models.IPFreeRange, filters)
+    return query.filter(*model_filters)
+
+
+def ip_free_range_create(context, **range_dict):
+    free_range = models.IPFreeRange()
+    free_range.update(range_dict)
+    context.session.add(free_range)
+    return free_range
+
+
+def ip_free_range_delete(context, free_range):
+    context.session.delete(free_range)
+
+
+def ip_free_range_claim(context, free_range, address):
+    """Removes address from free_range, splitting the range if needed.
+
+    The row is only touched if it still holds the bounds the caller read,
+    so two allocators racing for the same range can't both win. Returns
+    True if the address was claimed.
+    """
+    first = int(free_range["first_address"])
+    last = int(free_range["last_address"])
+    address = int(address)
+    if address < first or address > last:
+        return False
+
+    query = context.session.query(models.IPFreeRange).filter(
+        models.IPFreeRange.id == free_range["id"],
+        models.IPFreeRange.first_address == first,
+        models.IPFreeRange.last_address == last)
+
+    if first == last:
+        claimed = query.delete(synchronize_session=False)
+    elif address == first:
+        claimed = query.update({"first_address": address + 1},
+                               synchronize_session=False)
+    elif address == last:
+        claimed = query.update({"last_address": address - 1},
+                               synchronize_session=False)
+    else:
+        claimed = query.update({"last_address": address - 1},
+                               synchronize_session=False)
+        if claimed:
+            ip_free_range_create(context, subnet_id=free_range["subnet_id"],
+                                 first_address=address + 1,
+                                 last_address=last)
+
+    if claimed:
+        # NOTE(jkoelker) the bulk update bypassed the identity map
+        if first == last:
+            context.session.expunge(free_range)
+        else:
+            context.session.expire(free_range)
+    return claimed == 1
+
+
 @scoped
 def mac_address_find(context, lock_mode=False, **filters):
     query = context.session.query(models.MacAddress)
@@ -259,17 +681,94 @@ def mac_address_find(context, lock_mode=False, **filters):
 
 def mac_address_range_find_allocation_counts(context, address=None):
     query = context.session.query(models.MacAddressRange,
-                                  sql_func.count(models.MacAddress.address).
-                                  label("count")).with_lockmode("update")
-    query = query.outerjoin(models.MacAddress)
-    query = query.group_by(models.MacAddressRange)
-    query = query.order_by("count DESC")
+                                  models.MacAddressRange.allocated_count)
+    query = query.with_lockmode("update")
+    query = query.order_by(models.MacAddressRange.allocated_count.desc())
     if address:
         query = query.filter(models.MacAddressRange.last_address >= address)
         query = query.filter(models.MacAddressRange.first_address <= address)
     return query
 
 
+def mac_address_range_reserve_block(context, size):
+    """Advances next_auto_assign_mac of some range by up to size addresses.
+
+    The advance is a compare-and-swap on the value just read, so no row
+    locks are held between the read and the write. Returns a
+    (range, first, last) tuple for the reserved block, or None if every
+    range is exhausted.
+    """
+    MacAddressRange = models.MacAddressRange
+    query = context.session.query(MacAddressRange).filter(
+        MacAddressRange.next_auto_assign_mac <= MacAddressRange.last_address)
+    for rng in query:
+        first = rng["next_auto_assign_mac"]
+        last = min(first + size - 1, rng["last_address"])
+        reserve = context.session.query(MacAddressRange).filter(
+            MacAddressRange.id == rng["id"],
+            MacAddressRange.next_auto_assign_mac == first)
+        reserved = reserve.update({"next_auto_assign_mac": last + 1},
+                                  synchronize_session=False)
+        if reserved:
+            context.session.expire(rng)
+            return rng, first, last
+    return None
+
+
+def mac_address_lease_create(context, **lease_dict):
+    lease = models.MacAddressLease()
+    lease.update(lease_dict)
+    context.session.add(lease)
+    return lease
+
+
+def mac_address_lease_reclaim(context, owner, expires_at):
+    """Takes over a lease that has expired or been released.
+
+    Returns the lease, now owned by owner, or None if there is nothing to
+    reclaim.
+    """
+    MacAddressLease = models.MacAddressLease
+    query = context.session.query(MacAddressLease).filter(
+        MacAddressLease.expires_at <= timeutils.utcnow())
+    for lease in query.order_by(MacAddressLease.first_address):
+        reclaim = context.session.query(MacAddressLease).filter(
+            MacAddressLease.id == lease["id"],
+            MacAddressLease.owner == lease["owner"],
+            MacAddressLease.expires_at == lease["expires_at"])
+        reclaimed = reclaim.update({"owner": owner,
+                                    "expires_at": expires_at},
+                                   synchronize_session=False)
+        if reclaimed:
+            context.session.expire(lease)
+            return lease
+    return None
+
+
+def mac_address_lease_renew(context, lease_id, owner, first_address,
+                            expires_at):
+    """Records progress on a lease and pushes its expiry out.
+
+    Returns False if the lease was reclaimed by somebody else meanwhile.
+    """
+    MacAddressLease = models.MacAddressLease
+    query = context.session.query(MacAddressLease).filter(
+        MacAddressLease.id == lease_id,
+        MacAddressLease.owner == owner)
+    renewed = query.update({"first_address": first_address,
+                            "expires_at": expires_at},
+                           synchronize_session=False)
+    return renewed == 1
+
+
+def mac_address_lease_delete(context, lease_id, owner):
+    MacAddressLease = models.MacAddressLease
+    query = context.session.query(MacAddressLease).filter(
+        MacAddressLease.id == lease_id,
+        MacAddressLease.owner == owner)
+    query.delete(synchronize_session=False)
+
+
 @scoped
 def mac_address_range_find(context, **filters):
     query = context.session.query(models.MacAddressRange)
@@ -301,9 +800,17 @@ def mac_address_create(context, **mac_dict):
     mac_address["deallocated"] = False
     mac_address["deallocated_at"] = None
     context.session.add(mac_address)
+    _adjust_allocated_count(context, models.MacAddressRange,
+                            mac_dict.get("mac_address_range_id"), 1)
     return mac_address
 
 
+def mac_address_count_by_range(context):
+    query = context.session.query(models.MacAddress.mac_address_range_id,
+                                  sql_func.count(models.MacAddress.address))
+    return dict(query.group_by(models.MacAddress.mac_address_range_id))
+
+
 @scoped
 def network_find(context, fields=None, **filters):
     ids = []
@@ -328,7 +835,8 @@ def network_find(context, fields=None, **filters):
 
 
 def _network_find(context, fields, defaults=None, **filters):
-    query = context.session.query(models.Network)
+    query = _project(context.session.query(models.Network), models.Network,
+                     fields)
     model_filters = _model_query(context, models.Network, filters, query)
 
     if defaults:
@@ -351,6 +859,7 @@ def network_create(context, **network):
     new_net = models.Network()
     new_net.update(network)
     context.session.add(new_net)
+    _adjust_tenant_count(context, models.Network, new_net["tenant_id"], 1)
     return new_net
 
 
@@ -360,23 +869,20 @@ def network_update(context, network, **kwargs):
     return network
 
 
-def network_count_all(context):
-    query = context.session.query(sql_func.count(models.Network.id))
-    return query.filter(models.Network.tenant_id == context.tenant_id).\
-        scalar()
+def network_count_all(context, **filters):
+    return count(context, models.Network, **filters)
 
 
 def network_delete(context, network):
     context.session.delete(network)
+    _adjust_tenant_count(context, models.Network, network["tenant_id"], -1)
 
 
 def subnet_find_allocation_counts(context, net_id, **filters):
     query = context.session.query(models.Subnet,
-                                  sql_func.count(models.IPAddress.address).
-                                  label("count")).with_lockmode('update')
-    query = query.outerjoin(models.Subnet.allocated_ips)
-    query = query.group_by(models.Subnet)
-    query = query.order_by("count DESC")
+                                  models.Subnet.allocated_count)
+    query = query.with_lockmode('update')
+    query = query.order_by(models.Subnet.allocated_count.desc())
 
     query = query.filter(models.Subnet.network_id == net_id)
     if "ip_version" in filters:
@@ -385,26 +891,42 @@ def subnet_find_allocation_counts(context, net_id, **filters):
 
 
 @scoped
-def subnet_find(context, **filters):
+def subnet_find(context, fields=None, **filters):
     if "shared" in filters and True in filters["shared"]:
         return []
-    query = context.session.query(models.Subnet).\
-        options(orm.joinedload(models.Subnet.routes))
+    query = _project(context.session.query(models.Subnet), models.Subnet,
+                     fields, {"host_routes": models.Subnet.routes,
+                              "gateway_ip": models.Subnet.routes})
     model_filters = _model_query(context, models.Subnet, filters)
     return query.filter(*model_filters)
 
 
 def subnet_count_all(context, **filters):
-    query = context.session.query(sql_func.count(models.Subnet.id))
-    if filters.get("network_id"):
-        query = query.filter(
-            models.Subnet.network_id == filters["network_id"])
-    query.filter(models.Subnet.tenant_id == context.tenant_id)
-    return query.scalar()
+    return count(context, models.Subnet, **filters)
+
+
+def subnet_reset_policy_excluded_count(context, subnet_ids=None,
+                                       network_ids=None, ip_policy_id=None):
+    model_filters = []
+    if ip_policy_id:
+        networks = context.session.query(models.Network.id).filter(
+            models.Network.ip_policy_id == ip_policy_id)
+        model_filters.append(models.Subnet.ip_policy_id == ip_policy_id)
+        model_filters.append(models.Subnet.network_id.in_(
+            networks.subquery()))
+    if subnet_ids:
+        model_filters.append(models.Subnet.id.in_(subnet_ids))
+    if network_ids:
+        model_filters.append(models.Subnet.network_id.in_(network_ids))
+    if not model_filters:
+        return
+    query = context.session.query(models.Subnet).filter(or_(*model_filters))
+    query.update({"policy_excluded_count": None}, synchronize_session=False)
 
 
 def subnet_delete(context, subnet):
     context.session.delete(subnet)
+    _adjust_tenant_count(context, models.Subnet, subnet["tenant_id"], -1)
 
 
 def subnet_create(context, **subnet_dict):
@@ -412,12 +934,14 @@ def subnet_create(context, **subnet_dict):
     subnet.update(subnet_dict)
     subnet["tenant_id"] = context.tenant_id
     context.session.add(subnet)
+    _adjust_tenant_count(context, models.Subnet, subnet["tenant_id"], 1)
     return subnet
 
 
 def subnet_update(context, subnet, **kwargs):
     subnet.update(kwargs)
     context.session.add(subnet)
+    models.IP_POLICY_CACHE.invalidate_subnet(subnet["id"])
     return subnet
 
 
@@ -461,9 +985,10 @@ def dns_delete(context, dns):
 
 
 @scoped
-def security_group_find(context, **filters):
-    query = context.session.query(models.SecurityGroup).\
-        options(orm.joinedload(models.SecurityGroup.rules))
+def security_group_find(context, fields=None, **filters):
+    query = _project(context.session.query(models.SecurityGroup),
+                     models.SecurityGroup, fields,
+                     {"security_group_rules": models.SecurityGroup.rules})
     model_filters = _model_query(context, models.SecurityGroup, filters)
     return query.filter(*model_filters)
 
@@ -517,6 +1042,8 @@ def ip_policy_create(context, **ip_policy_dict):
     new_policy.update(ip_policy_dict)
     new_policy["tenant_id"] = context.tenant_id
     context.session.add(new_policy)
+    for subnet_id in ip_policy_dict.get("subnet_ids") or []:
+        models.IP_POLICY_CACHE.invalidate_subnet(subnet_id)
     return new_policy
 
 
@@ -537,9 +1064,119 @@ def ip_policy_update(context, ip_policy, **ip_policy_dict):
             length=arange["length"]))
 
     ip_policy.update(ip_policy_dict)
+    ip_policy["revision"] = (ip_policy.get("revision") or 0) + 1
     context.session.add(ip_policy)
+    models.IP_POLICY_CACHE.invalidate_policy(ip_policy["id"])
     return ip_policy
 
 
 def ip_policy_delete(context, ip_policy):
+    models.IP_POLICY_CACHE.invalidate_policy(ip_policy["id"])
     context.session.delete(ip_policy)
+
+
+def backend_op_create(context, **op_dict):
+    """Records an operation after the last one on its resource.
+
+    The locking read orders enqueues on a resource that already has
+    operations, the unique index catches concurrent first enqueues and the
+    loser retries with the next sequence.
+    """
+    BackendOperation = models.BackendOperation
+    for attempt in xrange(BACKEND_OP_CREATE_ATTEMPTS):
+        last = context.session.query(BackendOperation.sequence).filter(
+            BackendOperation.resource_id == op_dict["resource_id"])
+        last = last.order_by(BackendOperation.sequence.desc()).limit(1)
+        last = last.with_lockmode("update").scalar()
+        op = BackendOperation()
+        op.update(op_dict)
+        op["sequence"] = (last or 0) + 1
+        try:
+            with context.session.begin_nested():
+                context.session.add(op)
+        except db_exc.DBDuplicateEntry:
+            if attempt + 1 == BACKEND_OP_CREATE_ATTEMPTS:
+                raise
+            continue
+        return op
+
+
+@scoped
+def backend_op_find(context, **filters):
+    BackendOperation = models.BackendOperation
+    query = context.session.query(BackendOperation)
+    if filters.get("id"):
+        query = query.filter(BackendOperation.id.in_(filters["id"]))
+    if filters.get("resource_id"):
+        query = query.filter(
+            BackendOperation.resource_id == filters["resource_id"])
+    if filters.get("operation"):
+        query = query.filter(
+            BackendOperation.operation == filters["operation"])
+    if filters.get("state"):
+        query = query.filter(BackendOperation.state == filters["state"])
+    return query
+
+
+def backend_op_runnable(context, stale_before, limit=None):
+    """Returns the operations a worker may claim, oldest first.
+
+    A pending operation is runnable once its run_at has passed, and a
+    running one once it was last touched before stale_before, as its
+    worker is assumed to be gone. Neither is runnable while an earlier
+    operation on the same resource is pending or running.
+    """
+    BackendOperation = models.BackendOperation
+    earlier = orm.aliased(BackendOperation)
+    blocked = exists().where(and_(
+        earlier.resource_id == BackendOperation.resource_id,
+        earlier.sequence < BackendOperation.sequence,
+        earlier.state.in_(["pending", "running"])))
+    query = context.session.query(BackendOperation).filter(
+        or_(and_(BackendOperation.state == "pending",
+                 BackendOperation.run_at <= timeutils.utcnow()),
+            and_(BackendOperation.state == "running",
+                 BackendOperation.updated_at <= stale_before)),
+        ~blocked)
+    query = query.order_by(BackendOperation.created_at,
+                           BackendOperation.sequence)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def backend_op_claim(context, op, owner):
+    """Marks an operation running for owner.
+
+    Returns False if another worker claimed it first.
+    """
+    BackendOperation = models.BackendOperation
+    query = context.session.query(BackendOperation).filter(
+        BackendOperation.id == op["id"],
+        BackendOperation.state == op["state"],
+        BackendOperation.updated_at == op["updated_at"])
+    claimed = query.update({"state": "running",
+                            "owner": owner,
+                            "attempts": BackendOperation.attempts + 1,
+                            "updated_at": timeutils.utcnow()},
+                           synchronize_session=False)
+    if claimed:
+        context.session.expire(op)
+    return claimed == 1
+
+
+def backend_op_finish(context, op, owner, **kwargs):
+    """Records the outcome of a claimed operation.
+
+    Returns False if the operation was reclaimed from owner meanwhile.
+    """
+    BackendOperation = models.BackendOperation
+    query = context.session.query(BackendOperation).filter(
+        BackendOperation.id == op["id"],
+        BackendOperation.owner == owner,
+        BackendOperation.state == "running")
+    kwargs["updated_at"] = timeutils.utcnow()
+    finished = query.update(kwargs, synchronize_session=False)
+    if finished:
+        context.session.expire(op)
+    return finished == 1
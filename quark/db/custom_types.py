@@ -17,6 +17,11 @@ from sqlalchemy.dialects import sqlite
 from sqlalchemy import types
 
 
+# NOTE(jkoelker) Addresses are bound as integers, which MySQL stores in the
+#                BLOB as up to 39 digits. Index that much of them.
+INET_INDEX_LENGTH = 39
+
+
 class INET(types.TypeDecorator):
     impl = types.LargeBinary
 
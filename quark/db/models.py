@@ -30,6 +30,7 @@ from neutron.openstack.common import timeutils
 from oslo.config import cfg
 
 from quark.db import custom_types
+from quark import intervals
 
 import json
 
@@ -171,6 +172,35 @@ class IPAddress(BASEV2, models.HasId, models.HasTenant):
     deallocated_at = sa.Column(sa.DateTime())
 
 
+sa.Index("idx_quark_ip_addresses_reuse", IPAddress.__table__.c.network_id,
+         IPAddress.__table__.c._deallocated,
+         IPAddress.__table__.c.deallocated_at)
+# NOTE(jkoelker) INET is a BLOB on MySQL, which can only index a prefix of
+#                it. The length applies to the last column of the index.
+sa.Index("idx_quark_ip_addresses_network_address",
+         IPAddress.__table__.c.network_id, IPAddress.__table__.c.address,
+         mysql_length=custom_types.INET_INDEX_LENGTH)
+sa.Index("idx_quark_ip_addresses_subnet_address",
+         IPAddress.__table__.c.subnet_id, IPAddress.__table__.c.address,
+         mysql_length=custom_types.INET_INDEX_LENGTH)
+
+
+class ReusableIPAddress(BASEV2, models.HasId):
+    """Queue of deallocated addresses waiting to be handed out again.
+
+    Entries are read without locks and popped by deleting them by primary
+    key, so only the allocator whose delete hits the row gets the address.
+    """
+    __tablename__ = "quark_reusable_ip_addresses"
+    ip_address_id = sa.Column(sa.String(36),
+                              sa.ForeignKey("quark_ip_addresses.id",
+                                            ondelete="CASCADE"),
+                              nullable=False)
+    network_id = sa.Column(sa.String(36), nullable=False, index=True)
+    version = sa.Column(sa.Integer())
+    deallocated_at = sa.Column(sa.DateTime(), nullable=False)
+
+
 class Route(BASEV2, models.HasTenant, models.HasId, IsHazTags):
     __tablename__ = "quark_routes"
     cidr = sa.Column(sa.String(64))
@@ -186,6 +216,28 @@ class DNSNameserver(BASEV2, models.HasTenant, models.HasId, IsHazTags):
                                                        ondelete="CASCADE"))
 
 
+class IPFreeRange(BASEV2, models.HasId):
+    """Run-length index of never-allocated, policy-permitted addresses.
+
+    Each row is an inclusive [first_address, last_address] interval of a
+    subnet that has not yet had an IPAddress row created in it. Addresses
+    that have been handed out once are recycled through the deallocation
+    path instead, so they never return to this index.
+    """
+    __tablename__ = "quark_ip_free_ranges"
+    subnet_id = sa.Column(sa.String(36),
+                          sa.ForeignKey("quark_subnets.id",
+                                        ondelete="CASCADE"),
+                          nullable=False)
+    first_address = sa.Column(custom_types.INET(), nullable=False)
+    last_address = sa.Column(custom_types.INET(), nullable=False)
+
+
+sa.Index("idx_quark_ip_free_ranges_subnet", IPFreeRange.__table__.c.subnet_id,
+         IPFreeRange.__table__.c.first_address,
+         mysql_length=custom_types.INET_INDEX_LENGTH)
+
+
 class Subnet(BASEV2, models.HasId, models.HasTenant, IsHazTags):
     """Upstream model for IPs.
 
@@ -241,6 +293,23 @@ class Subnet(BASEV2, models.HasId, models.HasTenant, IsHazTags):
         cascade='delete')
     ip_policy_id = sa.Column(sa.String(36),
                              sa.ForeignKey("quark_ip_policy.id"))
+    free_ranges = orm.relationship(
+        IPFreeRange,
+        primaryjoin="IPFreeRange.subnet_id==Subnet.id",
+        cascade="delete")
+    free_ranges_built = sa.Column(sa.Boolean(), default=False)
+
+    # NOTE(jkoelker) Denormalized so subnet selection doesn't have to
+    #                aggregate quark_ip_addresses. allocated_count counts
+    #                every address row in the subnet, deallocated or not,
+    #                and policy_excluded_count is NULL until computed.
+    allocated_count = sa.Column(sa.Integer(), nullable=False, default=0,
+                                server_default="0")
+    policy_excluded_count = sa.Column(sa.BigInteger())
+
+
+sa.Index("idx_quark_subnets_tenant_network", Subnet.__table__.c.tenant_id,
+         Subnet.__table__.c.network_id)
 
 
 port_ip_association_table = sa.Table(
@@ -287,6 +356,10 @@ class SecurityGroup(BASEV2, models.HasId, models.HasTenant):
                              primaryjoin=join)
 
 
+sa.Index("idx_quark_security_groups_tenant",
+         SecurityGroup.__table__.c.tenant_id)
+
+
 class Port(BASEV2, models.HasTenant, models.HasId):
     __tablename__ = "quark_ports"
     id = sa.Column(sa.String(36), primary_key=True)
@@ -296,6 +369,7 @@ class Port(BASEV2, models.HasTenant, models.HasId):
                            nullable=False)
 
     backend_key = sa.Column(sa.String(36), nullable=False)
+    status = sa.Column(sa.String(16))
     mac_address = sa.Column(sa.BigInteger())
     device_id = sa.Column(sa.String(255), nullable=False)
     device_owner = sa.Column(sa.String(255))
@@ -323,6 +397,11 @@ class Port(BASEV2, models.HasTenant, models.HasId):
                                 backref="ports")
 
 
+sa.Index("idx_quark_ports_tenant_network", Port.__table__.c.tenant_id,
+         Port.__table__.c.network_id)
+sa.Index("idx_quark_ports_device_id", Port.__table__.c.device_id)
+
+
 class MacAddress(BASEV2, models.HasTenant):
     __tablename__ = "quark_mac_addresses"
     address = sa.Column(sa.BigInteger(), primary_key=True)
@@ -335,12 +414,18 @@ class MacAddress(BASEV2, models.HasTenant):
     orm.relationship(Port, backref="mac_address")
 
 
+sa.Index("idx_quark_mac_addresses_reuse", MacAddress.__table__.c.deallocated,
+         MacAddress.__table__.c.deallocated_at)
+
+
 class MacAddressRange(BASEV2, models.HasId):
     __tablename__ = "quark_mac_address_ranges"
     cidr = sa.Column(sa.String(255), nullable=False)
     first_address = sa.Column(sa.BigInteger(), nullable=False)
     last_address = sa.Column(sa.BigInteger(), nullable=False)
     next_auto_assign_mac = sa.Column(sa.BigInteger(), nullable=False)
+    allocated_count = sa.Column(sa.Integer(), nullable=False, default=0,
+                                server_default="0")
     allocated_macs = orm.relationship(MacAddress,
                                       primaryjoin='and_(MacAddressRange.id=='
                                       'MacAddress.mac_address_range_id, '
@@ -348,6 +433,102 @@ class MacAddressRange(BASEV2, models.HasId):
                                       backref="mac_address_range")
 
 
+class MacAddressLease(BASEV2, models.HasId):
+    """A block of a MAC address range reserved by one worker process.
+
+    first_address is the lowest address the owner may not have handed out
+    yet, it only moves forward when the lease is renewed or released.
+    """
+    __tablename__ = "quark_mac_address_leases"
+    mac_address_range_id = sa.Column(
+        sa.String(36),
+        sa.ForeignKey("quark_mac_address_ranges.id", ondelete="CASCADE"),
+        nullable=False)
+    first_address = sa.Column(sa.BigInteger(), nullable=False)
+    last_address = sa.Column(sa.BigInteger(), nullable=False)
+    owner = sa.Column(sa.String(255), nullable=False)
+    expires_at = sa.Column(sa.DateTime(), nullable=False)
+
+
+class CompiledIPPolicy(object):
+    """The excluded addresses of a subnet as sorted (first, last) pairs.
+
+    ip_set is only built for callers that ask for it, and like the rest of
+    a cached entry must be treated as read-only.
+    """
+    def __init__(self, excluded, version):
+        self.intervals = excluded
+        self.version = version
+        self._ip_set = None
+
+    @property
+    def ip_set(self):
+        if self._ip_set is None:
+            self._ip_set = intervals.to_ip_set(self.intervals, self.version)
+        return self._ip_set
+
+    @property
+    def size(self):
+        return intervals.size(self.intervals)
+
+
+class IPPolicyCache(object):
+    """Process-wide cache of compiled IP policies.
+
+    Holds one entry per subnet, keyed by (subnet id, policy id, policy
+    revision, cidr). A stale key simply misses, the invalidate calls only
+    keep dead entries from lingering.
+    """
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key[0])
+        if entry and entry[0] == key:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+    def set(self, key, compiled):
+        self._entries[key[0]] = (key, compiled)
+
+    def invalidate_subnet(self, subnet_id):
+        self._entries.pop(subnet_id, None)
+
+    def invalidate_policy(self, policy_id):
+        for subnet_id, entry in self._entries.items():
+            if entry[0][1] == policy_id:
+                self._entries.pop(subnet_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self._entries), hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=(float(self.hits) / lookups
+                              if lookups else 0.0))
+
+    def dump(self):
+        """Returns the counters in the Prometheus text format."""
+        stats = self.stats()
+        return ("# TYPE quark_ip_policy_cache_size gauge\n"
+                "quark_ip_policy_cache_size %d\n"
+                "# TYPE quark_ip_policy_cache_hits_total counter\n"
+                "quark_ip_policy_cache_hits_total %d\n"
+                "# TYPE quark_ip_policy_cache_misses_total counter\n"
+                "quark_ip_policy_cache_misses_total %d\n" %
+                (stats["size"], stats["hits"], stats["misses"]))
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+IP_POLICY_CACHE = IPPolicyCache()
+
+
 class IPPolicy(BASEV2, models.HasId, models.HasTenant):
     __tablename__ = "quark_ip_policy"
     networks = orm.relationship(
@@ -363,6 +544,7 @@ class IPPolicy(BASEV2, models.HasId, models.HasTenant):
         primaryjoin="IPPolicy.id==IPPolicyRange.ip_policy_id",
         backref="ip_policy")
     name = sa.Column(sa.String(255), nullable=True)
+    revision = sa.Column(sa.Integer(), default=0)
 
     class JSONIPPolicy(object):
         def __init__(self, policy=None):
@@ -382,32 +564,55 @@ class IPPolicy(BASEV2, models.HasId, models.HasTenant):
 
     @staticmethod
     def get_ip_policy_rule_set(subnet):
+        return IPPolicy.get_compiled_ip_policy(subnet).ip_set
+
+    @staticmethod
+    def get_compiled_ip_policy(subnet):
         ip_policy = subnet["ip_policy"] or \
             subnet["network"]["ip_policy"] or \
             dict()
+
+        key = None
+        if subnet.get("id") and (not ip_policy or ip_policy.get("id")):
+            key = (subnet["id"], ip_policy.get("id"),
+                   ip_policy.get("revision"), str(subnet["cidr"]))
+            compiled = IP_POLICY_CACHE.get(key)
+            if compiled:
+                return compiled
+
+        subnet_net = netaddr.IPNetwork(subnet["cidr"])
+        compiled = CompiledIPPolicy(
+            IPPolicy._build_ip_policy_intervals(subnet_net, ip_policy),
+            subnet_net.version)
+        if key:
+            IP_POLICY_CACHE.set(key, compiled)
+        return compiled
+
+    @staticmethod
+    def _build_ip_policy_intervals(subnet_net, ip_policy):
         ip_policy_ranges = ip_policy.get("exclude", []) + \
             IPPolicy.DEFAULT_POLICY.get("exclude", [])
 
-        ip_policy_rules = netaddr.IPSet()
-        subnet_net = netaddr.IPNetwork(subnet["cidr"])
+        excluded = []
 
-        def _policy_set(offset, length):
+        def _policy_range(offset, length):
             start = subnet_net.first + offset
-            end = start + length
-            return netaddr.IPSet(netaddr.IPRange(start, end - 1))
+            excluded.append((start, start + length - 1))
 
         for arange in ip_policy_ranges:
             offset, length = arange["offset"], arange["length"]
             if offset < 0:
                 if offset + length > 0:
-                    ip_policy_rules |= _policy_set(0, offset + length)
+                    _policy_range(0, offset + length)
                 pos_offset = subnet_net.size + offset
                 capped_length = min(length, -offset)
-                ip_policy_rules |= _policy_set(pos_offset, capped_length)
+                _policy_range(pos_offset, capped_length)
             else:
-                ip_policy_rules |= _policy_set(offset, length)
+                _policy_range(offset, length)
 
-        return ip_policy_rules
+        excluded = [(first, last) for first, last in excluded if first <= last]
+        return intervals.clip(intervals.merge(excluded), subnet_net.first,
+                              subnet_net.last)
 
 
 class IPPolicyRange(BASEV2, models.HasId):
@@ -428,3 +633,45 @@ class Network(BASEV2, models.HasTenant, models.HasId):
                              sa.ForeignKey("quark_ip_policy.id"))
     network_plugin = sa.Column(sa.String(36))
     ipam_strategy = sa.Column(sa.String(255))
+
+
+sa.Index("idx_quark_networks_tenant", Network.__table__.c.tenant_id)
+
+
+class TenantCount(BASEV2):
+    """Approximate number of rows a tenant owns in a resource table.
+
+    Only kept up to date while tenant_counts is set, rows removed other
+    than through the API are never taken off.
+    """
+    __tablename__ = "quark_tenant_counts"
+    tenant_id = sa.Column(sa.String(255), primary_key=True)
+    resource = sa.Column(sa.String(255), primary_key=True)
+    count = sa.Column(sa.Integer(), nullable=False, default=0)
+
+
+class BackendOperation(BASEV2, models.HasId):
+    """A network driver call recorded in the transaction that needs it.
+
+    Operations on one resource run one at a time in sequence order, so a
+    port delete never reaches the backend before the create it follows.
+    """
+    __tablename__ = "quark_backend_ops"
+    resource_id = sa.Column(sa.String(36), nullable=False)
+    sequence = sa.Column(sa.Integer(), nullable=False, default=0)
+    network_plugin = sa.Column(sa.String(36), nullable=False)
+    operation = sa.Column(sa.String(64), nullable=False)
+    payload = sa.Column(sa.Text())
+    state = sa.Column(sa.String(16), nullable=False, default="pending",
+                      index=True)
+    attempts = sa.Column(sa.Integer(), nullable=False, default=0)
+    result = sa.Column(sa.Text())
+    last_error = sa.Column(sa.Text())
+    owner = sa.Column(sa.String(255))
+    run_at = sa.Column(sa.DateTime(), default=timeutils.utcnow)
+    updated_at = sa.Column(sa.DateTime(), default=timeutils.utcnow)
+
+
+sa.Index("idx_quark_backend_ops_resource_sequence",
+         BackendOperation.__table__.c.resource_id,
+         BackendOperation.__table__.c.sequence, unique=True)
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #
 
+from neutron.openstack.common import excutils
 from neutron.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -53,6 +54,28 @@ class BaseDriver(object):
                                            port_id))
         return {"uuid": port_id}
 
+    def create_ports(self, context, network_id, ports):
+        """Creates several ports on one network.
+
+        Returns the backend ports, in order. If one of them fails the
+        ports already created are deleted before the error is raised.
+        """
+        created = []
+        try:
+            for port in ports:
+                created.append(self.create_port(context, network_id, **port))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for backend_port in created:
+                    try:
+                        self.delete_port(
+                            context, backend_port["uuid"],
+                            lswitch_uuid=backend_port.get("lswitch"))
+                    except Exception:
+                        LOG.exception("create_ports failed to clean up "
+                                      "port %s" % backend_port["uuid"])
+        return created
+
     def update_port(self, context, port_id, **kwargs):
         LOG.info("update_port %s %s" % (context.tenant_id, port_id))
         return {"uuid": port_id}
@@ -64,6 +87,11 @@ class BaseDriver(object):
         LOG.info("diag_port %s" % network_id)
         return {}
 
+    def diag_backend(self, context):
+        """Returns the health of the driver's connection to its backend."""
+        LOG.info("diag_backend")
+        return {}
+
     def create_security_group(self, context, group_name, **group):
         LOG.info("Creating security profile %s for tenant %s" %
                  (group_name, context.tenant_id))
@@ -0,0 +1,182 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Circuit breaker and adaptive concurrency limit for driver backends
+"""
+
+import collections
+import threading
+import time
+
+from neutron.openstack.common import log as logging
+
+from quark import exceptions
+
+LOG = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """Guards the calls a driver makes to its backend.
+
+    Keeps the latency and failure counts of every operation and lets at
+    most limit calls run at once. The limit grows by one for every limit
+    calls that finish within latency_target seconds, shrinks by a tenth
+    for a slower call and is halved for a failed one, staying between
+    min_limit and max_limit. Once failure_ratio of the last window calls
+    have failed the breaker opens and every call fails fast with
+    BackendUnavailable. After reset_timeout seconds a single call is let
+    through to probe the backend, closing the breaker if it succeeds.
+
+    is_failure decides which exceptions count against the backend, the
+    rest, like the backend refusing a request, count as successes.
+    """
+    def __init__(self, name, is_failure=None, enabled=False, window=20,
+                 failure_ratio=0.5, reset_timeout=30, latency_target=2.0,
+                 min_limit=1, max_limit=32):
+        self.name = name
+        self.is_failure = is_failure or (lambda e: True)
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.configure(enabled, window, failure_ratio, reset_timeout,
+                       latency_target, min_limit, max_limit)
+
+    def configure(self, enabled, window, failure_ratio, reset_timeout,
+                  latency_target, min_limit, max_limit):
+        with self.lock:
+            self.enabled = enabled
+            self.window = window
+            self.failure_ratio = failure_ratio
+            self.reset_timeout = reset_timeout
+            self.latency_target = latency_target
+            self.min_limit = max(min_limit, 1)
+            self.max_limit = max(max_limit, self.min_limit)
+            self.limit = float(self.max_limit)
+            self.outcomes = collections.deque(maxlen=window)
+            self.state = CLOSED
+            self.opened_at = 0
+            self.probing = False
+            self.in_flight = 0
+
+    def _operation(self, operation):
+        if operation not in self.operations:
+            self.operations[operation] = dict(calls=0, failures=0,
+                                              rejected=0, latency_total=0.0,
+                                              latency_max=0.0)
+        return self.operations[operation]
+
+    def _reject(self, operation, reason):
+        self._operation(operation)["rejected"] += 1
+        raise exceptions.BackendUnavailable(backend=self.name,
+                                            reason=reason)
+
+    def _acquire(self, operation):
+        """Takes an in-flight slot, returning whether the call is a probe.
+        """
+        with self.lock:
+            probe = False
+            if self.state == OPEN:
+                if time.time() < self.opened_at + self.reset_timeout:
+                    self._reject(operation, "circuit open")
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    self._reject(operation, "circuit half open")
+                self.probing = probe = True
+            elif self.in_flight >= int(self.limit):
+                self._reject(operation, "%d calls in flight" %
+                             self.in_flight)
+            self.in_flight += 1
+            return probe
+
+    def _release(self, operation, probe, elapsed, failed):
+        with self.lock:
+            self.in_flight -= 1
+            stats = self._operation(operation)
+            stats["calls"] += 1
+            stats["failures"] += failed and 1 or 0
+            stats["latency_total"] += elapsed
+            stats["latency_max"] = max(stats["latency_max"], elapsed)
+
+            if failed:
+                self.limit = max(self.min_limit, self.limit / 2)
+            elif elapsed > self.latency_target:
+                self.limit = max(self.min_limit, self.limit * 0.9)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.outcomes.append(failed)
+            if probe:
+                self.probing = False
+                if failed:
+                    self._open(operation)
+                else:
+                    self._close()
+            elif (self.state == CLOSED and failed and
+                    len(self.outcomes) == self.window and
+                    sum(self.outcomes) >= self.failure_ratio * self.window):
+                self._open(operation)
+
+    def _open(self, operation):
+        LOG.warning("Opening the %s circuit breaker after %s failed, "
+                    "retrying in %d seconds" %
+                    (self.name, operation, self.reset_timeout))
+        self.state = OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
+
+    def _close(self):
+        LOG.info("Closing the %s circuit breaker" % self.name)
+        self.state = CLOSED
+        self.outcomes.clear()
+
+    def call(self, operation, f, *args, **kwargs):
+        """Calls f, accounting it to operation."""
+        if not self.enabled:
+            return f(*args, **kwargs)
+        probe = self._acquire(operation)
+        started = time.time()
+        failed = False
+        try:
+            return f(*args, **kwargs)
+        except Exception as e:
+            failed = self.is_failure(e)
+            raise
+        finally:
+            self._release(operation, probe, time.time() - started, failed)
+
+    def stats(self):
+        with self.lock:
+            operations = {}
+            for operation, stats in self.operations.items():
+                calls = stats["calls"]
+                operations[operation] = dict(
+                    calls=calls, failures=stats["failures"],
+                    rejected=stats["rejected"],
+                    error_rate=(float(stats["failures"]) / calls
+                                if calls else 0.0),
+                    latency_avg=(stats["latency_total"] / calls
+                                 if calls else 0.0),
+                    latency_max=stats["latency_max"])
+            return dict(enabled=self.enabled, state=self.state,
+                        in_flight=self.in_flight, limit=int(self.limit),
+                        retry_at=(self.opened_at + self.reset_timeout
+                                  if self.state == OPEN else None),
+                        operations=operations)
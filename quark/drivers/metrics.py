@@ -0,0 +1,142 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Call counts, error counts and latency histograms for driver operations
+
+Every driver in the DriverRegistry is wrapped so each call of an
+operation below is recorded per driver and operation. The numbers are
+kept per process, each API worker reports its own.
+"""
+
+import bisect
+import threading
+import time
+
+OPERATIONS = ("create_network", "delete_network", "diag_network",
+              "create_port", "create_ports", "update_port", "delete_port",
+              "diag_port", "diag_backend", "create_security_group",
+              "delete_security_group", "update_security_group",
+              "create_security_group_rule", "delete_security_group_rule")
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0)
+
+
+class DriverMetrics(object):
+    """Counters and latency histograms keyed by driver and operation."""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, driver, operation, elapsed, failed=False):
+        key = (driver, operation)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = dict(
+                    calls=0, errors=0, latency_sum=0.0,
+                    counts=[0] * (len(self.buckets) + 1))
+            series["calls"] += 1
+            series["errors"] += failed and 1 or 0
+            series["latency_sum"] += elapsed
+            series["counts"][bisect.bisect_left(self.buckets, elapsed)] += 1
+
+    def stats(self, driver=None):
+        """Returns the series of one driver, or of all of them.
+
+        Bucket counts are cumulative, keyed by their upper bound.
+        """
+        with self.lock:
+            series = [(key, dict(value, counts=list(value["counts"])))
+                      for key, value in self.series.items()
+                      if driver in (None, key[0])]
+        stats = {}
+        for (name, operation), value in series:
+            total, buckets = 0, {}
+            for bound, count in zip(self.buckets + ("+Inf",),
+                                    value["counts"]):
+                total += count
+                buckets[str(bound)] = total
+            stats.setdefault(name, {})[operation] = dict(
+                calls=value["calls"], errors=value["errors"],
+                latency_sum=value["latency_sum"], buckets=buckets)
+        return stats
+
+    def dump(self, driver=None):
+        """Returns the series in the Prometheus text format."""
+        stats = self.stats(driver)
+        series = [(name, operation, value)
+                  for name, operations in sorted(stats.items())
+                  for operation, value in sorted(operations.items())]
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        lines = ["# TYPE quark_driver_calls_total counter"]
+        lines.extend('quark_driver_calls_total{%s} %d' %
+                     (_labels(name, operation), value["calls"])
+                     for name, operation, value in series)
+        lines.append("# TYPE quark_driver_errors_total counter")
+        lines.extend('quark_driver_errors_total{%s} %d' %
+                     (_labels(name, operation), value["errors"])
+                     for name, operation, value in series)
+        lines.append("# TYPE quark_driver_latency_seconds histogram")
+        for name, operation, value in series:
+            labels = _labels(name, operation)
+            for bound in bounds:
+                lines.append('quark_driver_latency_seconds_bucket{%s,le="%s"}'
+                             ' %d' % (labels, bound, value["buckets"][bound]))
+            lines.append("quark_driver_latency_seconds_sum{%s} %f" %
+                         (labels, value["latency_sum"]))
+            lines.append("quark_driver_latency_seconds_count{%s} %d" %
+                         (labels, value["calls"]))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+
+def _labels(driver, operation):
+    return 'driver="%s",operation="%s"' % (driver, operation)
+
+
+METRICS = DriverMetrics()
+
+
+class InstrumentedDriver(object):
+    """Proxies a driver, recording the calls of its OPERATIONS."""
+    def __init__(self, name, driver, metrics=METRICS):
+        self._name = name
+        self._driver = driver
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        # NOTE(jkoelker) Look the method up on every access so patching the
+        #                driver class still takes effect
+        method = getattr(self._driver, name)
+        if name not in OPERATIONS:
+            return method
+
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            failed = True
+            try:
+                result = method(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self._metrics.observe(self._name, name,
+                                      time.time() - started, failed)
+        return wrapper
@@ -17,14 +17,21 @@
 NVP client driver for Quark
 """
 
+import errno
+import socket
+import threading
+import time
+
 from oslo.config import cfg
 
-import aiclib
 from neutron.extensions import securitygroup as sg_ext
+from neutron.openstack.common import importutils
 from neutron.openstack.common import log as logging
 
 from quark.drivers import base
+from quark.drivers import breaker
 from quark import exceptions
+from quark import utils
 
 
 LOG = logging.getLogger(__name__)
@@ -46,6 +53,75 @@ nvp_opts = [
     cfg.IntOpt('max_rules_per_port',
                default=30,
                help=_('Maximum rules per NVP lport across all groups')),
+    cfg.StrOpt('connection_class',
+               default='aiclib.nvp.Connection',
+               help=_('aiclib connection class used to talk to the NVP '
+                      'controllers')),
+    cfg.IntOpt('controller_retry_interval',
+               default=5,
+               help=_('Seconds to wait before probing a failed NVP '
+                      'controller again, doubled for every further '
+                      'consecutive failure')),
+    cfg.IntOpt('controller_max_retry_interval',
+               default=300,
+               help=_('Upper bound in seconds on the wait before probing '
+                      'a failed NVP controller again')),
+    cfg.IntOpt('lswitch_cache_ttl',
+               default=0,
+               help=_('Seconds to cache the lswitches of a network and the '
+                      'lswitch of a port for. 0 disables the cache')),
+    cfg.IntOpt('lswitch_cache_size',
+               default=10000,
+               help=_('Maximum number of networks and of ports to cache '
+                      'lswitches for')),
+    cfg.IntOpt('security_profile_cache_ttl',
+               default=0,
+               help=_('Seconds to cache the NVP security profile uuid and '
+                      'rule count of a security group for. 0 disables the '
+                      'cache')),
+    cfg.IntOpt('security_profile_cache_size',
+               default=10000,
+               help=_('Maximum number of security groups to cache NVP '
+                      'security profiles for')),
+    cfg.IntOpt('lswitch_provision_interval',
+               default=0,
+               help=_('Seconds between checks for networks running out of '
+                      'lswitch ports, 0 disables creating their next '
+                      'lswitch ahead of time. OptimizedNVPDriver only')),
+    cfg.FloatOpt('lswitch_provision_high_water',
+                 default=0.8,
+                 help=_('Fraction of an lswitch worth of ports a network may '
+                        'fill before its next lswitch is created, e.g. with '
+                        '0.8 the next lswitch is created once fewer than '
+                        'a fifth of max_ports_per_switch are free')),
+    cfg.BoolOpt('breaker_enabled',
+                default=False,
+                help=_('Limit the requests in flight to NVP and fail them '
+                       'fast while NVP keeps failing')),
+    cfg.IntOpt('breaker_window',
+               default=20,
+               help=_('Number of recent NVP requests the failure ratio is '
+                      'taken over')),
+    cfg.FloatOpt('breaker_failure_ratio',
+                 default=0.5,
+                 help=_('Ratio of failed NVP requests that opens the '
+                        'circuit breaker')),
+    cfg.IntOpt('breaker_reset_timeout',
+               default=30,
+               help=_('Seconds the circuit breaker stays open before a '
+                      'request is let through to probe NVP')),
+    cfg.FloatOpt('breaker_latency_target',
+                 default=2.0,
+                 help=_('Seconds an NVP request may take before the limit '
+                        'of requests in flight is lowered')),
+    cfg.IntOpt('breaker_min_in_flight',
+               default=1,
+               help=_('Lower bound of the adaptive limit of requests in '
+                      'flight to NVP')),
+    cfg.IntOpt('breaker_max_in_flight',
+               default=32,
+               help=_('Upper bound of the adaptive limit of requests in '
+                      'flight to NVP')),
 ]
 
 physical_net_type_map = {
@@ -68,10 +144,64 @@ def _tag_unroll(tags):
     return dict((t['scope'], t['tag']) for t in tags)
 
 
+def _controller_failed(e):
+    """Tells failures of the controller apart from NVP rejecting a request.
+    """
+    if isinstance(e, (socket.error, IOError)):
+        return True
+    if getattr(e, "code", None) in (408, 502, 503, 504):
+        return True
+    return type(e).__module__.startswith("urllib3")
+
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+
+def _request_not_sent(e):
+    """Tells whether a failed request never reached the controller."""
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, socket.error):
+        return e.errno in (errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                           errno.ENETUNREACH)
+    if type(e).__name__ in ("NewConnectionError", "ConnectTimeoutError"):
+        return True
+    reason = getattr(e, "reason", None)
+    if isinstance(reason, Exception) and reason is not e:
+        return _request_not_sent(reason)
+    return False
+
+
+def _retryable(e, method):
+    """Tells whether a failed request can be sent to another controller.
+
+    A POST whose response was lost may already have been applied by NVP, so
+    it is only resent when the request never left.
+    """
+    if not _controller_failed(e):
+        return False
+    if method.upper() in IDEMPOTENT_METHODS:
+        return True
+    return _request_not_sent(e)
+
+
+def _operation(method, resource):
+    """Names the kind of an NVP request, e.g. POST_lport."""
+    parts = [p for p in resource.split("/") if p][1:]
+    if parts[2:3] == ["lport"]:
+        return "%s_lport" % method
+    return "%s_%s" % (method, parts and parts[0] or "")
+
+
 class NVPDriver(base.BaseDriver):
     def __init__(self):
         self.nvp_connections = []
         self.conn_index = 0
+        self.conn_lock = threading.Lock()
+        self.lswitch_cache = utils.TTLCache()
+        self.lport_cache = utils.TTLCache()
+        self.security_profile_cache = utils.TTLCache()
+        self.breaker = breaker.CircuitBreaker("NVP", _controller_failed)
         self.limits = {'max_ports_per_switch': 0,
                        'max_rules_per_group': 0,
                        'max_rules_per_port': 0}
@@ -91,6 +221,19 @@ class NVPDriver(base.BaseDriver):
             'max_ports_per_switch': CONF.NVP.max_ports_per_switch,
             'max_rules_per_group': CONF.NVP.max_rules_per_group,
             'max_rules_per_port': CONF.NVP.max_rules_per_port})
+        for cache in (self.lswitch_cache, self.lport_cache):
+            cache.ttl = CONF.NVP.lswitch_cache_ttl
+            cache.maxsize = CONF.NVP.lswitch_cache_size
+        self.security_profile_cache.ttl = CONF.NVP.security_profile_cache_ttl
+        self.security_profile_cache.maxsize = \
+            CONF.NVP.security_profile_cache_size
+        self.breaker.configure(CONF.NVP.breaker_enabled,
+                               CONF.NVP.breaker_window,
+                               CONF.NVP.breaker_failure_ratio,
+                               CONF.NVP.breaker_reset_timeout,
+                               CONF.NVP.breaker_latency_target,
+                               CONF.NVP.breaker_min_in_flight,
+                               CONF.NVP.breaker_max_in_flight)
         LOG.info("Loading NVP settings " + str(connections))
         for conn in connections:
             (ip, port, user, pw, req_timeout,
@@ -106,17 +249,150 @@ class NVPDriver(base.BaseDriver):
                                         redirects=redirects,
                                         default_tz=default_tz))
 
+    def _controller_available(self, conn, now):
+        return conn.get("retry_at", 0) <= now
+
+    def _choose_controller(self, exclude=None):
+        """Picks the available controller with the fewest requests in flight.
+
+        Ties go round robin. When every controller is backing off, the one
+        due to be probed soonest is used.
+        """
+        with self.conn_lock:
+            now = time.time()
+            count = len(self.nvp_connections)
+            candidates = [self.nvp_connections[(self.conn_index + i) % count]
+                          for i in xrange(count)]
+            candidates = [c for c in candidates if c is not exclude] or \
+                candidates
+            available = [c for c in candidates
+                         if self._controller_available(c, now)]
+            if available:
+                conn = min(available, key=lambda c: c.get("in_flight", 0))
+            else:
+                conn = min(candidates, key=lambda c: c["retry_at"])
+            self.conn_index = (self.conn_index + 1) % count
+            return conn
+
+    def _controller_request(self, conn, entity, method, resource):
+        with self.conn_lock:
+            conn["in_flight"] = conn.get("in_flight", 0) + 1
+        started = time.time()
+        try:
+            result = conn["action"](entity, method, resource)
+        except Exception as e:
+            if _controller_failed(e):
+                self._controller_down(conn)
+            raise
+        else:
+            self._controller_up(conn)
+            return result
+        finally:
+            elapsed = time.time() - started
+            with self.conn_lock:
+                conn["in_flight"] -= 1
+                conn["requests"] = conn.get("requests", 0) + 1
+                conn["latency_total"] = (conn.get("latency_total", 0.0) +
+                                         elapsed)
+                conn["latency_max"] = max(conn.get("latency_max", 0.0),
+                                          elapsed)
+
+    def _controller_up(self, conn):
+        if conn.get("failures"):
+            LOG.info("NVP controller %s is back" % conn["ip_address"])
+        conn["failures"] = 0
+        conn["retry_at"] = 0
+
+    def _controller_down(self, conn):
+        with self.conn_lock:
+            conn["failures"] = conn.get("failures", 0) + 1
+            conn["failures_total"] = conn.get("failures_total", 0) + 1
+            interval = min(CONF.NVP.controller_max_retry_interval,
+                           CONF.NVP.controller_retry_interval *
+                           2 ** (conn["failures"] - 1))
+            conn["retry_at"] = time.time() + interval
+        LOG.warning("NVP controller %s failed, retrying it in %d seconds" %
+                    (conn["ip_address"], interval))
+
+    def _request(self, conn, entity, method, resource):
+        """Sends a request, failing over to other controllers.
+
+        A request is retried up to the controller's retries count, for at
+        most its req_timeout seconds, as long as the failure was the
+        controller's and not NVP refusing the request. Non idempotent
+        requests are only retried when they never reached the controller.
+        """
+        retries = int(conn.get("retries") or 0)
+        req_timeout = int(conn.get("req_timeout") or 0)
+        started = time.time()
+        attempt = 0
+        while True:
+            try:
+                return self._controller_request(conn, entity, method,
+                                                resource)
+            except Exception as e:
+                attempt += 1
+                if (not _retryable(e, method) or attempt > retries or
+                        len(self.nvp_connections) < 2 or
+                        (req_timeout and
+                         time.time() - started >= req_timeout)):
+                    raise
+                failed = conn
+                conn = self._choose_controller(exclude=failed)
+                self._connect(conn)
+                LOG.warning("Retrying %s %s on NVP controller %s" %
+                            (method, resource, conn["ip_address"]))
+
+    def _connect(self, conn):
+        if "connection" in conn:
+            return conn["connection"]
+        scheme = conn["port"] == "443" and "https" or "http"
+        uri = "%s://%s:%s" % (scheme, conn["ip_address"], conn["port"])
+        user = conn['username']
+        passwd = conn['password']
+        kwargs = {}
+        if conn.get("http_timeout"):
+            kwargs["timeout"] = int(conn["http_timeout"])
+        if conn.get("redirects"):
+            # NOTE(jkoelker) aiclib follows redirects as part of its own
+            #                retry loop, failover is retried in _request
+            kwargs["retries"] = int(conn["redirects"])
+        connection_class = importutils.import_class(
+            CONF.NVP.connection_class)
+        connection = connection_class(uri, username=user, password=passwd,
+                                      **kwargs)
+        conn["action"] = connection._action
+
+        def _action(entity, method, resource):
+            return self.breaker.call(_operation(method, resource),
+                                     self._request, conn, entity, method,
+                                     resource)
+        connection._action = _action
+        conn["connection"] = connection
+        return connection
+
     def get_connection(self):
-        conn = self.nvp_connections[self.conn_index]
-        if "connection" not in conn:
-            scheme = conn["port"] == "443" and "https" or "http"
-            uri = "%s://%s:%s" % (scheme, conn["ip_address"], conn["port"])
-            user = conn['username']
-            passwd = conn['password']
-            conn["connection"] = aiclib.nvp.Connection(uri,
-                                                       username=user,
-                                                       password=passwd)
-        return conn["connection"]
+        return self._connect(self._choose_controller())
+
+    def controller_stats(self):
+        stats = []
+        for conn in self.nvp_connections:
+            requests = conn.get("requests", 0)
+            stats.append(dict(
+                ip_address=conn.get("ip_address"),
+                port=conn.get("port"),
+                in_flight=conn.get("in_flight", 0),
+                requests=requests,
+                failures=conn.get("failures_total", 0),
+                healthy=self._controller_available(conn, time.time()),
+                latency_avg=(conn.get("latency_total", 0.0) / requests
+                             if requests else 0.0),
+                latency_max=conn.get("latency_max", 0.0)))
+        return stats
+
+    def diag_backend(self, context):
+        return {'breaker': self.breaker.stats(),
+                'controllers': self.controller_stats()}
 
     def create_network(self, context, network_name, tags=None,
                        network_id=None, **kwargs):
@@ -129,6 +405,8 @@ class NVPDriver(base.BaseDriver):
         for switch in lswitches["results"]:
             LOG.debug("Deleting lswitch %s" % switch["uuid"])
             connection.lswitch(switch["uuid"]).delete()
+            self._lswitch_invalidate(switch["uuid"])
+        self._network_invalidate(network_id)
 
     def _collect_lswitch_info(self, lswitch, get_status):
         info = {
@@ -173,6 +451,8 @@ class NVPDriver(base.BaseDriver):
         port.tags(tags)
         res = port.create()
         res["lswitch"] = lswitch
+        self.lport_cache.set(res["uuid"], lswitch)
+        self._lswitch_port_added(context, network_id, lswitch)
         return res
 
     def update_port(self, context, port_id, status=True,
@@ -196,6 +476,8 @@ class NVPDriver(base.BaseDriver):
             lswitch_uuid = self._lswitch_from_port(context, port_id)
         LOG.debug("Deleting port %s from lswitch %s" % (port_id, lswitch_uuid))
         connection.lswitch_port(lswitch_uuid, port_id).delete()
+        self.lport_cache.pop(port_id)
+        self._lswitch_invalidate(lswitch_uuid)
 
     def _collect_lport_info(self, lport, get_status):
         info = {
@@ -295,13 +577,21 @@ class NVPDriver(base.BaseDriver):
                 dict(tag=tenant_id, scope="os_tid")]
         LOG.debug("Creating security profile %s" % group_name)
         profile.tags(tags)
-        return profile.create()
+        res = profile.create()
+        if self.security_profile_cache.ttl:
+            self._security_profile_cached(
+                context, group_id,
+                dict(uuid=res["uuid"],
+                     logical_port_ingress_rules=ingress_rules,
+                     logical_port_egress_rules=egress_rules))
+        return res
 
     def delete_security_group(self, context, group_id):
         guuid = self._get_security_group_id(context, group_id)
         connection = self.get_connection()
         LOG.debug("Deleting security profile %s" % group_id)
         connection.securityprofile(guuid).delete()
+        self.security_profile_cache.pop((context.tenant_id, group_id))
 
     def update_security_group(self, context, group_id, **group):
         query = self._get_security_group(context, group_id)
@@ -323,7 +613,9 @@ class NVPDriver(base.BaseDriver):
             profile.port_ingress_rules(ingress_rules)
         if group.get('port_egress_rules', None) is not None:
             profile.port_egress_rules(egress_rules)
-        return profile.update()
+        res = profile.update()
+        self.security_profile_cache.pop((context.tenant_id, group_id))
+        return res
 
     def _update_security_group_rules(self, context, group_id, rule, operation,
                                      checks):
@@ -357,8 +649,33 @@ class NVPDriver(base.BaseDriver):
              sg_ext.SecurityGroupRuleNotFound(id="with group_id %s" %
                                               group_id)})
 
+    def _network_invalidate(self, network_id):
+        self.lswitch_cache.invalidate(lambda key, _: key[1] == network_id)
+
+    def _lswitch_invalidate(self, lswitch_uuid):
+        self.lswitch_cache.invalidate(
+            lambda _, switches: any(res["uuid"] == lswitch_uuid
+                                    for res in switches["results"]))
+        self.lport_cache.invalidate(lambda _, uuid: uuid == lswitch_uuid)
+
+    def _lswitches_cached(self, context, network_id):
+        key = (context.tenant_id, network_id)
+        switches = self.lswitch_cache.get(key)
+        if switches is None:
+            switches = self._lswitch_status_query(context, network_id)
+            if switches is not None:
+                self.lswitch_cache.set(key, switches)
+        return switches
+
+    def _lswitch_port_added(self, context, network_id, lswitch):
+        """Counts a new port against the cached lswitches of its network."""
+        switches = self.lswitch_cache.get((context.tenant_id, network_id))
+        for res in (switches or {}).get("results", []):
+            if res["uuid"] == lswitch:
+                res["_relations"]["LogicalSwitchStatus"]["lport_count"] += 1
+
     def _create_or_choose_lswitch(self, context, network_id):
-        switches = self._lswitch_status_query(context, network_id)
+        switches = self._lswitches_cached(context, network_id)
         switch = self._lswitch_select_open(context, network_id=network_id,
                                            switches=switches)
         if switch:
@@ -396,6 +713,7 @@ class NVPDriver(base.BaseDriver):
         connection = self.get_connection()
         LOG.debug("Deleting lswitch %s" % lswitch_uuid)
         connection.lswitch(lswitch_uuid).delete()
+        self._lswitch_invalidate(lswitch_uuid)
 
     def _config_provider_attrs(self, connection, switch, phys_net,
                                net_type, segment_id):
@@ -457,6 +775,8 @@ class NVPDriver(base.BaseDriver):
         self._config_provider_attrs(connection, switch, phys_net, phys_type,
                                     segment_id)
         res = switch.create()
+        if network_id:
+            self._network_invalidate(network_id)
         return res["uuid"]
 
     def _lswitches_for_network(self, context, network_id):
@@ -467,6 +787,9 @@ class NVPDriver(base.BaseDriver):
         return query
 
     def _lswitch_from_port(self, context, port_id):
+        lswitch = self.lport_cache.get(port_id)
+        if lswitch:
+            return lswitch
         connection = self.get_connection()
         query = connection.lswitch_port("*").query()
         query.relations("LogicalSwitchConfig")
@@ -476,7 +799,9 @@ class NVPDriver(base.BaseDriver):
             raise Exception("Could not identify lswitch for port %s" % port_id)
         if port['result_count'] < 1:
             raise Exception("No lswitch found for port %s" % port_id)
-        return port['results'][0]["_relations"]["LogicalSwitchConfig"]["uuid"]
+        lswitch = port['results'][0]["_relations"]["LogicalSwitchConfig"]
+        self.lport_cache.set(port_id, lswitch["uuid"])
+        return lswitch["uuid"]
 
     def _get_security_group(self, context, group_id):
         connection = self.get_connection()
@@ -519,9 +844,14 @@ class NVPDriver(base.BaseDriver):
         ports = connection.lswitch_port("*").query().security_profile_uuid(
             '=', self._get_security_group_id(
                 context, group_id)).results().get('results', [])
-        groups = (port.get('security_profiles', []) for port in ports)
+        groups = [port.get('security_profiles', []) for port in ports]
+        # NOTE(jkoelker) Ports using a group tend to share the rest of
+        #                their groups too, read each profile only once.
+        profiles = dict((gp, connection.securityprofile(gp).read())
+                        for gp in set(gp for group in groups
+                                      for gp in group))
         return max([self._check_rule_count_for_groups(
-            context, (connection.securityprofile(gp).read() for gp in group))
+            context, (profiles[gp] for gp in group))
             for group in groups] or [0])
 
     def _check_rule_count_for_groups(self, context, groups):
@@ -529,12 +859,64 @@ class NVPDriver(base.BaseDriver):
                    len(group['logical_port_egress_rules'])
                    for group in groups)
 
+    def _security_profile_cached(self, context, group_id, group):
+        profile = dict(uuid=group['uuid'],
+                       rule_count=self._check_rule_count_for_groups(
+                           context, [group]))
+        self.security_profile_cache.set((context.tenant_id, group_id),
+                                        profile)
+        return profile
+
+    def _get_security_groups(self, context, group_ids):
+        """Fetches several security groups of a tenant in one query."""
+        if len(group_ids) == 1:
+            return {group_ids[0]: self._get_security_group(context,
+                                                           group_ids[0])}
+        connection = self.get_connection()
+        query = connection.securityprofile().query()
+        query.tagscopes(['os_tid'])
+        query.tags([context.tenant_id])
+        groups = {}
+        page = query.results()
+        while page:
+            for group in page['results']:
+                group_id = _tag_unroll(group['tags']).get('neutron_group_id')
+                if group_id in group_ids:
+                    groups[group_id] = group
+            # NOTE(jkoelker) A tenant can own more profiles than fit in a
+            #                page, keep following the cursor until every
+            #                requested group has turned up.
+            if len(groups) == len(set(group_ids)):
+                break
+            page = query.next()
+        for group_id in group_ids:
+            if group_id not in groups:
+                raise sg_ext.SecurityGroupNotFound(id=group_id)
+        return groups
+
+    def _security_profiles(self, context, group_ids):
+        """Resolves security groups to their NVP profile uuid and rule count.
+        """
+        profiles = {}
+        missing = []
+        for group_id in group_ids:
+            profile = self.security_profile_cache.get((context.tenant_id,
+                                                       group_id))
+            if profile is not None:
+                profiles[group_id] = profile
+            elif group_id not in missing:
+                missing.append(group_id)
+        if missing:
+            groups = self._get_security_groups(context, missing)
+            for group_id, group in groups.items():
+                profiles[group_id] = self._security_profile_cached(
+                    context, group_id, group)
+        return profiles
+
     def _get_security_groups_for_port(self, context, groups):
-        if (self._check_rule_count_for_groups(
-                context,
-                (self._get_security_group(context, g) for g in groups))
-                > self.limits['max_rules_per_port']):
+        profiles = self._security_profiles(context, groups)
+        if (sum(profiles[g]['rule_count'] for g in groups) >
+                self.limits['max_rules_per_port']):
             raise exceptions.DriverLimitReached(limit="rules per port")
 
-        return [self._get_security_group(context, group)['uuid']
-                for group in groups]
+        return [profiles[group]['uuid'] for group in groups]
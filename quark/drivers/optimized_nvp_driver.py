@@ -17,7 +17,11 @@
 Optimized NVP client for Quark
 """
 
+import eventlet
+from neutron import context as neutron_context
+from neutron.extensions import securitygroup as sg_ext
 from neutron.openstack.common import log as logging
+from oslo.config import cfg
 from quark.db import models
 from quark.drivers.nvp_driver import NVPDriver
 import sqlalchemy as sa
@@ -25,8 +29,128 @@ from sqlalchemy import orm
 
 LOG = logging.getLogger(__name__)
 
+CONF = cfg.CONF
+
+
+class LSwitchProvisioner(object):
+    """Creates the next lswitch of networks running out of free ports.
+
+    Once the free ports across a network's lswitches drop below
+    1 - lswitch_provision_high_water of max_ports_per_switch, a new lswitch
+    with the transport zone, connector and segment of the network's first
+    one is created, so create_port finds an open lswitch instead of
+    creating one itself.
+    """
+    def __init__(self, driver):
+        self.driver = driver
+        self._started = False
+        self.provisioned = 0
+        self.failed = 0
+
+    def start(self):
+        if self._started:
+            return
+        eventlet.spawn_n(self._run)
+        self._started = True
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once(neutron_context.get_admin_context())
+            except Exception:
+                LOG.exception("Failed to provision lswitches")
+            eventlet.sleep(CONF.NVP.lswitch_provision_interval)
+
+    def networks_near_full(self, context):
+        """Returns the (network_id, tenant_id) of networks needing an
+        lswitch.
+        """
+        max_ports = self.driver.limits['max_ports_per_switch']
+        if not max_ports:
+            return []
+        return context.session.query(LSwitch.network_id,
+                                     models.Network.tenant_id).\
+            filter(LSwitch.network_id == models.Network.id).\
+            group_by(LSwitch.network_id, models.Network.tenant_id).\
+            having(self._free_ports(max_ports) < self._low_water(max_ports)).\
+            all()
+
+    def _free_ports(self, max_ports):
+        return sa.func.sum(sa.case([(LSwitch.port_count < max_ports,
+                                     max_ports - LSwitch.port_count)],
+                                   else_=0))
+
+    def _low_water(self, max_ports):
+        return max_ports * (1 - CONF.NVP.lswitch_provision_high_water)
+
+    def _claim_network(self, context, network_id):
+        """Locks the network row and checks it still needs an lswitch."""
+        max_ports = self.driver.limits['max_ports_per_switch']
+        network = context.session.query(models.Network.id).\
+            filter(models.Network.id == network_id).\
+            with_lockmode("update").\
+            first()
+        if not network:
+            return False
+        free = context.session.query(self._free_ports(max_ports)).\
+            filter(LSwitch.network_id == network_id).\
+            scalar()
+        return free is not None and free < self._low_water(max_ports)
+
+    def run_once(self, context):
+        """Creates one lswitch for each network running out of ports.
+
+        Returns the number of lswitches created.
+        """
+        created = 0
+        # NOTE(jkoelker) Every worker runs a provisioner. The network row
+        #                is locked and the shortfall checked again before
+        #                creating, so a worker that lost the race finds the
+        #                lswitch the winner committed and skips it.
+        #                create_port never locks the network row, so it is
+        #                not stalled by the NVP call.
+        for network_id, tenant_id in self.networks_near_full(context):
+            net_context = neutron_context.Context(None, tenant_id,
+                                                  is_admin=True)
+            try:
+                with net_context.session.begin():
+                    if not self._claim_network(net_context, network_id):
+                        continue
+                    details = self.driver._get_network_details(
+                        net_context, network_id, None)
+                    nvp_id = self.driver._lswitch_create(
+                        net_context, network_id=network_id, **details)
+            except Exception:
+                LOG.exception("Failed to provision an lswitch for network "
+                              "%s" % network_id)
+                self.failed += 1
+                continue
+            LOG.info("Provisioned lswitch %s for network %s" %
+                     (nvp_id, network_id))
+            self.provisioned += 1
+            created += 1
+        return created
+
+    def stats(self):
+        return dict(running=self._started, provisioned=self.provisioned,
+                    failed=self.failed)
+
 
 class OptimizedNVPDriver(NVPDriver):
+    def __init__(self):
+        self.provisioner = LSwitchProvisioner(self)
+        super(OptimizedNVPDriver, self).__init__()
+
+    def load_config(self):
+        super(OptimizedNVPDriver, self).load_config()
+        if CONF.NVP.lswitch_provision_interval:
+            self.provisioner.start()
+
+    def diag_backend(self, context):
+        diag = super(OptimizedNVPDriver, self).diag_backend(context)
+        diag['provisioner'] = self.provisioner.stats()
+        return diag
+
     def delete_network(self, context, network_id):
         lswitches = self._lswitches_for_network(context, network_id)
         for switch in lswitches:
@@ -50,6 +174,7 @@ class OptimizedNVPDriver(NVPDriver):
 
         new_port = LSwitchPort(port_id=nvp_port["uuid"],
                                switch_id=switch.id)
+        self._lport_set_profiles(context, new_port, security_groups)
         context.session.add(new_port)
         switch.port_count = switch.port_count + 1
         return nvp_port
@@ -62,6 +187,8 @@ class OptimizedNVPDriver(NVPDriver):
                         allowed_pairs=allowed_pairs)
         port = self._lport_select_by_id(context, port_id)
         port.update(nvp_port)
+        if security_groups:
+            self._lport_set_profiles(context, port, security_groups)
 
     def delete_port(self, context, port_id, lswitch_uuid=None):
         port = self._lport_select_by_id(context, port_id)
@@ -77,7 +204,10 @@ class OptimizedNVPDriver(NVPDriver):
         nvp_group = super(OptimizedNVPDriver, self).create_security_group(
             context, group_name, **group)
         group_id = group.get('group_id')
-        profile = SecurityProfile(id=group_id, nvp_id=nvp_group['uuid'])
+        rule_count = (len(group.get('port_ingress_rules', [])) +
+                      len(group.get('port_egress_rules', [])))
+        profile = SecurityProfile(id=group_id, nvp_id=nvp_group['uuid'],
+                                  rule_count=rule_count)
         context.session.add(profile)
 
     def delete_security_group(self, context, group_id):
@@ -86,6 +216,41 @@ class OptimizedNVPDriver(NVPDriver):
         group = self._query_security_group(context, group_id)
         context.session.delete(group)
 
+    def create_security_group_rule(self, context, group_id, rule):
+        res = super(OptimizedNVPDriver, self).create_security_group_rule(
+            context, group_id, rule)
+        self._profile_rule_count_changed(context, group_id, 1)
+        return res
+
+    def delete_security_group_rule(self, context, group_id, rule):
+        res = super(OptimizedNVPDriver, self).delete_security_group_rule(
+            context, group_id, rule)
+        self._profile_rule_count_changed(context, group_id, -1)
+        return res
+
+    def _lport_set_profiles(self, context, port, group_ids):
+        profiles = []
+        if group_ids:
+            profiles = context.session.query(SecurityProfile).\
+                filter(SecurityProfile.id.in_(group_ids)).\
+                all()
+        port.security_profiles = profiles
+        port.rule_count = sum(profile.rule_count or 0
+                              for profile in profiles)
+
+    def _profile_rule_count_changed(self, context, group_id, delta):
+        """Applies a rule count change to a profile and its ports."""
+        context.session.query(SecurityProfile).\
+            filter(SecurityProfile.id == group_id).\
+            update({"rule_count": SecurityProfile.rule_count + delta},
+                   synchronize_session=False)
+        port_ids = sa.select([lport_profile_association_table.c.lport_id]).\
+            where(lport_profile_association_table.c.profile_id == group_id)
+        context.session.query(LSwitchPort).\
+            filter(LSwitchPort.id.in_(port_ids)).\
+            update({"rule_count": LSwitchPort.rule_count + delta},
+                   synchronize_session=False)
+
     def _lport_select_by_id(self, context, port_id):
         query = context.session.query(LSwitchPort)
         query = query.filter(LSwitchPort.port_id == port_id)
@@ -105,7 +270,7 @@ class OptimizedNVPDriver(NVPDriver):
 
     def _lswitch_select_first(self, context, network_id):
         query = context.session.query(LSwitch)
-        query.filter(LSwitch.network_id == network_id)
+        query = query.filter(LSwitch.network_id == network_id)
         return query.first()
 
     def _lswitch_select_free(self, context, network_id):
@@ -200,14 +365,63 @@ class OptimizedNVPDriver(NVPDriver):
                 'logical_port_ingress_rules': rulelist['ingress'],
                 'logical_port_egress_rules': rulelist['egress']}
 
+    def _security_profiles(self, context, group_ids):
+        profiles = {}
+        if group_ids:
+            for profile in context.session.query(SecurityProfile).\
+                    filter(SecurityProfile.id.in_(group_ids)).\
+                    all():
+                profiles[profile.id] = dict(uuid=profile.nvp_id,
+                                            rule_count=profile.rule_count or 0)
+        for group_id in group_ids:
+            if group_id not in profiles:
+                raise sg_ext.SecurityGroupNotFound(id=group_id)
+        return profiles
+
     def _check_rule_count_per_port(self, context, group_id):
-        ports = context.session.query(models.SecurityGroup).filter(
-            models.SecurityGroup.id == group_id).first().get('ports', [])
-        groups = (set(group.id for group in port.get('security_groups', []))
-                  for port in ports)
-        return max(self._check_rule_count_for_groups(
-            context, (self._get_security_group(context, id) for id in g))
-            for g in groups)
+        association = lport_profile_association_table
+        count = context.session.query(sa.func.max(LSwitchPort.rule_count)).\
+            filter(LSwitchPort.id == association.c.lport_id).\
+            filter(association.c.profile_id == group_id).\
+            scalar()
+        # NOTE(jkoelker) Ports whose lport has no profiles recorded predate
+        #                the association table, count their rules the slow
+        #                way until the migration has backfilled them.
+        count = count or 0
+        for port in self._untracked_ports(context, group_id):
+            groups = (self._get_security_group(context, group.id)
+                      for group in port.security_groups)
+            count = max(count,
+                        self._check_rule_count_for_groups(context, groups))
+        return count
+
+    def _untracked_ports(self, context, group_id):
+        association = lport_profile_association_table
+        port_groups = models.port_group_association_table
+        tracked = sa.exists().where(sa.and_(
+            LSwitchPort.port_id == models.Port.backend_key,
+            LSwitchPort.id == association.c.lport_id))
+        return context.session.query(models.Port).\
+            filter(models.Port.id == port_groups.c.port_id).\
+            filter(port_groups.c.group_id == group_id).\
+            filter(~tracked).\
+            all()
+
+
+lport_profile_association_table = sa.Table(
+    "quark_nvp_driver_lport_security_profile_associations",
+    models.BASEV2.metadata,
+    sa.Column("lport_id", sa.String(36),
+              sa.ForeignKey("quark_nvp_driver_lswitchport.id"),
+              nullable=False),
+    sa.Column("profile_id", sa.String(36),
+              sa.ForeignKey("quark_nvp_driver_security_profile.id"),
+              nullable=False))
+
+
+# NOTE(jkoelker) index=True would name this past MySQL's 64 character limit
+sa.Index("idx_quark_nvp_driver_lport_profile",
+         lport_profile_association_table.c.profile_id)
 
 
 class LSwitchPort(models.BASEV2, models.HasId):
@@ -216,6 +430,16 @@ class LSwitchPort(models.BASEV2, models.HasId):
     switch_id = sa.Column(sa.String(36),
                           sa.ForeignKey("quark_nvp_driver_lswitch.id"),
                           nullable=False)
+    # NOTE(jkoelker) Sum of the rules of the port's security profiles,
+    #                kept up to date for the max_rules_per_port check
+    rule_count = sa.Column(sa.Integer(), nullable=False, default=0)
+    security_profiles = orm.relationship(
+        "SecurityProfile", secondary=lport_profile_association_table,
+        backref="lports")
+
+
+sa.Index("idx_quark_nvp_driver_lswitchport_port",
+         LSwitchPort.__table__.c.port_id)
 
 
 class LSwitch(models.BASEV2, models.HasId):
@@ -230,6 +454,11 @@ class LSwitch(models.BASEV2, models.HasId):
     segment_id = sa.Column(sa.Integer())
 
 
+sa.Index("idx_quark_nvp_driver_lswitch_network",
+         LSwitch.__table__.c.network_id, LSwitch.__table__.c.port_count)
+sa.Index("idx_quark_nvp_driver_lswitch_nvp_id", LSwitch.__table__.c.nvp_id)
+
+
 class QOS(models.BASEV2, models.HasId):
     __tablename__ = "quark_nvp_driver_qos"
     display_name = sa.Column(sa.String(255), nullable=False)
@@ -240,3 +469,4 @@ class QOS(models.BASEV2, models.HasId):
 class SecurityProfile(models.BASEV2, models.HasId):
     __tablename__ = "quark_nvp_driver_security_profile"
     nvp_id = sa.Column(sa.String(36), nullable=False)
+    rule_count = sa.Column(sa.Integer(), nullable=False, default=0)
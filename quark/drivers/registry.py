@@ -14,6 +14,7 @@
 #    under the License.
 
 from quark.drivers import base
+from quark.drivers import metrics
 from quark.drivers import nvp_driver
 from quark.drivers import unmanaged
 
@@ -24,6 +25,8 @@ class DriverRegistry(object):
             base.BaseDriver.get_name(): base.BaseDriver(),
             nvp_driver.NVPDriver.get_name(): nvp_driver.NVPDriver(),
             unmanaged.UnmanagedDriver.get_name(): unmanaged.UnmanagedDriver()}
+        for name, driver in self.drivers.items():
+            self.drivers[name] = metrics.InstrumentedDriver(name, driver)
 
     def get_driver(self, driver_name):
         if driver_name in self.drivers:
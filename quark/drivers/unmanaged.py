@@ -15,13 +15,14 @@
 
 from neutron.openstack.common import log as logging
 
+from quark.drivers import base
 from quark import network_strategy
 
 STRATEGY = network_strategy.STRATEGY
 LOG = logging.getLogger(__name__)
 
 
-class UnmanagedDriver(object):
+class UnmanagedDriver(base.BaseDriver):
     """Unmanaged network driver.
 
     Returns a bridge...
@@ -68,6 +69,10 @@ class UnmanagedDriver(object):
         LOG.info("diag_port %s" % network_id)
         return {}
 
+    def diag_backend(self, context):
+        LOG.info("diag_backend")
+        return {}
+
     def create_security_group(self, context, group_name, **group):
         LOG.info("Creating security profile %s for tenant %s" %
                  (group_name, context.tenant_id))
@@ -79,3 +79,15 @@ class IPPolicyInUse(exceptions.InUse):
 
 class DriverLimitReached(exceptions.InvalidInput):
     message = _("Driver has reached limit on resource '%(limit)s'")
+
+
+class BackendUnavailable(exceptions.ServiceUnavailable):
+    message = _("Backend %(backend)s is unavailable: %(reason)s")
+
+
+class InvalidSortKey(exceptions.InvalidInput):
+    message = _("Cannot sort by %(key)s, sortable keys are %(keys)s")
+
+
+class MarkerNotFound(exceptions.NotFound):
+    message = _("Marker %(marker)s not found.")
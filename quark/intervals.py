@@ -0,0 +1,88 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Arithmetic on sets of integers stored as inclusive (first, last) intervals.
+
+Unlike netaddr.IPSet, nothing here is split into CIDR blocks, so the cost of
+every operation depends on the number of intervals involved and not on the
+size or alignment of the address space they cover.
+"""
+
+import netaddr
+
+
+def merge(intervals):
+    """Sorts intervals and coalesces overlapping or adjacent ones."""
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def difference(intervals, removed):
+    """Returns the parts of intervals not covered by removed."""
+    removed = merge(removed)
+    result = []
+    start = 0
+    for first, last in merge(intervals):
+        while start < len(removed) and removed[start][1] < first:
+            start += 1
+        index = start
+        while index < len(removed) and removed[index][0] <= last:
+            r_first, r_last = removed[index]
+            if r_first > first:
+                result.append((first, r_first - 1))
+            first = max(first, r_last + 1)
+            if first > last:
+                break
+            index += 1
+        if first <= last:
+            result.append((first, last))
+    return result
+
+
+def clip(intervals, first, last):
+    """Returns the parts of intervals that fall within [first, last]."""
+    return [(max(i_first, first), min(i_last, last))
+            for i_first, i_last in intervals
+            if i_first <= last and i_last >= first]
+
+
+def size(intervals):
+    return sum(last - first + 1 for first, last in intervals)
+
+
+def from_network(network):
+    """Returns the single interval covering a netaddr.IPNetwork."""
+    return [(network.first, network.last)]
+
+
+def to_pools(intervals, version):
+    """Renders intervals as neutron allocation_pools."""
+    return [dict(start=str(netaddr.IPAddress(first, version=version)),
+                 end=str(netaddr.IPAddress(last, version=version)))
+            for first, last in intervals]
+
+
+def to_ip_set(intervals, version):
+    return netaddr.IPSet(
+        netaddr.IPRange(netaddr.IPAddress(first, version=version),
+                        netaddr.IPAddress(last, version=version))
+        for first, last in intervals)
@@ -17,24 +17,176 @@
 Quark Pluggable IPAM
 """
 
+import atexit
+import copy
+import datetime
+import os
+import random
+import socket
+import threading
+
 import netaddr
 
 from neutron.common import exceptions
+from neutron import context as neutron_context
 from neutron.openstack.common import log as logging
-from neutron.openstack.common.notifier import api as notifier_api
 from neutron.openstack.common import timeutils
+from neutron.openstack.common import uuidutils
 
 from oslo.config import cfg
 
 from quark.db import api as db_api
 from quark.db import models
+from quark import intervals
+from quark import notifications
 
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+# NOTE(jkoelker) Claims lost to another allocator before giving up on the
+#                free range index. Every retry re-reads the ranges with a
+#                locking read, so losing more than once is unusual.
+FREE_RANGE_CLAIM_ATTEMPTS = 3
+
+
+class MacAddressLeases(object):
+    """The block of MAC addresses leased by this worker process.
+
+    A block is reserved by advancing a range's next_auto_assign_mac in a
+    single statement, after which addresses are handed out of it in memory
+    without touching the range rows. Lease bookkeeping runs in its own
+    short transactions so a rolled back port create can't undo it. The
+    lease is renewed as it is consumed, released on exit and reclaimed by
+    another worker if it expires.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._owner = None
+        self._lease = None
+        self._registered = False
+
+    def _check_owner(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # NOTE(jkoelker) A lease taken before a fork belongs to the
+            #                parent, the child has to get its own.
+            self._pid = pid
+            self._owner = "%s:%d:%s" % (socket.gethostname(), pid,
+                                        uuidutils.generate_uuid())
+            self._lease = None
+
+    def _expires_at(self, timeout=None):
+        if timeout is None:
+            timeout = CONF.QUARK.mac_lease_timeout
+        return timeutils.utcnow() + datetime.timedelta(seconds=timeout)
+
+    def _acquire(self):
+        admin = neutron_context.get_admin_context()
+        expires_at = self._expires_at()
+        with admin.session.begin():
+            lease = db_api.mac_address_lease_reclaim(admin, self._owner,
+                                                     expires_at)
+            if not lease:
+                block = db_api.mac_address_range_reserve_block(
+                    admin, CONF.QUARK.mac_lease_size)
+                if not block:
+                    return None
+                rng, first, last = block
+                lease = db_api.mac_address_lease_create(
+                    admin, mac_address_range_id=rng["id"],
+                    first_address=first, last_address=last,
+                    owner=self._owner, expires_at=expires_at)
+
+        if not self._registered:
+            atexit.register(self.release)
+            self._registered = True
+
+        LOG.info("Leased MAC addresses %s-%s" % (lease["first_address"],
+                                                 lease["last_address"]))
+        return dict(id=lease["id"],
+                    mac_address_range_id=lease["mac_address_range_id"],
+                    next_address=lease["first_address"],
+                    last_address=lease["last_address"],
+                    renewed_at=timeutils.utcnow())
+
+    def _renew(self, lease, timeout=None):
+        admin = neutron_context.get_admin_context()
+        with admin.session.begin():
+            if lease["next_address"] > lease["last_address"]:
+                db_api.mac_address_lease_delete(admin, lease["id"],
+                                                self._owner)
+                return False
+            renewed = db_api.mac_address_lease_renew(
+                admin, lease["id"], self._owner, lease["next_address"],
+                self._expires_at(timeout))
+        lease["renewed_at"] = timeutils.utcnow()
+        return renewed
+
+    def _next_address(self):
+        with self._lock:
+            self._check_owner()
+            while True:
+                lease = self._lease
+                if not lease:
+                    lease = self._lease = self._acquire()
+                    if not lease:
+                        return None
+
+                since_renewal = timeutils.utcnow() - lease["renewed_at"]
+                if (lease["next_address"] > lease["last_address"] or
+                        timeutils.total_seconds(since_renewal) >
+                        CONF.QUARK.mac_lease_timeout / 2):
+                    if not self._renew(lease):
+                        self._lease = None
+                        continue
+
+                address = lease["next_address"]
+                lease["next_address"] = address + 1
+                return lease["mac_address_range_id"], address
+
+    def allocate(self, context):
+        """Returns a (range id, address) pair not yet in use, or None."""
+        while True:
+            leased = self._next_address()
+            if not leased:
+                return None
+            # NOTE(jkoelker) A reclaimed lease may contain addresses its
+            #                previous owner handed out, and a MAC may have
+            #                been requested explicitly since.
+            if not db_api.mac_address_find(context, address=leased[1],
+                                           scope=db_api.ONE):
+                return leased
+
+    def release(self):
+        """Makes the rest of the lease reclaimable right away."""
+        with self._lock:
+            if not self._lease or self._pid != os.getpid():
+                return
+            try:
+                self._renew(self._lease, timeout=0)
+            except Exception:
+                LOG.exception("Failed to release MAC address lease %s" %
+                              self._lease["id"])
+            self._lease = None
+
+
+MAC_LEASES = MacAddressLeases()
+
+
+def _loaded_device_ids(address):
+    # NOTE(jkoelker) A freshly allocated address has no ports yet, so don't
+    #                spend a query per address lazy loading them to find out
+    loaded = getattr(address, "__dict__", address)
+    return [p["device_id"] for p in loaded.get("ports", [])]
+
 
 class QuarkIpam(object):
+    # NOTE(jkoelker) Subnet allocation counts remembered for the batch this
+    #                strategy is allocating, see allocate_ip_addresses.
+    _batch = None
+
     def allocate_mac_address(self, context, net_id, port_id, reuse_after,
                              mac_address=None):
         if mac_address:
@@ -49,6 +201,15 @@ class QuarkIpam(object):
                     context, deallocated_mac, deallocated=False,
                     deallocated_at=None)
 
+        if not mac_address and CONF.QUARK.mac_lease_size > 0:
+            leased = MAC_LEASES.allocate(context)
+            if leased:
+                range_id, next_address = leased
+                with context.session.begin(subtransactions=True):
+                    return db_api.mac_address_create(
+                        context, address=next_address,
+                        mac_address_range_id=range_id)
+
         with context.session.begin(subtransactions=True):
             ranges = db_api.mac_address_range_find_allocation_counts(
                 context, address=mac_address)
@@ -77,9 +238,46 @@ class QuarkIpam(object):
 
         raise exceptions.MacAddressGenerationFailure(net_id=net_id)
 
+    def _attempt_to_reallocate_queued_ip(self, context, net_id, reuse_after,
+                                         version):
+        elevated = context.elevated()
+        for times in xrange(3):
+            with context.session.begin(subtransactions=True):
+                entries = db_api.ip_reuse_queue_peek(elevated, net_id,
+                                                     version, reuse_after)
+                if not entries:
+                    break
+                for entry in entries:
+                    if not db_api.ip_reuse_queue_pop(elevated, entry):
+                        continue
+                    # NOTE(jkoelker) The address may have been handed out
+                    #                again by a fixed IP request since.
+                    address = db_api.ip_address_find(
+                        elevated, id=[entry["ip_address_id"]],
+                        deallocated=True, lock_mode=True, scope=db_api.ONE)
+                    if not address or not address.get("subnet"):
+                        continue
+                    cidr = netaddr.IPNetwork(address["subnet"]["cidr"])
+                    addr = netaddr.IPAddress(address["address"],
+                                             version=cidr.version)
+                    if addr not in cidr:
+                        db_api.ip_address_delete(elevated, address)
+                        continue
+                    return [db_api.ip_address_update(
+                        elevated, address, deallocated=False,
+                        deallocated_at=None,
+                        allocated_at=timeutils.utcnow())]
+        return []
+
     def attempt_to_reallocate_ip(self, context, net_id, port_id, reuse_after,
                                  version=None, ip_address=None):
         version = version or [4, 6]
+        if CONF.QUARK.ipam_reuse_queue and not ip_address:
+            if not isinstance(version, list):
+                version = [version]
+            return self._attempt_to_reallocate_queued_ip(
+                context, net_id, reuse_after, version)
+
         elevated = context.elevated()
 
         # We never want to take the chance of an infinite loop here. Instead,
@@ -107,7 +305,7 @@ class QuarkIpam(object):
                             return [updated_address]
                         else:
                             # Make sure we never find it again
-                            context.session.delete(address)
+                            db_api.ip_address_delete(elevated, address)
                             continue
                 break
         return []
@@ -115,8 +313,141 @@ class QuarkIpam(object):
     def is_strategy_satisfied(self, ip_addresses):
         return ip_addresses
 
+    def _build_free_ranges(self, context, subnet):
+        """(Re)builds the free range index of a subnet from scratch."""
+        for free_range in db_api.ip_free_range_find(
+                context, subnet_id=subnet["id"], scope=db_api.ALL):
+            db_api.ip_free_range_delete(context, free_range)
+
+        ipnet = netaddr.IPNetwork(subnet["cidr"])
+        allocated = db_api.ip_address_find(context, subnet_id=subnet["id"],
+                                           scope=db_api.ALL) or []
+        allocated = [int(netaddr.IPAddress(int(a["address"]),
+                                           version=ipnet.version))
+                     for a in allocated]
+        excluded = models.IPPolicy.get_compiled_ip_policy(subnet).intervals
+        excluded = excluded + [(address, address) for address in allocated]
+
+        free = intervals.difference(intervals.from_network(ipnet), excluded)
+        for first, last in free:
+            db_api.ip_free_range_create(context, subnet_id=subnet["id"],
+                                        first_address=first,
+                                        last_address=last)
+        subnet["free_ranges_built"] = True
+        context.session.flush()
+
+    def _claim_free_range_ip(self, context, subnet, ip_policy_rules,
+                             cursor=None):
+        """Claims the lowest indexed address at or after cursor.
+
+        Wraps around to the lowest indexed address if nothing is free past
+        the cursor. Returns None once the index is exhausted, or when
+        claims keep being lost to other allocators.
+        """
+        ipnet = netaddr.IPNetwork(subnet["cidr"])
+        lost = 0
+        while lost < FREE_RANGE_CLAIM_ATTEMPTS:
+            # NOTE(jkoelker) A plain read after a lost claim may return the
+            #                same snapshot the claim already failed on, the
+            #                locking read sees the current ranges.
+            ranges = db_api.ip_free_range_find(
+                context, subnet_id=subnet["id"], lock_mode=lost > 0,
+                scope=db_api.ALL)
+            if not ranges:
+                return None
+
+            ranges = sorted(ranges, key=lambda r: int(r["first_address"]))
+            if cursor is not None:
+                ranges = ([r for r in ranges
+                           if int(r["last_address"]) >= cursor] +
+                          [r for r in ranges
+                           if int(r["last_address"]) < cursor])
+
+            free_range = ranges[0]
+            address = max(int(free_range["first_address"]), cursor or 0)
+            if address > int(free_range["last_address"]):
+                address = int(free_range["first_address"])
+
+            if not db_api.ip_free_range_claim(context, free_range, address):
+                lost += 1
+                continue
+
+            next_ip = netaddr.IPAddress(address, version=ipnet.version)
+            # NOTE(jkoelker) the policy may have grown since the index was
+            #                built, in which case we've just pruned it.
+            if ip_policy_rules and next_ip in ip_policy_rules:
+                continue
+            return next_ip
+
+        LOG.warn("Lost %d free range claims on subnet %s, falling back" %
+                 (lost, subnet["id"]))
+        return None
+
+    def _free_range_index_enabled(self):
+        return CONF.QUARK.ipam_free_range_index
+
+    def _remove_from_free_ranges(self, context, subnet, ip_address):
+        if not subnet.get("free_ranges_built"):
+            return
+        if not self._free_range_index_enabled():
+            # NOTE(jkoelker) nobody is maintaining the index right now, so
+            #                make sure it is rebuilt if it is turned back on.
+            subnet["free_ranges_built"] = False
+            return
+        address = int(ip_address)
+        for attempt in xrange(FREE_RANGE_CLAIM_ATTEMPTS):
+            ranges = db_api.ip_free_range_find(
+                context, subnet_id=subnet["id"], lock_mode=attempt > 0,
+                scope=db_api.ALL) or []
+            ranges = [r for r in ranges
+                      if (int(r["first_address"]) <= address <=
+                          int(r["last_address"]))]
+            if not ranges:
+                return
+            if db_api.ip_free_range_claim(context, ranges[0], address):
+                return
+        # NOTE(jkoelker) The address may still be in the index, have the
+        #                next allocation rebuild it from the addresses.
+        subnet["free_ranges_built"] = False
+
+    def _allocate_from_free_ranges(self, context, subnet, network_id,
+                                   ip_policy_rules):
+        ipnet = netaddr.IPNetwork(subnet["cidr"])
+        cursor = netaddr.IPAddress(int(subnet["next_auto_assign_ip"]))
+        if ipnet.version == 4:
+            cursor = cursor.ipv4()
+        cursor = int(cursor)
+
+        rebuilt = False
+        if not subnet.get("free_ranges_built"):
+            self._build_free_ranges(context, subnet)
+            rebuilt = True
+
+        next_ip = self._claim_free_range_ip(context, subnet, ip_policy_rules,
+                                            cursor=cursor)
+        if next_ip is None and not rebuilt:
+            # The index only ever shrinks, so give a policy that shrank
+            # since it was built a chance to hand its addresses back.
+            self._build_free_ranges(context, subnet)
+            next_ip = self._claim_free_range_ip(context, subnet,
+                                                ip_policy_rules,
+                                                cursor=cursor)
+        if next_ip is None:
+            raise exceptions.IpAddressGenerationFailure(net_id=network_id)
+
+        subnet["next_auto_assign_ip"] = int(next_ip.ipv6()) + 1
+        return next_ip
+
     def _iterate_until_available_ip(self, context, subnet, network_id,
                                     ip_policy_rules):
+        if self._free_range_index_enabled():
+            return self._allocate_from_free_ranges(context, subnet,
+                                                   network_id,
+                                                   ip_policy_rules)
+
+        if subnet.get("free_ranges_built"):
+            subnet["free_ranges_built"] = False
+
         address = True
         while address:
             next_ip_int = int(subnet["next_auto_assign_ip"])
@@ -168,6 +499,7 @@ class QuarkIpam(object):
                     if address:
                         raise exceptions.IpAddressGenerationFailure(
                             net_id=net_id)
+                    self._remove_from_free_ranges(elevated, subnet, next_ip)
                 else:
                     next_ip = self._iterate_until_available_ip(
                         elevated, subnet, net_id, ip_policy_rules)
@@ -183,28 +515,38 @@ class QuarkIpam(object):
             payload = dict(tenant_id=addr["tenant_id"],
                            ip_block_id=addr["subnet_id"],
                            ip_address=addr["address_readable"],
-                           device_ids=[p["device_id"] for p in addr["ports"]],
+                           device_ids=_loaded_device_ids(addr),
                            created_at=addr["created_at"])
-            notifier_api.notify(context,
-                                notifier_api.publisher_id("network"),
-                                "ip_block.address.create",
-                                notifier_api.CONF.default_notification_level,
-                                payload)
+            notifications.notify(context, "ip_block.address.create",
+                                 payload)
         return new_addresses
 
+    def allocate_ip_addresses(self, context, net_id, port_ids, reuse_after):
+        """Allocates addresses for several new ports on one network.
+
+        The network's subnets are scanned once for the whole batch and
+        their allocation counts are kept up to date in memory, rather
+        than being locked and counted again for every port. Returns a list
+        holding the addresses of each port, in order.
+        """
+        batch = copy.copy(self)
+        batch._batch = {}
+        with context.session.begin(subtransactions=True):
+            return [batch.allocate_ip_address(context, net_id, port_id,
+                                              reuse_after)
+                    for port_id in port_ids]
+
     def _deallocate_ip_address(self, context, address):
         address["deallocated"] = 1
+        if CONF.QUARK.ipam_reuse_queue:
+            db_api.ip_reuse_queue_push(context, address)
         payload = dict(tenant_id=address["tenant_id"],
                        ip_block_id=address["subnet_id"],
                        ip_address=address["address_readable"],
-                       device_ids=[p["device_id"] for p in address["ports"]],
+                       device_ids=_loaded_device_ids(address),
                        created_at=address["created_at"],
                        deleted_at=timeutils.utcnow())
-        notifier_api.notify(context,
-                            notifier_api.publisher_id("network"),
-                            "ip_block.address.delete",
-                            notifier_api.CONF.default_notification_level,
-                            payload)
+        notifications.notify(context, "ip_block.address.delete", payload)
 
     def deallocate_ip_address(self, context, port, **kwargs):
         with context.session.begin(subtransactions=True):
@@ -224,20 +566,37 @@ class QuarkIpam(object):
             db_api.mac_address_update(context, mac, deallocated=True,
                                       deallocated_at=timeutils.utcnow())
 
+    def _allocation_counts(self, context, net_id, **filters):
+        if self._batch is None:
+            return db_api.subnet_find_allocation_counts(context, net_id,
+                                                        scope=db_api.ALL,
+                                                        **filters)
+        key = (net_id, filters.get("ip_version"))
+        if key not in self._batch:
+            self._batch[key] = [
+                [subnet, ips_in_subnet or 0] for subnet, ips_in_subnet in
+                db_api.subnet_find_allocation_counts(context, net_id,
+                                                     scope=db_api.ALL,
+                                                     **filters)]
+        return self._batch[key]
+
     def select_subnet(self, context, net_id, ip_address, **filters):
-        subnets = db_api.subnet_find_allocation_counts(context, net_id,
-                                                       scope=db_api.ALL,
-                                                       **filters)
-        for subnet, ips_in_subnet in subnets:
+        subnets = self._allocation_counts(context, net_id, **filters)
+        for entry in subnets:
+            subnet, ips_in_subnet = entry
             ipnet = netaddr.IPNetwork(subnet["cidr"])
             if ip_address and ip_address not in ipnet:
                 continue
-            ip_policy_rules = None
+            policy_size = 0
             if not ip_address:
-                ip_policy_rules = models.IPPolicy.get_ip_policy_rule_set(
-                    subnet)
-            policy_size = ip_policy_rules.size if ip_policy_rules else 0
-            if ipnet.size > (ips_in_subnet + policy_size):
+                policy_size = subnet.get("policy_excluded_count")
+                if policy_size is None:
+                    policy_size = models.IPPolicy.get_compiled_ip_policy(
+                        subnet).size
+                    subnet["policy_excluded_count"] = policy_size
+            if ipnet.size > ((ips_in_subnet or 0) + policy_size):
+                if self._batch is not None:
+                    entry[1] += 1
                 return subnet
 
 
@@ -317,12 +676,88 @@ class QuarkIpamBOTHREQ(QuarkIpamBOTH):
         return subnets
 
 
+class QuarkIpamFreeRanges(object):
+    """Allocates new addresses by claiming them from quark_ip_free_ranges.
+
+    Subnets are chosen without locking them or counting their addresses,
+    and next_auto_assign_ip is left alone, so concurrent allocations on a
+    network only contend on the free range row each of them shrinks.
+    Meant to be mixed in ahead of one of the strategies above.
+    """
+    def _free_range_index_enabled(self):
+        return True
+
+    def _ensure_free_ranges(self, context, subnet, rebuild=False):
+        if subnet["free_ranges_built"] and not rebuild:
+            return
+        with context.session.begin(subtransactions=True):
+            # NOTE(jkoelker) Serialize builders on the subnet row and make
+            #                sure nobody beat us to it while we waited.
+            context.session.refresh(subnet, lockmode="update")
+            if subnet["free_ranges_built"] and not rebuild:
+                return
+            self._build_free_ranges(context, subnet)
+
+    def select_subnet(self, context, net_id, ip_address, **filters):
+        subnets = db_api.subnet_find(context, network_id=net_id,
+                                     scope=db_api.ALL, **filters) or []
+        for subnet in subnets:
+            ipnet = netaddr.IPNetwork(subnet["cidr"])
+            if ip_address and ip_address not in ipnet:
+                continue
+            self._ensure_free_ranges(context, subnet)
+            if ip_address:
+                return subnet
+            if db_api.ip_free_range_find(context, subnet_id=subnet["id"],
+                                         scope=db_api.ONE):
+                return subnet
+
+    def _iterate_until_available_ip(self, context, subnet, network_id,
+                                    ip_policy_rules):
+        # NOTE(jkoelker) Start each allocator at a random address, so
+        #                concurrent ones claim from different ranges rather
+        #                than all from the lowest one.
+        ipnet = netaddr.IPNetwork(subnet["cidr"])
+        cursor = random.randint(ipnet.first, ipnet.last)
+        next_ip = self._claim_free_range_ip(context, subnet, ip_policy_rules,
+                                            cursor=cursor)
+        if next_ip is None:
+            # The index only ever shrinks, so give a policy that shrank
+            # since it was built a chance to hand its addresses back.
+            self._ensure_free_ranges(context, subnet, rebuild=True)
+            next_ip = self._claim_free_range_ip(context, subnet,
+                                                ip_policy_rules,
+                                                cursor=cursor)
+        if next_ip is None:
+            raise exceptions.IpAddressGenerationFailure(net_id=network_id)
+        return next_ip
+
+
+class QuarkIpamFreeRangesANY(QuarkIpamFreeRanges, QuarkIpamANY):
+    @classmethod
+    def get_name(self):
+        return "ANY_FREE_RANGES"
+
+
+class QuarkIpamFreeRangesBOTH(QuarkIpamFreeRanges, QuarkIpamBOTH):
+    @classmethod
+    def get_name(self):
+        return "BOTH_FREE_RANGES"
+
+
+class QuarkIpamFreeRangesBOTHREQ(QuarkIpamFreeRanges, QuarkIpamBOTHREQ):
+    @classmethod
+    def get_name(self):
+        return "BOTH_REQUIRED_FREE_RANGES"
+
+
 class IpamRegistry(object):
     def __init__(self):
-        self.strategies = {
-            QuarkIpamANY.get_name(): QuarkIpamANY(),
-            QuarkIpamBOTH.get_name(): QuarkIpamBOTH(),
-            QuarkIpamBOTHREQ.get_name(): QuarkIpamBOTHREQ()}
+        self.strategies = dict(
+            (strategy.get_name(), strategy())
+            for strategy in (QuarkIpamANY, QuarkIpamBOTH, QuarkIpamBOTHREQ,
+                             QuarkIpamFreeRangesANY, QuarkIpamFreeRangesBOTH,
+                             QuarkIpamFreeRangesBOTHREQ))
 
     def is_valid_strategy(self, strategy_name):
         if strategy_name in self.strategies:
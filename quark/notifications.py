@@ -0,0 +1,169 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Quark notification emitter.
+
+With async_notifications enabled, events raised inside a transaction are
+held until the transaction commits, dropped if it rolls back, and handed
+to a background green thread that sends them in batches. Otherwise they
+are sent straight away, as before.
+"""
+
+import atexit
+import threading
+import time
+import weakref
+
+import eventlet
+from eventlet import queue
+from neutron.openstack.common import log as logging
+from neutron.openstack.common.notifier import api as notifier_api
+from oslo.config import cfg
+from sqlalchemy import event
+from sqlalchemy import orm
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+
+def _send(context, event_type, payload):
+    notifier_api.notify(context,
+                        notifier_api.publisher_id("network"),
+                        event_type,
+                        notifier_api.CONF.default_notification_level,
+                        payload)
+
+
+class NotificationEmitter(object):
+    """Sends queued notifications from a background green thread."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._started = False
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._queue = queue.LightQueue(
+                CONF.QUARK.notification_queue_size)
+            event.listen(orm.Session, "after_commit", _after_commit)
+            event.listen(orm.Session, "after_soft_rollback",
+                         _after_soft_rollback)
+            atexit.register(self.flush)
+            eventlet.spawn_n(self._run)
+            self._started = True
+
+    def put(self, context, event_type, payload):
+        try:
+            self._queue.put_nowait((context, event_type, payload))
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                LOG.warning("Notification queue full, %d notifications "
+                            "dropped so far" % self.dropped)
+
+    def depth(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def stats(self):
+        return dict(queued=self.queued, sent=self.sent, failed=self.failed,
+                    dropped=self.dropped, depth=self.depth())
+
+    def _batch(self, block=True):
+        batch = []
+        try:
+            batch.append(self._queue.get(block=block))
+            while len(batch) < CONF.QUARK.notification_batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _send_batch(self, batch):
+        for context, event_type, payload in batch:
+            try:
+                _send(context, event_type, payload)
+                self.sent += 1
+            except Exception:
+                self.failed += 1
+                LOG.exception("Failed to send %s notification" % event_type)
+
+    def _run(self):
+        while True:
+            self._send_batch(self._batch())
+            eventlet.sleep(0)
+
+    def flush(self, timeout=None):
+        """Sends everything still queued, for use at shutdown."""
+        if not self._queue:
+            return
+        if timeout is None:
+            timeout = CONF.QUARK.notification_flush_timeout
+        deadline = time.time() + timeout
+        while self._queue.qsize() and time.time() < deadline:
+            self._send_batch(self._batch(block=False))
+        if self._queue.qsize():
+            LOG.warning("Gave up flushing %d notifications at shutdown" %
+                        self._queue.qsize())
+
+
+EMITTER = NotificationEmitter()
+
+_PENDING = weakref.WeakKeyDictionary()
+
+
+def _owner(transaction):
+    # NOTE(jkoelker) subtransactions commit and roll back along with the
+    #                nearest savepoint or the outermost transaction
+    while transaction._parent is not None and not transaction.nested:
+        transaction = transaction._parent
+    return transaction
+
+
+def _after_commit(session):
+    transaction = session.transaction
+    if transaction is None:
+        return
+    events = _PENDING.pop(transaction, [])
+    if transaction.nested:
+        _PENDING.setdefault(_owner(transaction._parent), []).extend(events)
+        return
+    for pending in events:
+        EMITTER.put(*pending)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    _PENDING.pop(_owner(previous_transaction), None)
+
+
+def notify(context, event_type, payload):
+    if not CONF.QUARK.async_notifications:
+        _send(context, event_type, payload)
+        return
+
+    EMITTER.start()
+    transaction = context.session.transaction
+    if transaction is None or not transaction.is_active:
+        EMITTER.put(context, event_type, payload)
+    else:
+        _PENDING.setdefault(_owner(transaction), []).append(
+            (context, event_type, payload))
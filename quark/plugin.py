@@ -21,10 +21,14 @@ from oslo.config import cfg
 from neutron.db import api as neutron_db_api
 from neutron.extensions import securitygroup as sg_ext
 from neutron import neutron_plugin_base_v2
+from neutron.openstack.common import excutils
+from neutron.openstack.common import log as logging
 from neutron import quota
 
 from quark.api import extensions
+from quark import backend_ops
 from quark.db import models
+from quark.drivers import metrics
 from quark.plugin_modules import ip_addresses
 from quark.plugin_modules import ip_policies
 from quark.plugin_modules import mac_address_ranges
@@ -35,6 +39,7 @@ from quark.plugin_modules import security_groups
 from quark.plugin_modules import subnets
 
 CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
 
 quark_resources = [
     quota.BaseResource('ports_per_network',
@@ -76,9 +81,40 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
                                    "ip_policies", "quotas",
                                    "networks_quark"]
 
+    # NOTE(jkoelker) Have neutron hand sorts, limit and marker to the list
+    #                calls rather than paging the full result itself.
+    __native_pagination_support = True
+    __native_sorting_support = True
+    # NOTE(jkoelker) Ports are created in bulk by create_port_bulk. Neutron
+    #                then expects a *_bulk call for every other resource as
+    #                well, see _create_bulk.
+    __native_bulk_support = True
+
     def __init__(self):
         neutron_db_api.configure_db()
         neutron_db_api.register_models(base=models.BASEV2)
+        if CONF.QUARK.backend_outbox:
+            backend_ops.WORKER.start()
+
+    def _create_bulk(self, create, delete, context, items):
+        """Creates items one at a time, deleting them again on failure.
+
+        The same emulation neutron does for plugins without native bulk
+        support.
+        """
+        created = []
+        try:
+            for item in items:
+                created.append(create(context, item))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for obj in created:
+                    try:
+                        delete(context, obj["id"])
+                    except Exception:
+                        LOG.exception("Unable to delete %s while undoing "
+                                      "a bulk create" % obj["id"])
+        return created
 
     def get_mac_address_range(self, context, id, fields=None):
         return mac_address_ranges.get_mac_address_range(context, id, fields)
@@ -173,6 +209,9 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
     def create_port(self, context, port):
         return ports.create_port(context, port)
 
+    def create_port_bulk(self, context, bulk_ports):
+        return ports.create_port_bulk(context, bulk_ports)
+
     def post_update_port(self, context, id, port):
         return ports.post_update_port(context, id, port)
 
@@ -182,8 +221,10 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
     def update_port(self, context, id, port):
         return ports.update_port(context, id, port)
 
-    def get_ports(self, context, filters=None, fields=None):
-        return ports.get_ports(context, filters, fields)
+    def get_ports(self, context, filters=None, fields=None, sorts=None,
+                  limit=None, marker=None, page_reverse=False):
+        return ports.get_ports(context, filters, fields, sorts, limit,
+                               marker, page_reverse)
 
     def get_ports_count(self, context, filters=None):
         return ports.get_ports_count(context, filters)
@@ -212,14 +253,20 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
     def create_subnet(self, context, subnet):
         return subnets.create_subnet(context, subnet)
 
+    def create_subnet_bulk(self, context, bulk_subnets):
+        return self._create_bulk(self.create_subnet, self.delete_subnet,
+                                 context, bulk_subnets["subnets"])
+
     def update_subnet(self, context, id, subnet):
         return subnets.update_subnet(context, id, subnet)
 
     def get_subnet(self, context, id, fields=None):
         return subnets.get_subnet(context, id, fields)
 
-    def get_subnets(self, context, filters=None, fields=None):
-        return subnets.get_subnets(context, filters, fields)
+    def get_subnets(self, context, filters=None, fields=None, sorts=None,
+                    limit=None, marker=None, page_reverse=False):
+        return subnets.get_subnets(context, filters, fields, sorts, limit,
+                                   marker, page_reverse)
 
     def get_subnets_count(self, context, filters=None):
         return subnets.get_subnets_count(context, filters)
@@ -233,14 +280,20 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
     def create_network(self, context, network):
         return networks.create_network(context, network)
 
+    def create_network_bulk(self, context, bulk_networks):
+        return self._create_bulk(self.create_network, self.delete_network,
+                                 context, bulk_networks["networks"])
+
     def update_network(self, context, id, network):
         return networks.update_network(context, id, network)
 
     def get_network(self, context, id, fields=None):
         return networks.get_network(context, id, fields)
 
-    def get_networks(self, context, filters=None, fields=None):
-        return networks.get_networks(context, filters, fields)
+    def get_networks(self, context, filters=None, fields=None, sorts=None,
+                     limit=None, marker=None, page_reverse=False):
+        return networks.get_networks(context, filters, fields, sorts, limit,
+                                     marker, page_reverse)
 
     def get_networks_count(self, context, filters=None):
         return networks.get_networks_count(context, filters)
@@ -250,3 +303,11 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
 
     def diagnose_network(self, context, id, fields):
         return networks.diagnose_network(context, id, fields)
+
+    def diagnose_drivers(self, context, id, fields):
+        return {'drivers': metrics.METRICS.stats(id != "*" and id or None),
+                'ip_policy_cache': models.IP_POLICY_CACHE.stats()}
+
+    def dump_driver_metrics(self, context, id):
+        return (metrics.METRICS.dump(id != "*" and id or None) +
+                models.IP_POLICY_CACHE.dump())
@@ -64,6 +64,9 @@ def create_ip_policy(context, ip_policy):
                     id=model["ip_policy"]["id"], n_id=model["id"])
             model["ip_policy"] = db_api.ip_policy_create(context, **ipp)
 
+        db_api.subnet_reset_policy_excluded_count(
+            context, subnet_ids=subnet_ids, network_ids=network_ids)
+
     return v._make_ip_policy_dict(model["ip_policy"])
 
 
@@ -94,6 +97,10 @@ def update_ip_policy(context, id, ip_policy):
         network_ids = ipp.get("network_ids")
         subnet_ids = ipp.get("subnet_ids")
 
+        # NOTE(jkoelker) Anything covered by the policy before the update
+        #                needs its excluded address count recomputed.
+        db_api.subnet_reset_policy_excluded_count(context, ip_policy_id=id)
+
         models = []
         if subnet_ids:
             for subnet in ipp_db["subnets"]:
@@ -120,6 +127,8 @@ def update_ip_policy(context, id, ip_policy):
             model["ip_policy"] = ipp_db
 
         ipp_db = db_api.ip_policy_update(context, ipp_db, **ipp)
+        db_api.subnet_reset_policy_excluded_count(
+            context, subnet_ids=subnet_ids, network_ids=network_ids)
     return v._make_ip_policy_dict(ipp_db)
 
 
@@ -22,6 +22,7 @@ from neutron.openstack.common import log as logging
 from neutron.openstack.common import uuidutils
 from oslo.config import cfg
 
+from quark import backend_ops
 from quark.db import api as db_api
 from quark.drivers import registry
 from quark import exceptions as q_exc
@@ -93,10 +94,19 @@ def create_network(context, network):
 
         #TODO(dietz or perkins): Allow this to be overridden later with CLI
         default_net_type = CONF.QUARK.default_network_type
-        net_driver = registry.DRIVER_REGISTRY.get_driver(default_net_type)
-        net_driver.create_network(context, net_attrs["name"],
-                                  network_id=net_uuid, phys_type=pnet_type,
-                                  phys_net=phys_net, segment_id=seg_id)
+        if CONF.QUARK.backend_outbox:
+            backend_ops.enqueue(context, "create_network", net_uuid,
+                                default_net_type,
+                                network_name=net_attrs["name"],
+                                network_id=net_uuid, phys_type=pnet_type,
+                                phys_net=phys_net, segment_id=seg_id)
+        else:
+            net_driver = registry.DRIVER_REGISTRY.get_driver(
+                default_net_type)
+            net_driver.create_network(context, net_attrs["name"],
+                                      network_id=net_uuid,
+                                      phys_type=pnet_type,
+                                      phys_net=phys_net, segment_id=seg_id)
 
         subs = net_attrs.pop("subnets", [])
 
@@ -161,7 +171,8 @@ def get_network(context, id, fields=None):
     return v._make_network_dict(network)
 
 
-def get_networks(context, filters=None, fields=None):
+def get_networks(context, filters=None, fields=None, sorts=None, limit=None,
+                 marker=None, page_reverse=False):
     """Retrieve a list of networks.
 
     The contents of the list depends on the identity of the user
@@ -179,11 +190,20 @@ def get_networks(context, filters=None, fields=None):
         network dictionary as listed in the RESOURCE_ATTRIBUTE_MAP
         object in neutron/api/v2/attributes.py. Only these fields
         will be returned.
+    : param sorts: a list of (key, ascending) pairs to order the networks
+        by, on top of the id.
+    : param limit: the most networks to return.
+    : param marker: the id of the last network of the previous page.
+    : param page_reverse: return the page before the marker instead.
     """
     LOG.info("get_networks for tenant %s with filters %s, fields %s" %
             (context.tenant_id, filters, fields))
-    nets = db_api.network_find(context, **filters) or []
-    nets = [v._make_network_dict(net) for net in nets]
+    nets = db_api.network_find(context, fields=fields, sorts=sorts,
+                               limit=limit, marker=marker,
+                               page_reverse=page_reverse, **filters) or []
+    nets = [v._make_network_dict(net, fields) for net in nets]
+    if page_reverse:
+        nets.reverse()
     return nets
 
 
@@ -206,7 +226,9 @@ def get_networks_count(context, filters=None):
     """
     LOG.info("get_networks_count for tenant %s filters %s" %
             (context.tenant_id, filters))
-    return db_api.network_count_all(context)
+    return db_api.network_count_all(context,
+                                    approximate=CONF.QUARK.tenant_counts,
+                                    **(filters or {}))
 
 
 def delete_network(context, id):
@@ -244,6 +266,8 @@ def _diag_network(context, network, fields):
     if 'config' in fields or 'status' in fields:
         net.update(net_driver.diag_network(
             context, net['id'], get_status='status' in fields))
+    if 'backend' in fields:
+        net['backend'] = net_driver.diag_backend(context)
     return net
 
 
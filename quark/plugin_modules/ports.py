@@ -21,6 +21,7 @@ from neutron.openstack.common import uuidutils
 from neutron import quota
 from oslo.config import cfg
 
+from quark import backend_ops
 from quark.db import api as db_api
 from quark.drivers import registry
 from quark import ipam
@@ -31,6 +32,84 @@ CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
 
+def _find_port_network(context, net_id, segment_id):
+    net = db_api.network_find(context, id=net_id, segment_id=segment_id,
+                              scope=db_api.ONE)
+    if not net:
+        # Maybe it's a tenant network
+        net = db_api.network_find(context, id=net_id, scope=db_api.ONE)
+        if not net:
+            raise exceptions.NetworkNotFound(net_id=net_id)
+    return net
+
+
+def _allocate_port_addresses(context, net, ipam_driver, port_id, port_attrs,
+                             mac_address=None, fixed_ips=None,
+                             addresses=None):
+    # NOTE(jkoelker) addresses is passed when the port was allocated as
+    #                part of a batch
+    if addresses is None and fixed_ips:
+        addresses = []
+        for fixed_ip in fixed_ips:
+            subnet_id = fixed_ip.get("subnet_id")
+            ip_address = fixed_ip.get("ip_address")
+            if not (subnet_id and ip_address):
+                raise exceptions.BadRequest(
+                    resource="fixed_ips",
+                    msg="subnet_id and ip_address required")
+            addresses.extend(ipam_driver.allocate_ip_address(
+                context, net["id"], port_id, CONF.QUARK.ipam_reuse_after,
+                ip_address=ip_address))
+    elif addresses is None:
+        addresses = ipam_driver.allocate_ip_address(
+            context, net["id"], port_id, CONF.QUARK.ipam_reuse_after)
+
+    group_ids, security_groups = v.make_security_group_list(
+        context, port_attrs.pop("security_groups", None))
+    mac = ipam_driver.allocate_mac_address(context, net["id"], port_id,
+                                           CONF.QUARK.ipam_reuse_after,
+                                           mac_address=mac_address)
+    return addresses, mac, group_ids, security_groups
+
+
+def _address_pairs(mac, addresses):
+    mac_address_string = str(netaddr.EUI(mac['address'],
+                                         dialect=netaddr.mac_unix))
+    return [{'mac_address': mac_address_string,
+             'ip_address': address.get('address_readable', '')}
+            for address in addresses]
+
+
+def _create_backend_port(context, net, port_id, group_ids, mac, addresses):
+    allowed_pairs = _address_pairs(mac, addresses)
+    if CONF.QUARK.backend_outbox:
+        backend_ops.enqueue(context, "create_port", port_id,
+                            net["network_plugin"], network_id=net["id"],
+                            port_id=port_id, security_groups=group_ids,
+                            allowed_pairs=allowed_pairs)
+        # NOTE(jkoelker) The port id stands in for the backend key until
+        #                the outbox worker records the real one.
+        return {"uuid": port_id}
+
+    net_driver = registry.DRIVER_REGISTRY.get_driver(net["network_plugin"])
+    return net_driver.create_port(context, net["id"], port_id=port_id,
+                                  security_groups=group_ids,
+                                  allowed_pairs=allowed_pairs)
+
+
+def _create_port_record(context, net, port_id, port_attrs, addresses, mac,
+                        security_groups, backend_port):
+    port_attrs["network_id"] = net["id"]
+    port_attrs["id"] = port_id
+    port_attrs["security_groups"] = security_groups
+
+    LOG.info("Including extra plugin attrs: %s" % backend_port)
+    port_attrs.update(backend_port)
+    return db_api.port_create(
+        context, addresses=addresses, mac_address=mac["address"],
+        backend_key=backend_port["uuid"], **port_attrs)
+
+
 def create_port(context, port):
     """Create a port
 
@@ -48,69 +127,126 @@ def create_port(context, port):
     segment_id = utils.pop_param(port_attrs, "segment_id")
     fixed_ips = utils.pop_param(port_attrs, "fixed_ips")
     net_id = port_attrs["network_id"]
-    addresses = []
 
     with context.session.begin():
         port_id = uuidutils.generate_uuid()
 
-        net = db_api.network_find(context, id=net_id,
-                                  segment_id=segment_id, scope=db_api.ONE)
-        if not net:
-            # Maybe it's a tenant network
-            net = db_api.network_find(context, id=net_id, scope=db_api.ONE)
-            if not net:
-                raise exceptions.NetworkNotFound(net_id=net_id)
+        net = _find_port_network(context, net_id, segment_id)
 
         quota.QUOTAS.limit_check(
             context, context.tenant_id,
             ports_per_network=len(net.get('ports', [])) + 1)
 
         ipam_driver = ipam.IPAM_REGISTRY.get_strategy(net["ipam_strategy"])
-        if fixed_ips:
-            for fixed_ip in fixed_ips:
-                subnet_id = fixed_ip.get("subnet_id")
-                ip_address = fixed_ip.get("ip_address")
-                if not (subnet_id and ip_address):
-                    raise exceptions.BadRequest(
-                        resource="fixed_ips",
-                        msg="subnet_id and ip_address required")
-                addresses.extend(ipam_driver.allocate_ip_address(
-                    context, net["id"], port_id, CONF.QUARK.ipam_reuse_after,
-                    ip_address=ip_address))
-        else:
-            addresses.extend(ipam_driver.allocate_ip_address(
-                context, net["id"], port_id, CONF.QUARK.ipam_reuse_after))
+        addresses, mac, group_ids, security_groups = _allocate_port_addresses(
+            context, net, ipam_driver, port_id, port_attrs,
+            mac_address=mac_address, fixed_ips=fixed_ips)
 
-        group_ids, security_groups = v.make_security_group_list(
-            context, port["port"].pop("security_groups", None))
-        mac = ipam_driver.allocate_mac_address(context, net["id"], port_id,
-                                               CONF.QUARK.ipam_reuse_after,
-                                               mac_address=mac_address)
-        mac_address_string = str(netaddr.EUI(mac['address'],
-                                             dialect=netaddr.mac_unix))
-        address_pairs = [{'mac_address': mac_address_string,
-                          'ip_address': address.get('address_readable', '')}
-                         for address in addresses]
-        net_driver = registry.DRIVER_REGISTRY.get_driver(net["network_plugin"])
-        backend_port = net_driver.create_port(context, net["id"],
-                                              port_id=port_id,
-                                              security_groups=group_ids,
-                                              allowed_pairs=address_pairs)
-
-        port_attrs["network_id"] = net["id"]
-        port_attrs["id"] = port_id
-        port_attrs["security_groups"] = security_groups
-
-        LOG.info("Including extra plugin attrs: %s" % backend_port)
-        port_attrs.update(backend_port)
-        new_port = db_api.port_create(
-            context, addresses=addresses, mac_address=mac["address"],
-            backend_key=backend_port["uuid"], **port_attrs)
+        backend_port = _create_backend_port(context, net, port_id,
+                                            group_ids, mac, addresses)
+
+        new_port = _create_port_record(context, net, port_id, port_attrs,
+                                       addresses, mac, security_groups,
+                                       backend_port)
 
         # Include any driver specific bits
     return v._make_port_dict(new_port)
 
 
+def _create_network_ports(context, net_id, segment_id, port_list):
+    net = _find_port_network(context, net_id, segment_id)
+
+    quota.QUOTAS.limit_check(
+        context, context.tenant_id,
+        ports_per_network=len(net.get('ports', [])) + len(port_list))
+
+    ipam_driver = ipam.IPAM_REGISTRY.get_strategy(net["ipam_strategy"])
+    port_ids = [uuidutils.generate_uuid() for _ in port_list]
+    mac_addresses = [utils.pop_param(port_attrs, "mac_address", None)
+                     for port_attrs in port_list]
+    fixed_ips = [utils.pop_param(port_attrs, "fixed_ips")
+                 for port_attrs in port_list]
+
+    # Ports asking for specific addresses get them one by one, the rest
+    # share a single pass through the IPAM strategy.
+    batched = [port_id for port_id, ips in zip(port_ids, fixed_ips)
+               if not ips]
+    batched = dict(zip(batched, ipam_driver.allocate_ip_addresses(
+        context, net["id"], batched, CONF.QUARK.ipam_reuse_after)))
+
+    allocated = []
+    for port_id, port_attrs, mac_address, ips in zip(
+            port_ids, port_list, mac_addresses, fixed_ips):
+        allocated.append(_allocate_port_addresses(
+            context, net, ipam_driver, port_id, port_attrs,
+            mac_address=mac_address, fixed_ips=ips,
+            addresses=batched.get(port_id)))
+
+    if CONF.QUARK.backend_outbox:
+        backend_ports = []
+        for port_id, (addresses, mac, group_ids, _) in zip(port_ids,
+                                                           allocated):
+            backend_ports.append(_create_backend_port(
+                context, net, port_id, group_ids, mac, addresses))
+    else:
+        backend_requests = []
+        for port_id, (addresses, mac, group_ids, _) in zip(port_ids,
+                                                           allocated):
+            backend_requests.append(dict(
+                port_id=port_id, security_groups=group_ids,
+                allowed_pairs=_address_pairs(mac, addresses)))
+        net_driver = registry.DRIVER_REGISTRY.get_driver(
+            net["network_plugin"])
+        backend_ports = net_driver.create_ports(context, net["id"],
+                                                backend_requests)
+
+    new_ports = []
+    for port_id, port_attrs, allocated_port, backend_port in zip(
+            port_ids, port_list, allocated, backend_ports):
+        addresses, mac, _, security_groups = allocated_port
+        new_ports.append(_create_port_record(
+            context, net, port_id, port_attrs, addresses, mac,
+            security_groups, backend_port))
+    return new_ports
+
+
+def create_port_bulk(context, ports):
+    """Create several ports at once.
+
+    Ports are grouped by network and segment. Each group has its network
+    looked up, its quota checked and its addresses allocated once, and its
+    backend ports created in a single driver call. The bulk is atomic, if
+    any port fails none of them are created.
+    : param context: neutron api request context
+    : param ports: dictionary with a "ports" key holding a list of port
+        dictionaries, each shaped like the port argument of create_port.
+    : returns: a list of the new port dictionaries, in the requested order.
+    """
+    LOG.info("create_port_bulk for tenant %s" % context.tenant_id)
+
+    port_list = [p["port"] for p in ports["ports"]]
+    groups = {}
+    group_order = []
+    for index, port_attrs in enumerate(port_list):
+        key = (port_attrs["network_id"],
+               utils.pop_param(port_attrs, "segment_id"))
+        if key not in groups:
+            groups[key] = []
+            group_order.append(key)
+        groups[key].append(index)
+
+    new_ports = [None] * len(port_list)
+    with context.session.begin():
+        for net_id, segment_id in group_order:
+            indexes = groups[(net_id, segment_id)]
+            created = _create_network_ports(
+                context, net_id, segment_id,
+                [port_list[index] for index in indexes])
+            for index, new_port in zip(indexes, created):
+                new_ports[index] = new_port
+    return [v._make_port_dict(new_port) for new_port in new_ports]
+
+
 def update_port(context, id, port):
     """Update values of a port.
 
@@ -239,10 +375,11 @@ def get_port(context, id, fields=None):
     if not results:
         raise exceptions.PortNotFound(port_id=id, net_id='')
 
-    return v._make_port_dict(results)
+    return v._make_port_dict(results, fields)
 
 
-def get_ports(context, filters=None, fields=None):
+def get_ports(context, filters=None, fields=None, sorts=None, limit=None,
+              marker=None, page_reverse=False):
     """Retrieve a list of ports.
 
     The contents of the list depends on the identity of the user
@@ -260,13 +397,23 @@ def get_ports(context, filters=None, fields=None):
         port dictionary as listed in the RESOURCE_ATTRIBUTE_MAP
         object in neutron/api/v2/attributes.py. Only these fields
         will be returned.
+    : param sorts: a list of (key, ascending) pairs to order the ports
+        by, on top of the id.
+    : param limit: the most ports to return.
+    : param marker: the id of the last port of the previous page.
+    : param page_reverse: return the page before the marker instead.
     """
     LOG.info("get_ports for tenant %s filters %s fields %s" %
             (context.tenant_id, filters, fields))
     if filters is None:
         filters = {}
-    query = db_api.port_find(context, fields=fields, **filters)
-    return v._make_ports_list(query, fields)
+    query = db_api.port_find(context, fields=fields, sorts=sorts,
+                             limit=limit, marker=marker,
+                             page_reverse=page_reverse, **filters)
+    ports = v._make_ports_list(query, fields)
+    if page_reverse:
+        ports.reverse()
+    return ports
 
 
 def get_ports_count(context, filters=None):
@@ -288,7 +435,9 @@ def get_ports_count(context, filters=None):
     """
     LOG.info("get_ports_count for tenant %s filters %s" %
             (context.tenant_id, filters))
-    return db_api.port_count_all(context, **filters)
+    return db_api.port_count_all(context,
+                                 approximate=CONF.QUARK.tenant_counts,
+                                 **(filters or {}))
 
 
 def delete_port(context, id):
@@ -313,6 +462,11 @@ def delete_port(context, id):
         ipam_driver.deallocate_ip_address(
             context, port, ipam_reuse_after=CONF.QUARK.ipam_reuse_after)
         db_api.port_delete(context, port)
+        if CONF.QUARK.backend_outbox:
+            backend_ops.enqueue(context, "delete_port", port["id"],
+                                port.network["network_plugin"],
+                                port_id=port["id"], backend_key=backend_key)
+            return
         net_driver = registry.DRIVER_REGISTRY.get_driver(
             port.network["network_plugin"])
         net_driver.delete_port(context, backend_key)
@@ -207,8 +207,14 @@ def get_security_groups(context, filters=None, fields=None,
                         page_reverse=False):
     LOG.info("get_security_groups for tenant %s" %
             (context.tenant_id))
-    groups = db_api.security_group_find(context, **filters)
-    return [v._make_security_group_dict(group) for group in groups]
+    groups = db_api.security_group_find(context, fields=fields, sorts=sorts,
+                                        limit=limit, marker=marker,
+                                        page_reverse=page_reverse,
+                                        **filters)
+    groups = [v._make_security_group_dict(group, fields) for group in groups]
+    if page_reverse:
+        groups.reverse()
+    return groups
 
 
 def get_security_group_rules(context, filters=None, fields=None,
@@ -216,8 +222,15 @@ def get_security_group_rules(context, filters=None, fields=None,
                              page_reverse=False):
     LOG.info("get_security_group_rules for tenant %s" %
             (context.tenant_id))
-    rules = db_api.security_group_rule_find(context, **filters)
-    return [v._make_security_group_rule_dict(rule) for rule in rules]
+    rules = db_api.security_group_rule_find(context, sorts=sorts, limit=limit,
+                                            marker=marker,
+                                            page_reverse=page_reverse,
+                                            **filters)
+    rules = [v._make_security_group_rule_dict(rule, fields)
+             for rule in rules]
+    if page_reverse:
+        rules.reverse()
+    return rules
 
 
 def update_security_group(context, id, security_group, net_driver):
@@ -19,13 +19,14 @@ from neutron.common import config as neutron_cfg
 from neutron.common import exceptions
 from neutron.openstack.common import importutils
 from neutron.openstack.common import log as logging
-from neutron.openstack.common.notifier import api as notifier_api
 from neutron.openstack.common import timeutils
 
 from oslo.config import cfg
 
 from quark.db import api as db_api
+from quark import intervals
 from quark import network_strategy
+from quark import notifications
 from quark.plugin_modules import routes
 from quark import plugin_views as v
 from quark import utils
@@ -121,16 +122,15 @@ def create_subnet(context, subnet):
                 context, ip=netaddr.IPAddress(dns_ip)))
 
         if isinstance(allocation_pools, list):
-            ranges = []
-            cidrset = netaddr.IPSet([netaddr.IPNetwork(new_subnet["cidr"])])
-            for p in allocation_pools:
-                cidrset -= netaddr.IPSet(netaddr.IPRange(p["start"], p["end"]))
-            non_allocation_pools = v._pools_from_cidr(cidrset)
-            for p in non_allocation_pools:
-                r = netaddr.IPRange(p["start"], p["end"])
-                ranges.append(dict(
-                    length=len(r),
-                    offset=int(r[0]) - int(cidr[0])))
+            pools = [(int(netaddr.IPAddress(p["start"])),
+                      int(netaddr.IPAddress(p["end"])))
+                     for p in allocation_pools]
+            non_allocation_pools = intervals.difference(
+                intervals.from_network(netaddr.IPNetwork(new_subnet["cidr"])),
+                pools)
+            ranges = [dict(length=last - first + 1,
+                           offset=first - int(cidr[0]))
+                      for first, last in non_allocation_pools]
             new_subnet["ip_policy"] = db_api.ip_policy_create(context,
                                                               exclude=ranges)
 
@@ -138,13 +138,10 @@ def create_subnet(context, subnet):
                                       default_route=routes.DEFAULT_ROUTE)
     subnet_dict["gateway_ip"] = gateway_ip
 
-    notifier_api.notify(context,
-                        notifier_api.publisher_id("network"),
-                        "ip_block.create",
-                        notifier_api.CONF.default_notification_level,
-                        dict(tenant_id=subnet_dict["tenant_id"],
-                             ip_block_id=subnet_dict["id"],
-                             created_at=new_subnet["created_at"]))
+    notifications.notify(context, "ip_block.create",
+                         dict(tenant_id=subnet_dict["tenant_id"],
+                              ip_block_id=subnet_dict["id"],
+                              created_at=new_subnet["created_at"]))
 
     return subnet_dict
 
@@ -233,7 +230,8 @@ def get_subnet(context, id, fields=None):
     return v._make_subnet_dict(subnet, default_route=routes.DEFAULT_ROUTE)
 
 
-def get_subnets(context, filters=None, fields=None):
+def get_subnets(context, filters=None, fields=None, sorts=None, limit=None,
+                marker=None, page_reverse=False):
     """Retrieve a list of subnets.
 
     The contents of the list depends on the identity of the user
@@ -251,12 +249,22 @@ def get_subnets(context, filters=None, fields=None):
         subnet dictionary as listed in the RESOURCE_ATTRIBUTE_MAP
         object in neutron/api/v2/attributes.py. Only these fields
         will be returned.
+    : param sorts: a list of (key, ascending) pairs to order the subnets
+        by, on top of the id.
+    : param limit: the most subnets to return.
+    : param marker: the id of the last subnet of the previous page.
+    : param page_reverse: return the page before the marker instead.
     """
     LOG.info("get_subnets for tenant %s with filters %s fields %s" %
             (context.tenant_id, filters, fields))
-    subnets = db_api.subnet_find(context, **filters)
-    return v._make_subnets_list(subnets, fields=fields,
-                                default_route=routes.DEFAULT_ROUTE)
+    subnets = db_api.subnet_find(context, fields=fields, sorts=sorts,
+                                 limit=limit, marker=marker,
+                                 page_reverse=page_reverse, **filters)
+    subnets = v._make_subnets_list(subnets, fields=fields,
+                                   default_route=routes.DEFAULT_ROUTE)
+    if page_reverse:
+        subnets.reverse()
+    return subnets
 
 
 def get_subnets_count(context, filters=None):
@@ -278,7 +286,9 @@ def get_subnets_count(context, filters=None):
     """
     LOG.info("get_subnets_count for tenant %s with filters %s" %
             (context.tenant_id, filters))
-    return db_api.subnet_count_all(context, **filters)
+    return db_api.subnet_count_all(context,
+                                   approximate=CONF.QUARK.tenant_counts,
+                                   **(filters or {}))
 
 
 def _delete_subnet(context, subnet):
@@ -306,11 +316,7 @@ def delete_subnet(context, id):
 
         _delete_subnet(context, subnet)
 
-        notifier_api.notify(context,
-                            notifier_api.publisher_id("network"),
-                            "ip_block.delete",
-                            notifier_api.CONF.default_notification_level,
-                            payload)
+        notifications.notify(context, "ip_block.delete", payload)
 
 
 def diagnose_subnet(context, id, fields):
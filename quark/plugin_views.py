@@ -24,6 +24,7 @@ from neutron.openstack.common import log as logging
 
 from quark.db import api as db_api
 from quark.db import models
+from quark import intervals
 from quark import network_strategy
 from quark import utils
 
@@ -31,125 +32,114 @@ LOG = logging.getLogger(__name__)
 STRATEGY = network_strategy.STRATEGY
 
 
-def _make_network_dict(network, fields=None):
-    shared_net = STRATEGY.is_parent_network(network["id"])
-    res = {"id": network["id"],
-           "name": network.get("name"),
-           "tenant_id": network.get("tenant_id"),
-           "admin_state_up": None,
-           "ipam_strategy": network.get("ipam_strategy"),
-           "status": "ACTIVE",
-           "shared": shared_net,
-           #TODO(mdietz): this is the expected return. Then the client
-           #              foolishly turns around and asks for the entire
-           #              subnet list anyway! Plz2fix
-           "subnets": [s["id"] for s in network.get("subnets", [])]}
-    return res
+def _wanted(fields, key):
+    """Whether key was asked for, every key is without fields."""
+    return not fields or key in fields
 
 
-def _pools_from_cidr(cidr):
-    cidrs = cidr.iter_cidrs()
-    if len(cidrs) == 0:
-        return []
-    if len(cidrs) == 1:
-        return [dict(start=str(cidrs[0][0]),
-                     end=str(cidrs[0][-1]))]
-
-    pool_start = cidrs[0][0]
-    prev_cidr_end = cidrs[0][-1]
-    pools = []
-    for cidr in cidrs[1:]:
-        cidr_start = cidr[0]
-        if prev_cidr_end + 1 != cidr_start:
-            pools.append(dict(start=str(pool_start),
-                              end=str(prev_cidr_end)))
-            pool_start = cidr_start
-        prev_cidr_end = cidr[-1]
-    pools.append(dict(start=str(pool_start), end=str(prev_cidr_end)))
-    return pools
+def _pick(model, keys, fields):
+    return dict((key, model.get(key)) for key in keys
+                if _wanted(fields, key))
 
 
-def _make_subnet_dict(subnet, default_route=None, fields=None):
-    dns_nameservers = [str(netaddr.IPAddress(dns["ip"]))
-                       for dns in subnet.get("dns_nameservers")]
-    net_id = STRATEGY.get_parent_network(subnet["network_id"])
+def _make_network_dict(network, fields=None):
+    res = _pick(network, ("name", "tenant_id", "ipam_strategy"), fields)
+    if _wanted(fields, "id"):
+        res["id"] = network["id"]
+    if _wanted(fields, "admin_state_up"):
+        res["admin_state_up"] = None
+    if _wanted(fields, "status"):
+        res["status"] = "ACTIVE"
+    if _wanted(fields, "shared"):
+        res["shared"] = STRATEGY.is_parent_network(network["id"])
+    #TODO(mdietz): this is the expected return. Then the client
+    #              foolishly turns around and asks for the entire
+    #              subnet list anyway! Plz2fix
+    if _wanted(fields, "subnets"):
+        res["subnets"] = [s["id"] for s in network.get("subnets", [])]
+    return res
+
 
+def _make_subnet_dict(subnet, default_route=None, fields=None):
     def _allocation_pools(subnet):
-        ip_policy_rules = models.IPPolicy.get_ip_policy_rule_set(subnet)
-        cidr = netaddr.IPSet([netaddr.IPNetwork(subnet["cidr"])])
-        allocatable = cidr - ip_policy_rules
-        return _pools_from_cidr(allocatable)
-
-    res = {"id": subnet.get("id"),
-           "name": subnet.get("name"),
-           "tenant_id": subnet.get("tenant_id"),
-           "network_id": net_id,
-           "ip_version": subnet.get("ip_version"),
-           "allocation_pools": _allocation_pools(subnet),
-           "dns_nameservers": dns_nameservers or [],
-           "cidr": subnet.get("cidr"),
-           "shared": STRATEGY.is_parent_network(net_id),
-           "enable_dhcp": None}
+        excluded = models.IPPolicy.get_compiled_ip_policy(subnet).intervals
+        cidr = netaddr.IPNetwork(subnet["cidr"])
+        allocatable = intervals.difference(intervals.from_network(cidr),
+                                           excluded)
+        return intervals.to_pools(allocatable, cidr.version)
+
+    res = _pick(subnet, ("id", "name", "tenant_id", "ip_version", "cidr"),
+                fields)
+    if _wanted(fields, "network_id") or _wanted(fields, "shared"):
+        net_id = STRATEGY.get_parent_network(subnet["network_id"])
+        if _wanted(fields, "network_id"):
+            res["network_id"] = net_id
+        if _wanted(fields, "shared"):
+            res["shared"] = STRATEGY.is_parent_network(net_id)
+    if _wanted(fields, "allocation_pools"):
+        res["allocation_pools"] = _allocation_pools(subnet)
+    if _wanted(fields, "dns_nameservers"):
+        res["dns_nameservers"] = [str(netaddr.IPAddress(dns["ip"]))
+                                  for dns in subnet.get("dns_nameservers")]
+    if _wanted(fields, "enable_dhcp"):
+        res["enable_dhcp"] = None
 
     def _host_route(route):
         return {"destination": route["cidr"],
                 "nexthop": route["gateway"]}
 
-    res["host_routes"] = [_host_route(r) for r in subnet["routes"]]
+    if _wanted(fields, "host_routes"):
+        res["host_routes"] = [_host_route(r) for r in subnet["routes"]]
 
     #TODO(mdietz): really inefficient, should go away
-    res["gateway_ip"] = None
-    for route in subnet["routes"]:
-        netroute = netaddr.IPNetwork(route["cidr"])
-        if netroute.value == default_route.value:
-            res["gateway_ip"] = route["gateway"]
-            break
+    if _wanted(fields, "gateway_ip"):
+        res["gateway_ip"] = None
+        for route in subnet["routes"]:
+            netroute = netaddr.IPNetwork(route["cidr"])
+            if netroute.value == default_route.value:
+                res["gateway_ip"] = route["gateway"]
+                break
     return res
 
 
 def _make_security_group_dict(security_group, fields=None):
-    res = {"id": security_group.get("id"),
-           "description": security_group.get("description"),
-           "name": security_group.get("name"),
-           "tenant_id": security_group.get("tenant_id")}
-    res["security_group_rules"] = [
-        r.id for r in security_group["rules"]]
+    res = _pick(security_group, ("id", "description", "name", "tenant_id"),
+                fields)
+    if _wanted(fields, "security_group_rules"):
+        res["security_group_rules"] = [
+            r.id for r in security_group["rules"]]
     return res
 
 
 def _make_security_group_rule_dict(security_rule, fields=None):
-    res = {"id": security_rule.get("id"),
-           "ethertype": security_rule.get("ethertype"),
-           "direction": security_rule.get("direction"),
-           "tenant_id": security_rule.get("tenant_id"),
-           "port_range_max": security_rule.get("port_range_max"),
-           "port_range_min": security_rule.get("port_range_min"),
-           "protocol": security_rule.get("protocol"),
-           "remote_ip_prefix": security_rule.get("remote_ip_prefix"),
-           "security_group_id": security_rule.get("group_id"),
-           "remote_group_id": security_rule.get("remote_group_id")}
+    res = _pick(security_rule, ("id", "ethertype", "direction", "tenant_id",
+                                "port_range_max", "port_range_min",
+                                "protocol", "remote_ip_prefix",
+                                "remote_group_id"), fields)
+    if _wanted(fields, "security_group_id"):
+        res["security_group_id"] = security_rule.get("group_id")
     return res
 
 
 def _port_dict(port, fields=None):
-    res = {"id": port.get("id"),
-           "name": port.get("name"),
-           "network_id": STRATEGY.get_parent_network(port["network_id"]),
-           "tenant_id": port.get("tenant_id"),
-           "mac_address": port.get("mac_address"),
-           "admin_state_up": port.get("admin_state_up"),
-           "status": "ACTIVE",
-           "security_groups": [group.get("id", None) for group in
-                               port.get("security_groups", None)],
-           "device_id": port.get("device_id"),
-           "device_owner": port.get("device_owner")}
-
-    if "mac_address" in res and res["mac_address"]:
-        mac = str(netaddr.EUI(res["mac_address"])).replace('-', ':')
-        res["mac_address"] = mac
+    res = _pick(port, ("id", "name", "tenant_id", "admin_state_up",
+                       "device_id", "device_owner"), fields)
+    if _wanted(fields, "network_id"):
+        res["network_id"] = STRATEGY.get_parent_network(port["network_id"])
+    if _wanted(fields, "status"):
+        res["status"] = port.get("status") or "ACTIVE"
+    if _wanted(fields, "security_groups"):
+        res["security_groups"] = [group.get("id", None) for group in
+                                  port.get("security_groups", None)]
+
+    if _wanted(fields, "mac_address"):
+        res["mac_address"] = port.get("mac_address")
+        if res["mac_address"]:
+            mac = str(netaddr.EUI(res["mac_address"])).replace('-', ':')
+            res["mac_address"] = mac
 
     #NOTE(mdietz): more pythonic key in dict check fails here. Leave as get
-    if port.get("bridge"):
+    if _wanted(fields, "bridge") and port.get("bridge"):
         res["bridge"] = port["bridge"]
     return res
 
@@ -160,20 +150,15 @@ def _make_port_address_dict(ip):
 
 
 def _make_port_dict(port, fields=None):
-    res = _port_dict(port)
-    res["fixed_ips"] = [_make_port_address_dict(ip)
-                        for ip in port.ip_addresses]
+    res = _port_dict(port, fields)
+    if _wanted(fields, "fixed_ips"):
+        res["fixed_ips"] = [_make_port_address_dict(ip)
+                            for ip in port.ip_addresses]
     return res
 
 
 def _make_ports_list(query, fields=None):
-    ports = []
-    for port in query:
-        port_dict = _port_dict(port, fields)
-        port_dict["fixed_ips"] = [_make_port_address_dict(addr)
-                                  for addr in port.ip_addresses]
-        ports.append(port_dict)
-    return ports
+    return [_make_port_dict(port, fields) for port in query]
 
 
 def _make_subnets_list(query, default_route=None, fields=None):
@@ -392,3 +392,20 @@ class TestQuarkDiagnoseNetworks(test_quark_plugin.TestQuarkPlugin):
                 nets = self.plugin.diagnose_network(self.context, "*", {})
                 for key in net.keys():
                     self.assertEqual(nets['networks'][0][key], net[key])
+
+
+class TestQuarkCreateNetworkBulk(test_quark_plugin.TestQuarkPlugin):
+    def test_create_network_bulk_undoes_created_networks(self):
+        networks = dict(networks=[dict(network=dict(name="a")),
+                                  dict(network=dict(name="b"))])
+        with contextlib.nested(
+            mock.patch.object(self.plugin, "create_network"),
+            mock.patch.object(self.plugin, "delete_network")
+        ) as (create_network, delete_network):
+            create_network.side_effect = [dict(id=1),
+                                          exceptions.BadRequest(
+                                              resource="networks",
+                                              msg="nope")]
+            with self.assertRaises(exceptions.BadRequest):
+                self.plugin.create_network_bulk(self.context, networks)
+            delete_network.assert_called_once_with(self.context, 1)
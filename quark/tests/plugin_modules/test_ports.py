@@ -19,6 +19,7 @@ import mock
 from neutron.api.v2 import attributes as neutron_attrs
 from neutron.common import exceptions
 from neutron.extensions import securitygroup as sg_ext
+from oslo.config import cfg
 
 from quark.db import api as quark_db_api
 from quark.db import models
@@ -91,6 +92,14 @@ class TestQuarkGetPorts(test_quark_plugin.TestQuarkPlugin):
             self.assertEqual(fixed_ips[0]["ip_address"],
                              ip["address_readable"])
 
+    def test_port_list_with_fields(self):
+        port = dict(mac_address="AA:BB:CC:DD:EE:FF", network_id=1,
+                    tenant_id=self.context.tenant_id, device_id=2, id=1)
+        with self._stubs(ports=[port]):
+            ports = self.plugin.get_ports(self.context, filters=None,
+                                          fields=["id", "device_id"])
+            self.assertEqual(ports, [dict(id=1, device_id=2)])
+
     def test_port_show(self):
         ip = dict(id=1, address=3232235876, address_readable="192.168.1.100",
                   subnet_id=1, network_id=2, version=4)
@@ -298,6 +307,112 @@ class TestQuarkCreatePort(test_quark_plugin.TestQuarkPlugin):
         with self.assertRaises(sg_ext.SecurityGroupNotFound):
             self.test_create_port_security_groups([])
 
+    def test_create_port_backend_outbox(self):
+        network = dict(id=1)
+        mac = dict(address="AA:BB:CC:DD:EE:FF")
+        port = dict(port=dict(mac_address=mac["address"], network_id=1,
+                              tenant_id=self.context.tenant_id, device_id=2))
+        cfg.CONF.set_override("backend_outbox", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "backend_outbox", "QUARK")
+        with self._stubs(port=port["port"], network=network, addr=dict(),
+                         mac=mac) as port_create:
+            with contextlib.nested(
+                mock.patch("quark.db.api.backend_op_create"),
+                mock.patch("quark.drivers.base.BaseDriver.create_port")
+            ) as (op_create, driver_create):
+                self.plugin.create_port(self.context, port)
+                self.assertFalse(driver_create.called)
+                self.assertEqual(op_create.call_args[1]["operation"],
+                                 "create_port")
+                port_id = op_create.call_args[1]["resource_id"]
+                self.assertEqual(port_create.call_args[1]["backend_key"],
+                                 port_id)
+
+
+class TestQuarkCreatePortBulk(test_quark_plugin.TestQuarkPlugin):
+    @contextlib.contextmanager
+    def _stubs(self, networks=None, addrs=None, backend=None):
+        for network in (networks or {}).values():
+            network["network_plugin"] = "BASE"
+            network["ipam_strategy"] = "ANY"
+
+        def _port_create(context, **port_attrs):
+            port_model = models.Port()
+            port_model.update(port_attrs)
+            return port_model
+
+        def _network_find(context, id=None, **kwargs):
+            return (networks or {}).get(id)
+
+        db_mod = "quark.db.api"
+        ipam = "quark.ipam.QuarkIpam"
+        with contextlib.nested(
+            mock.patch("%s.port_create" % db_mod),
+            mock.patch("%s.network_find" % db_mod),
+            mock.patch("%s.allocate_ip_address" % ipam),
+            mock.patch("%s.allocate_mac_address" % ipam),
+            mock.patch("quark.drivers.base.BaseDriver.create_port"),
+            mock.patch("quark.drivers.base.BaseDriver.delete_port")
+        ) as (port_create, net_find, alloc_ip, alloc_mac, driver_create,
+              driver_delete):
+            port_create.side_effect = _port_create
+            net_find.side_effect = _network_find
+            alloc_ip.side_effect = addrs
+            alloc_mac.return_value = dict(address="AA:BB:CC:DD:EE:FF")
+            driver_create.side_effect = backend
+            yield port_create, alloc_ip, driver_delete
+
+    def _ports(self, count, network_id=1):
+        return dict(ports=[dict(port=dict(network_id=network_id,
+                                          tenant_id=self.context.tenant_id,
+                                          device_id=i))
+                           for i in xrange(count)])
+
+    def test_create_port_bulk(self):
+        with self._stubs(networks={1: dict(id=1)}, addrs=[[], []],
+                         backend=[dict(uuid=1), dict(uuid=2)]
+                         ) as (port_create, alloc_ip, driver_delete):
+            result = self.plugin.create_port_bulk(self.context,
+                                                  self._ports(2))
+            self.assertEqual(port_create.call_count, 2)
+            self.assertEqual(alloc_ip.call_count, 2)
+            self.assertEqual([r["device_id"] for r in result], [0, 1])
+
+    def test_create_port_bulk_multiple_networks(self):
+        ports = self._ports(1)
+        ports["ports"].extend(self._ports(2, network_id=2)["ports"])
+        ports["ports"].extend(self._ports(1)["ports"])
+        with self._stubs(networks={1: dict(id=1), 2: dict(id=2)},
+                         addrs=[[], [], [], []],
+                         backend=[dict(uuid=i) for i in xrange(4)]
+                         ) as (port_create, alloc_ip, driver_delete):
+            result = self.plugin.create_port_bulk(self.context, ports)
+            self.assertEqual([r["network_id"] for r in result],
+                             [1, 2, 2, 1])
+            self.assertEqual([r["device_id"] for r in result], [0, 0, 1, 0])
+
+    def test_create_port_bulk_allocation_failure(self):
+        failure = exceptions.IpAddressGenerationFailure(net_id=1)
+        with self._stubs(networks={1: dict(id=1)}, addrs=[[], failure]
+                         ) as (port_create, alloc_ip, driver_delete):
+            with self.assertRaises(exceptions.IpAddressGenerationFailure):
+                self.plugin.create_port_bulk(self.context, self._ports(2))
+            self.assertEqual(port_create.call_count, 0)
+
+    def test_create_port_bulk_backend_failure(self):
+        with self._stubs(networks={1: dict(id=1)}, addrs=[[], []],
+                         backend=[dict(uuid=1), Exception("nope")]
+                         ) as (port_create, alloc_ip, driver_delete):
+            with self.assertRaises(Exception):
+                self.plugin.create_port_bulk(self.context, self._ports(2))
+            self.assertEqual(port_create.call_count, 0)
+            self.assertEqual(driver_delete.call_count, 1)
+
+    def test_create_port_bulk_no_network_found(self):
+        with self._stubs(networks={}):
+            with self.assertRaises(exceptions.NetworkNotFound):
+                self.plugin.create_port_bulk(self.context, self._ports(1))
+
 
 class TestQuarkUpdatePort(test_quark_plugin.TestQuarkPlugin):
     @contextlib.contextmanager
@@ -0,0 +1,129 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+import contextlib
+import json
+
+import mock
+from oslo.config import cfg
+
+from quark import backend_ops
+from quark.tests import test_base
+
+
+class TestBackendOperations(test_base.TestBase):
+    def setUp(self):
+        super(TestBackendOperations, self).setUp()
+        cfg.CONF.set_override("backend_op_max_attempts", 2, "QUARK")
+        self.worker = backend_ops.BackendOperationWorker()
+        self.worker.owner = "host:1"
+        self.context = mock.MagicMock()
+
+    def tearDown(self):
+        super(TestBackendOperations, self).tearDown()
+        cfg.CONF.clear_override("backend_op_max_attempts", "QUARK")
+
+    def _op(self, operation, attempts=1, **payload):
+        payload["tenant_id"] = "tenant"
+        return dict(id=1, operation=operation, resource_id="res",
+                    network_plugin="BASE", attempts=attempts,
+                    payload=json.dumps(payload))
+
+    @contextlib.contextmanager
+    def _stubs(self, ops=None, created=None):
+        driver = mock.Mock()
+        with contextlib.nested(
+            mock.patch("neutron.context.Context"),
+            mock.patch("neutron.context.get_admin_context"),
+            mock.patch("quark.drivers.registry.DRIVER_REGISTRY.get_driver"),
+            mock.patch("quark.db.api.backend_op_runnable"),
+            mock.patch("quark.db.api.backend_op_claim"),
+            mock.patch("quark.db.api.backend_op_finish"),
+            mock.patch("quark.db.api.backend_op_find"),
+            mock.patch("quark.db.api.port_find"),
+            mock.patch("quark.db.api.port_update")
+        ) as (context_cls, admin, get_driver, runnable, claim, finish, find,
+              port_find, port_update):
+            admin.return_value = self.context
+            get_driver.return_value = driver
+            runnable.return_value = ops or []
+            claim.return_value = True
+            find.return_value = created
+            yield driver, finish, port_update
+
+    def test_enqueue(self):
+        self.context.tenant_id = "tenant"
+        with mock.patch("quark.db.api.backend_op_create") as create:
+            backend_ops.enqueue(self.context, "delete_port", "res", "BASE",
+                                port_id="res", backend_key="key")
+        kwargs = create.call_args[1]
+        self.assertEqual(kwargs["operation"], "delete_port")
+        self.assertEqual(kwargs["resource_id"], "res")
+        self.assertEqual(json.loads(kwargs["payload"]),
+                         dict(port_id="res", backend_key="key",
+                              tenant_id="tenant"))
+
+    def test_run_once_create_port_done(self):
+        op = self._op("create_port", network_id="net", port_id="res",
+                      security_groups=[], allowed_pairs=[])
+        with self._stubs(ops=[op]) as (driver, finish, port_update):
+            driver.create_port.return_value = {"uuid": "backend"}
+            self.assertEqual(self.worker.run_once(), 1)
+            self.assertEqual(port_update.call_args[1]["backend_key"],
+                             "backend")
+            self.assertEqual(finish.call_args[1]["state"], "done")
+            self.assertEqual(self.worker.succeeded, 1)
+
+    def test_run_once_unclaimed_skipped(self):
+        op = self._op("delete_port", port_id="res", backend_key="key")
+        with self._stubs(ops=[op]) as (driver, finish, port_update):
+            with mock.patch("quark.db.api.backend_op_claim") as claim:
+                claim.return_value = False
+                self.assertEqual(self.worker.run_once(), 0)
+            self.assertFalse(driver.delete_port.called)
+
+    def test_failure_retried(self):
+        op = self._op("delete_port", port_id="res", backend_key="key")
+        with self._stubs() as (driver, finish, port_update):
+            driver.delete_port.side_effect = Exception("boom")
+            self.worker._execute(self.context, op)
+            self.assertEqual(finish.call_args[1]["state"], "pending")
+            self.assertEqual(finish.call_args[1]["last_error"], "boom")
+            self.assertEqual(self.worker.retried, 1)
+
+    def test_failure_gives_up(self):
+        op = self._op("delete_port", attempts=2, port_id="res",
+                      backend_key="key")
+        with self._stubs() as (driver, finish, port_update):
+            driver.delete_port.side_effect = Exception("boom")
+            self.worker._execute(self.context, op)
+            self.assertEqual(finish.call_args[1]["state"], "failed")
+            self.assertEqual(self.worker.failed, 1)
+
+    def test_create_port_gives_up_marks_port_errored(self):
+        op = self._op("create_port", attempts=2, network_id="net",
+                      port_id="res", security_groups=[], allowed_pairs=[])
+        with self._stubs() as (driver, finish, port_update):
+            driver.create_port.side_effect = Exception("boom")
+            self.worker._execute(self.context, op)
+            self.assertEqual(finish.call_args[1]["state"], "failed")
+            self.assertEqual(port_update.call_args[1]["status"], "ERROR")
+
+    def test_delete_port_resolves_placeholder_key(self):
+        op = self._op("delete_port", port_id="res", backend_key="res")
+        created = dict(result=json.dumps({"uuid": "backend"}))
+        with self._stubs(created=created) as (driver, finish, port_update):
+            self.worker._execute(self.context, op)
+            driver.delete_port.assert_called_once_with(mock.ANY, "backend")
@@ -13,6 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+
+import mock
+
 from quark.drivers import base
 from quark.tests import test_base
 
@@ -51,6 +55,9 @@ class TestBaseDriver(test_base.TestBase):
         diag = self.driver.diag_port(self.context, network_id=1)
         self.assertEqual(diag, {})
 
+    def test_diag_backend(self):
+        self.assertEqual(self.driver.diag_backend(self.context), {})
+
     def test_create_security_group(self):
         self.driver.create_security_group(context=self.context,
                                           group_name="mygroup")
@@ -74,3 +81,20 @@ class TestBaseDriver(test_base.TestBase):
         self.driver.delete_security_group_rule(context=self.context,
                                                group_id=3,
                                                rule=rule)
+
+    def test_create_ports(self):
+        ports = self.driver.create_ports(self.context, 1,
+                                         [dict(port_id=2), dict(port_id=3)])
+        self.assertEqual(ports, [{"uuid": 2}, {"uuid": 3}])
+
+    def test_create_ports_failure_deletes_created(self):
+        with contextlib.nested(
+            mock.patch.object(self.driver, "create_port"),
+            mock.patch.object(self.driver, "delete_port")
+        ) as (create_port, delete_port):
+            create_port.side_effect = [{"uuid": 2}, Exception("nope")]
+            with self.assertRaises(Exception):
+                self.driver.create_ports(self.context, 1,
+                                         [dict(port_id=2), dict(port_id=3)])
+            delete_port.assert_called_once_with(self.context, 2,
+                                                lswitch_uuid=None)
@@ -0,0 +1,50 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+import mock
+
+from quark.bench import ipam as bench_ipam
+from quark.tests import test_base
+
+
+class TestIpamBenchReport(test_base.TestBase):
+    def _counter(self, statements=0, lock_wait=0.0):
+        counter = mock.Mock()
+        counter.statements = statements
+        counter.lock_wait = lock_wait
+        return counter
+
+    def test_percentile(self):
+        ordered = range(1, 101)
+        self.assertEqual(bench_ipam._percentile(ordered, 0.5), 51)
+        self.assertEqual(bench_ipam._percentile(ordered, 0.99), 99)
+        self.assertEqual(bench_ipam._percentile(ordered, 1.0), 100)
+
+    def test_percentile_empty(self):
+        self.assertEqual(bench_ipam._percentile([], 0.5), 0.0)
+
+    def test_report(self):
+        report = bench_ipam._report([0.002, 0.001, 0.003], 0.5,
+                                    self._counter(12, 0.25))
+        self.assertEqual(report["operations"], 3)
+        self.assertEqual(report["operations_per_second"], 6.0)
+        self.assertEqual(report["statements_per_operation"], 4.0)
+        self.assertEqual(report["lock_wait_ms"], 250.0)
+        self.assertEqual(report["latency_ms"]["max"], 3.0)
+
+    def test_report_no_operations(self):
+        report = bench_ipam._report([], 0, self._counter())
+        self.assertEqual(report["operations_per_second"], 0.0)
+        self.assertEqual(report["statements_per_operation"], 0.0)
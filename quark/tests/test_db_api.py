@@ -14,10 +14,14 @@
 #  under the License.
 
 import mock
+import netaddr
 from neutron.db import api as neutron_db_api
+from neutron.openstack.common.db.sqlalchemy import session as neutron_session
 from oslo.config import cfg
 
 from quark.db import api as db_api
+from quark.db import models
+from quark import exceptions as q_exc
 
 from quark.tests import test_base
 
@@ -45,3 +49,252 @@ class TestDBAPI(test_base.TestBase):
         query_obj = self.context.session.query.return_value
         filter_fn = query_obj.filter
         self.assertEqual(filter_fn.call_count, 1)
+
+    def test_ip_address_create_increments_subnet_count(self):
+        self.context.session.add = mock.Mock()
+        self.context.session.query = mock.Mock()
+        db_api.ip_address_create(self.context, address=netaddr.IPAddress(1),
+                                 subnet_id=1)
+        query_obj = self.context.session.query.return_value
+        update_fn = query_obj.filter.return_value.update
+        self.assertEqual(update_fn.call_count, 1)
+        self.assertIn("allocated_count", update_fn.call_args[0][0])
+        increment = update_fn.call_args[0][0]["allocated_count"]
+        self.assertIn("coalesce", str(increment))
+
+    def test_ip_address_delete_decrements_subnet_count(self):
+        self.context.session.delete = mock.Mock()
+        self.context.session.query = mock.Mock()
+        address = dict(id=1, subnet_id=1)
+        db_api.ip_address_delete(self.context, address)
+        query_obj = self.context.session.query.return_value
+        update_fn = query_obj.filter.return_value.update
+        self.assertEqual(update_fn.call_count, 1)
+        self.context.session.delete.assert_called_once_with(address)
+
+    def test_mac_address_create_increments_range_count(self):
+        self.context.session.add = mock.Mock()
+        self.context.session.query = mock.Mock()
+        db_api.mac_address_create(self.context, address=1,
+                                  mac_address_range_id=1)
+        query_obj = self.context.session.query.return_value
+        update_fn = query_obj.filter.return_value.update
+        self.assertEqual(update_fn.call_count, 1)
+
+    def test_subnet_reset_policy_excluded_count_no_filters(self):
+        self.context.session.query = mock.Mock()
+        db_api.subnet_reset_policy_excluded_count(self.context)
+        self.assertFalse(self.context.session.query.called)
+
+
+class TestDBAPIPagination(test_base.TestBase):
+    def setUp(self):
+        super(TestDBAPIPagination, self).setUp()
+        cfg.CONF.set_override('connection', 'sqlite://', 'database')
+        neutron_db_api.configure_db()
+        models.BASEV2.metadata.create_all(neutron_session._ENGINE)
+        for i in xrange(5):
+            self.context.session.add(models.Network(
+                id="net%d" % i, tenant_id=self.context.tenant_id))
+        for i in xrange(4):
+            self.context.session.add(models.Port(
+                id="port%d" % i, network_id="net%d" % (3 - i / 2),
+                tenant_id=self.context.tenant_id, backend_key="key",
+                device_id="dev"))
+        self.context.session.flush()
+
+    def tearDown(self):
+        super(TestDBAPIPagination, self).tearDown()
+        neutron_db_api.clear_db()
+
+    def _ids(self, rows):
+        return [row["id"] for row in rows]
+
+    def test_pages(self):
+        first = db_api.network_find(self.context, limit=2, scope=db_api.ALL)
+        self.assertEqual(self._ids(first), ["net0", "net1"])
+        second = db_api.network_find(self.context, limit=2, marker="net1",
+                                     scope=db_api.ALL)
+        self.assertEqual(self._ids(second), ["net2", "net3"])
+        last = db_api.network_find(self.context, limit=2, marker="net3",
+                                   scope=db_api.ALL)
+        self.assertEqual(self._ids(last), ["net4"])
+
+    def test_page_reverse(self):
+        page = db_api.network_find(self.context, limit=2, marker="net3",
+                                   page_reverse=True, scope=db_api.ALL)
+        self.assertEqual(self._ids(page), ["net2", "net1"])
+
+    def test_sort_breaks_ties_by_id(self):
+        sorts = [("network_id", True)]
+        first = db_api.port_find(self.context, sorts=sorts, limit=3,
+                                 scope=db_api.ALL)
+        self.assertEqual(self._ids(first), ["port2", "port3", "port0"])
+        second = db_api.port_find(self.context, sorts=sorts, limit=3,
+                                  marker="port0", scope=db_api.ALL)
+        self.assertEqual(self._ids(second), ["port1"])
+
+    def test_sort_descending(self):
+        page = db_api.port_find(self.context, sorts=[("network_id", False)],
+                                limit=2, marker="port0", scope=db_api.ALL)
+        self.assertEqual(self._ids(page), ["port1", "port2"])
+
+    def test_unknown_sort_key(self):
+        with self.assertRaises(q_exc.InvalidSortKey):
+            db_api.port_find(self.context, sorts=[("fixed_ips", True)],
+                             scope=db_api.ALL)
+
+    def test_sort_unindexed_key_with_nulls(self):
+        port = db_api.port_find(self.context, id=["port1"],
+                                scope=db_api.ONE)
+        port["name"] = "b"
+        port = db_api.port_find(self.context, id=["port2"],
+                                scope=db_api.ONE)
+        port["name"] = "a"
+        self.context.session.flush()
+        sorts = [("name", True)]
+        first = db_api.port_find(self.context, sorts=sorts, limit=2,
+                                 scope=db_api.ALL)
+        self.assertEqual(self._ids(first), ["port0", "port3"])
+        second = db_api.port_find(self.context, sorts=sorts, limit=2,
+                                  marker="port3", scope=db_api.ALL)
+        self.assertEqual(self._ids(second), ["port2", "port1"])
+        page = db_api.port_find(self.context, sorts=[("name", False)],
+                                limit=2, marker="port2", scope=db_api.ALL)
+        self.assertEqual(self._ids(page), ["port0", "port3"])
+
+    def test_sort_by_constant_key(self):
+        page = db_api.network_find(self.context, sorts=[("status", True)],
+                                   limit=2, scope=db_api.ALL)
+        self.assertEqual(self._ids(page), ["net0", "net1"])
+
+    def test_marker_not_found(self):
+        with self.assertRaises(q_exc.MarkerNotFound):
+            db_api.network_find(self.context, limit=2, marker="nope",
+                                scope=db_api.ALL)
+
+    def test_marker_of_other_tenant_not_found(self):
+        self.context.session.add(models.Network(id="other",
+                                                tenant_id="other"))
+        self.context.session.flush()
+        with self.assertRaises(q_exc.MarkerNotFound):
+            db_api.network_find(self.context, limit=2, marker="other",
+                                scope=db_api.ALL)
+
+
+class TestDBAPIProjection(test_base.TestBase):
+    def setUp(self):
+        super(TestDBAPIProjection, self).setUp()
+        cfg.CONF.set_override('connection', 'sqlite://', 'database')
+        neutron_db_api.configure_db()
+        models.BASEV2.metadata.create_all(neutron_session._ENGINE)
+        self.context.session.add(models.Port(
+            id="port1", network_id="net1", tenant_id=self.context.tenant_id,
+            backend_key="key", device_id="dev", mac_address=1))
+        self.context.session.flush()
+        self.context.session.expunge_all()
+
+    def tearDown(self):
+        super(TestDBAPIProjection, self).tearDown()
+        neutron_db_api.clear_db()
+
+    def test_port_find_fields(self):
+        port = db_api.port_find(self.context, fields=["id", "device_id"],
+                                scope=db_api.ONE)
+        self.assertEqual(port.__dict__["device_id"], "dev")
+        for attr in ("mac_address", "backend_key", "ip_addresses"):
+            self.assertFalse(attr in port.__dict__)
+
+    def test_port_find_unknown_field_loads_everything(self):
+        port = db_api.port_find(self.context, fields=["id", "binding:host"],
+                                scope=db_api.ONE)
+        self.assertEqual(port.__dict__["mac_address"], 1)
+        self.assertEqual(port.__dict__["ip_addresses"], [])
+
+
+class TestDBAPICount(test_base.TestBase):
+    def setUp(self):
+        super(TestDBAPICount, self).setUp()
+        cfg.CONF.set_override('connection', 'sqlite://', 'database')
+        cfg.CONF.set_override('tenant_counts', True, 'QUARK')
+        neutron_db_api.configure_db()
+        models.BASEV2.metadata.create_all(neutron_session._ENGINE)
+        for i in xrange(3):
+            db_api.port_create(self.context, id="port%d" % i,
+                               network_id="net%d" % (i % 2),
+                               backend_key="key", device_id="dev%d" % i)
+        self.context.session.flush()
+
+    def tearDown(self):
+        super(TestDBAPICount, self).tearDown()
+        cfg.CONF.clear_override('tenant_counts', 'QUARK')
+        neutron_db_api.clear_db()
+
+    def test_count_filters(self):
+        self.assertEqual(db_api.port_count_all(self.context), 3)
+        self.assertEqual(db_api.port_count_all(self.context,
+                                               network_id="net0"), 2)
+        self.assertEqual(db_api.port_count_all(self.context,
+                                               device_id=["dev1"]), 1)
+
+    def test_approximate_count_seeded_and_maintained(self):
+        self.assertEqual(db_api.port_count_all(self.context,
+                                               approximate=True), 3)
+        counter = self.context.session.query(models.TenantCount).one()
+        self.assertEqual(counter.count, 3)
+
+        db_api.port_create(self.context, id="port3", network_id="net0",
+                           backend_key="key", device_id="dev3")
+        self.context.session.flush()
+        self.context.session.expire_all()
+        self.assertEqual(db_api.port_count_all(self.context,
+                                               approximate=True), 4)
+
+    def test_approximate_count_seed_race_lost(self):
+        self.context.session.add(models.TenantCount(
+            tenant_id=self.context.tenant_id, resource="quark_ports",
+            count=7))
+        self.context.session.flush()
+        self.context.session.expunge_all()
+        counter = db_api._seed_tenant_count(self.context, models.Port,
+                                            self.context.tenant_id)
+        self.assertEqual(counter.count, 7)
+
+    def test_approximate_count_with_filters_is_exact(self):
+        db_api.port_count_all(self.context, approximate=True)
+        self.context.session.query(models.TenantCount).update({"count": 10})
+        self.assertEqual(db_api.port_count_all(self.context,
+                                               approximate=True,
+                                               network_id="net1"), 1)
+
+
+class TestDBAPIBackendOps(test_base.TestBase):
+    def setUp(self):
+        super(TestDBAPIBackendOps, self).setUp()
+        cfg.CONF.set_override('connection', 'sqlite://', 'database')
+        neutron_db_api.configure_db()
+        models.BASEV2.metadata.create_all(neutron_session._ENGINE)
+
+    def tearDown(self):
+        super(TestDBAPIBackendOps, self).tearDown()
+        neutron_db_api.clear_db()
+
+    def _create(self, resource_id):
+        return db_api.backend_op_create(self.context,
+                                        resource_id=resource_id,
+                                        network_plugin="BASE",
+                                        operation="create_port",
+                                        payload="{}")
+
+    def test_sequence_per_resource(self):
+        self.assertEqual(self._create("port1")["sequence"], 1)
+        self.assertEqual(self._create("port1")["sequence"], 2)
+        self.assertEqual(self._create("port2")["sequence"], 1)
+
+    def test_duplicate_sequence_rejected(self):
+        self._create("port1")
+        self.context.session.add(models.BackendOperation(
+            resource_id="port1", sequence=1, network_plugin="BASE",
+            operation="delete_port"))
+        with self.assertRaises(Exception):
+            self.context.session.flush()
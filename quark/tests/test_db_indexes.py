@@ -0,0 +1,133 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+import os
+import re
+
+from neutron.db import api as neutron_db_api
+from neutron.openstack.common.db.sqlalchemy import session as neutron_session
+from oslo.config import cfg
+
+from quark.db import api as db_api
+from quark.db import models
+from quark.tests import test_base
+
+
+class TestFindsUseIndexes(test_base.TestBase):
+    """EXPLAINs the queries of the find functions on the hot predicates.
+
+    Runs on sqlite, and on MySQL as well when QUARK_TEST_MYSQL_CONNECTION
+    holds a connection string to a scratch database.
+    """
+    connection = "sqlite://"
+
+    def setUp(self):
+        super(TestFindsUseIndexes, self).setUp()
+        if not self.connection:
+            self.skipTest("No database to explain queries on")
+        cfg.CONF.set_override('connection', self.connection, 'database')
+        neutron_db_api.configure_db()
+        models.BASEV2.metadata.create_all(neutron_session._ENGINE)
+
+    def tearDown(self):
+        super(TestFindsUseIndexes, self).tearDown()
+        if self.connection:
+            models.BASEV2.metadata.drop_all(neutron_session._ENGINE)
+            neutron_db_api.clear_db()
+
+    def _plan(self, query):
+        """Returns the index each table is read through, None for scans."""
+        engine = neutron_session._ENGINE
+        compiled = query.statement.compile(dialect=engine.dialect)
+        params = compiled.params
+        if compiled.positional:
+            params = [compiled.params[key] for key in compiled.positiontup]
+
+        plan = {}
+        if engine.dialect.name != "sqlite":
+            for row in engine.execute("EXPLAIN %s" % compiled, params):
+                plan.setdefault(row["table"], row["key"])
+            return plan
+
+        for row in engine.execute("EXPLAIN QUERY PLAN %s" % compiled,
+                                  params):
+            match = re.match(r"(SEARCH|SCAN)(?: TABLE)? (\w+)(.*)", row[-1])
+            if match:
+                operation, table, detail = match.groups()
+                plan.setdefault(table, operation == "SEARCH" and
+                                detail.strip() or None)
+        return plan
+
+    def assertIndexed(self, query, table):
+        plan = self._plan(query)
+        self.assertTrue(plan.get(table), "%s is scanned: %s" % (table, plan))
+
+    def test_port_find_device_id(self):
+        self.assertIndexed(db_api.port_find(self.context, device_id="dev"),
+                           "quark_ports")
+
+    def test_port_find_tenant_network(self):
+        query = db_api.port_find(self.context, tenant_id="tenant",
+                                 network_id="net")
+        self.assertIndexed(query, "quark_ports")
+
+    def test_ip_address_find_reusable(self):
+        query = db_api.ip_address_find(self.context, network_id="net",
+                                       reuse_after=60, deallocated=True,
+                                       version=4, order_by="address")
+        self.assertIndexed(query, "quark_ip_addresses")
+
+    def test_ip_address_find_network_address(self):
+        query = db_api.ip_address_find(self.context, network_id="net",
+                                       ip_address=167772161,
+                                       tenant_id="tenant")
+        self.assertIndexed(query, "quark_ip_addresses")
+
+    def test_ip_address_find_subnet(self):
+        query = db_api.ip_address_find(self.context, subnet_id="subnet")
+        self.assertIndexed(query, "quark_ip_addresses")
+
+    def test_ip_free_range_find_subnet(self):
+        query = db_api.ip_free_range_find(self.context, subnet_id="subnet")
+        self.assertIndexed(query, "quark_ip_free_ranges")
+
+    def test_mac_address_find_reusable(self):
+        query = db_api.mac_address_find(self.context, reuse_after=60,
+                                        deallocated=True)
+        self.assertIndexed(query, "quark_mac_addresses")
+
+    def test_mac_address_find_address(self):
+        query = db_api.mac_address_find(self.context, address=1)
+        self.assertIndexed(query, "quark_mac_addresses")
+
+    def test_network_find_tenant(self):
+        self.assertIndexed(db_api.network_find(self.context),
+                           "quark_networks")
+
+    def test_subnet_find_tenant(self):
+        self.assertIndexed(db_api.subnet_find(self.context),
+                           "quark_subnets")
+
+    def test_security_group_find_tenant(self):
+        self.assertIndexed(db_api.security_group_find(self.context),
+                           "quark_security_groups")
+
+    def test_backend_op_find_resource(self):
+        query = db_api.backend_op_find(self.context, resource_id="port")
+        self.assertIndexed(query, "quark_backend_ops")
+
+
+class TestFindsUseIndexesMySQL(TestFindsUseIndexes):
+    connection = os.environ.get("QUARK_TEST_MYSQL_CONNECTION")
@@ -21,6 +21,11 @@ from quark.tests import test_base
 class TestDBModels(test_base.TestBase):
     def setUp(self):
         super(TestDBModels, self).setUp()
+        models.IP_POLICY_CACHE.clear()
+
+    def tearDown(self):
+        super(TestDBModels, self).tearDown()
+        models.IP_POLICY_CACHE.clear()
 
     def test_get_ip_policy_rule_set(self):
         subnet = dict(id=1, ip_version=4, next_auto_assign_ip=0,
@@ -41,3 +46,51 @@ class TestDBModels(test_base.TestBase):
             ip_policy_rules,
             IPSet(["fc00::/127",
                    "fdff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128"]))
+
+    def test_get_ip_policy_rule_set_cached(self):
+        subnet = dict(id=1, cidr="0.0.0.0/24", network=dict(ip_policy=None),
+                      ip_policy=dict(id=2, revision=0,
+                                     exclude=[dict(offset=0, length=4)]))
+        first = models.IPPolicy.get_ip_policy_rule_set(subnet)
+        second = models.IPPolicy.get_ip_policy_rule_set(subnet)
+        self.assertIs(first, second)
+        self.assertEqual(models.IP_POLICY_CACHE.misses, 1)
+        self.assertEqual(models.IP_POLICY_CACHE.hits, 1)
+        self.assertEqual(models.IP_POLICY_CACHE.stats(),
+                         dict(size=1, hits=1, misses=1, hit_rate=0.5))
+
+    def test_get_ip_policy_rule_set_revision_misses(self):
+        subnet = dict(id=1, cidr="0.0.0.0/24", network=dict(ip_policy=None),
+                      ip_policy=dict(id=2, revision=0,
+                                     exclude=[dict(offset=0, length=4)]))
+        models.IPPolicy.get_ip_policy_rule_set(subnet)
+        subnet["ip_policy"]["revision"] = 1
+        subnet["ip_policy"]["exclude"] = [dict(offset=0, length=8)]
+        ip_policy_rules = models.IPPolicy.get_ip_policy_rule_set(subnet)
+        self.assertEqual(models.IP_POLICY_CACHE.misses, 2)
+        self.assertEqual(ip_policy_rules,
+                         IPSet(['0.0.0.0/29', '0.0.0.255/32']))
+
+    def test_get_ip_policy_rule_set_no_policy_id_not_cached(self):
+        subnet = dict(id=1, cidr="0.0.0.0/24", network=dict(ip_policy=None),
+                      ip_policy=dict(exclude=[dict(offset=0, length=4)]))
+        models.IPPolicy.get_ip_policy_rule_set(subnet)
+        models.IPPolicy.get_ip_policy_rule_set(subnet)
+        self.assertEqual(models.IP_POLICY_CACHE.hits, 0)
+        self.assertEqual(models.IP_POLICY_CACHE.misses, 0)
+
+    def test_ip_policy_cache_invalidate_policy(self):
+        subnet = dict(id=1, cidr="0.0.0.0/24", network=dict(ip_policy=None),
+                      ip_policy=dict(id=2, revision=0,
+                                     exclude=[dict(offset=0, length=4)]))
+        models.IPPolicy.get_ip_policy_rule_set(subnet)
+        models.IP_POLICY_CACHE.invalidate_policy(2)
+        models.IPPolicy.get_ip_policy_rule_set(subnet)
+        self.assertEqual(models.IP_POLICY_CACHE.misses, 2)
+
+    def test_compiled_ip_policy_intervals(self):
+        subnet = dict(id=1, cidr="0.0.0.0/24", network=dict(ip_policy=None),
+                      ip_policy=dict(id=2, revision=0,
+                                     exclude=[dict(offset=0, length=5)]))
+        compiled = models.IPPolicy.get_compiled_ip_policy(subnet)
+        self.assertEqual(compiled.intervals, [(0, 4), (255, 255)])
@@ -0,0 +1,83 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+import mock
+
+from quark.drivers import base
+from quark.drivers import metrics
+from quark.drivers import registry
+from quark.tests import test_base
+
+
+class TestDriverMetrics(test_base.TestBase):
+    def setUp(self):
+        super(TestDriverMetrics, self).setUp()
+        self.metrics = metrics.DriverMetrics(buckets=(0.1, 1.0))
+
+    def test_observe(self):
+        self.metrics.observe("NVP", "create_port", 0.05)
+        self.metrics.observe("NVP", "create_port", 0.5, failed=True)
+        self.metrics.observe("NVP", "create_port", 5)
+        stats = self.metrics.stats()["NVP"]["create_port"]
+        self.assertEqual(stats["calls"], 3)
+        self.assertEqual(stats["errors"], 1)
+        self.assertAlmostEqual(stats["latency_sum"], 5.55)
+        self.assertEqual(stats["buckets"], {"0.1": 1, "1.0": 2, "+Inf": 3})
+
+    def test_stats_for_driver(self):
+        self.metrics.observe("NVP", "create_port", 0.05)
+        self.metrics.observe("BASE", "create_port", 0.05)
+        self.assertEqual(self.metrics.stats("BASE").keys(), ["BASE"])
+
+    def test_dump(self):
+        self.metrics.observe("NVP", "delete_port", 0.5, failed=True)
+        lines = self.metrics.dump().splitlines()
+        labels = 'driver="NVP",operation="delete_port"'
+        self.assertIn("quark_driver_calls_total{%s} 1" % labels, lines)
+        self.assertIn("quark_driver_errors_total{%s} 1" % labels, lines)
+        self.assertIn('quark_driver_latency_seconds_bucket{%s,le="0.1"} 0'
+                      % labels, lines)
+        self.assertIn('quark_driver_latency_seconds_bucket{%s,le="+Inf"} 1'
+                      % labels, lines)
+        self.assertIn("quark_driver_latency_seconds_count{%s} 1" % labels,
+                      lines)
+
+
+class TestInstrumentedDriver(test_base.TestBase):
+    def setUp(self):
+        super(TestInstrumentedDriver, self).setUp()
+        self.metrics = metrics.DriverMetrics()
+        self.driver = metrics.InstrumentedDriver("BASE", base.BaseDriver(),
+                                                 self.metrics)
+
+    def test_operations_recorded(self):
+        port = self.driver.create_port(self.context, 1, 2)
+        self.assertEqual(port, {"uuid": 2})
+        self.assertEqual(self.driver.get_name(), "BASE")
+        stats = self.metrics.stats()["BASE"]
+        self.assertEqual(stats.keys(), ["create_port"])
+        self.assertEqual(stats["create_port"]["calls"], 1)
+
+    def test_errors_recorded(self):
+        with mock.patch("quark.drivers.base.BaseDriver.delete_port") as delete:
+            delete.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                self.driver.delete_port(self.context, 2)
+        stats = self.metrics.stats()["BASE"]["delete_port"]
+        self.assertEqual(stats["errors"], 1)
+
+    def test_registry_instruments_drivers(self):
+        driver = registry.DriverRegistry().get_driver("BASE")
+        self.assertTrue(isinstance(driver, metrics.InstrumentedDriver))
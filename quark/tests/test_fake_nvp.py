@@ -0,0 +1,125 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+import aiclib
+from oslo.config import cfg
+
+from quark.bench import fake_nvp
+import quark.drivers.nvp_driver
+from quark.tests import test_base
+
+
+class TestFakeNVP(test_base.TestBase):
+    def setUp(self):
+        super(TestFakeNVP, self).setUp()
+        self.fake = fake_nvp.FakeNVP(max_page_length=2)
+
+    def _tags(self, tenant_id, network_id):
+        return [dict(scope="os_tid", tag=tenant_id),
+                dict(scope="neutron_net_id", tag=network_id)]
+
+    def test_lswitch_tag_query(self):
+        for network_id in ("net1", "net2"):
+            status, switch = self.fake.request(
+                "POST", "/ws.v1/lswitch",
+                dict(tags=self._tags("tid", network_id)))
+            self.assertEqual(status, 201)
+        status, results = self.fake.request(
+            "GET", "/ws.v1/lswitch",
+            dict(tag_scope=["os_tid", "neutron_net_id"],
+                 tag=["tid", "net2"], relations="LogicalSwitchStatus"))
+        self.assertEqual(results["result_count"], 1)
+        self.assertEqual(results["results"][0]["uuid"], switch["uuid"])
+        status = results["results"][0]["_relations"]["LogicalSwitchStatus"]
+        self.assertEqual(status["lport_count"], 0)
+
+    def test_lport_query_relations(self):
+        status, switch = self.fake.request("POST", "/ws.v1/lswitch", {})
+        status, port = self.fake.request(
+            "POST", "/ws.v1/lswitch/%s/lport" % switch["uuid"], {})
+        status, results = self.fake.request(
+            "GET", "/ws.v1/lswitch/*/lport",
+            dict(uuid=port["uuid"], relations=["LogicalSwitchConfig"]))
+        relations = results["results"][0]["_relations"]
+        self.assertEqual(relations["LogicalSwitchConfig"]["uuid"],
+                         switch["uuid"])
+
+    def test_lport_on_missing_lswitch(self):
+        status, body = self.fake.request("POST", "/ws.v1/lswitch/nope/lport",
+                                         {})
+        self.assertEqual(status, 404)
+
+    def test_delete_lswitch_deletes_lports(self):
+        status, switch = self.fake.request("POST", "/ws.v1/lswitch", {})
+        self.fake.request("POST", "/ws.v1/lswitch/%s/lport" % switch["uuid"],
+                          {})
+        status, body = self.fake.request(
+            "DELETE", "/ws.v1/lswitch/%s" % switch["uuid"], {})
+        self.assertEqual(status, 204)
+        self.assertEqual(self.fake.stats()["objects"]["lport"], 0)
+
+    def test_query_pages(self):
+        self.fake.populate("tid", profiles=3)
+        params = dict(tag_scope="os_tid", tag="tid")
+        status, first = self.fake.request("GET", "/ws.v1/security-profile",
+                                          dict(params))
+        self.assertEqual(first["result_count"], 3)
+        self.assertEqual(len(first["results"]), 2)
+        params["_page_cursor"] = first["page_cursor"]
+        status, second = self.fake.request("GET", "/ws.v1/security-profile",
+                                           params)
+        self.assertEqual(len(second["results"]), 1)
+        self.assertFalse("page_cursor" in second)
+
+    def test_error_injection(self):
+        self.fake.error_rate = 1.0
+        status, body = self.fake.request("GET", "/ws.v1/lswitch", {})
+        self.assertEqual(status, 503)
+        self.assertEqual(self.fake.stats()["errors"], 1)
+        self.assertEqual(self.fake.stats()["calls"]["GET_lswitch"], 1)
+
+
+class TestFakeNVPDriver(test_base.TestBase):
+    def setUp(self):
+        super(TestFakeNVPDriver, self).setUp()
+        cfg.CONF.set_override("connection_class",
+                              "quark.bench.fake_nvp.FakeConnection", "NVP")
+        cfg.CONF.set_override("controller_connection",
+                              ["fake-nvp:80:admin:admin:30:10:2:2"], "NVP")
+        self.driver = quark.drivers.nvp_driver.NVPDriver()
+        self.context.tenant_id = "tid"
+        fake_nvp._CONTROLLERS.clear()
+
+    def tearDown(self):
+        super(TestFakeNVPDriver, self).tearDown()
+        cfg.CONF.clear_override("connection_class", "NVP")
+        cfg.CONF.clear_override("controller_connection", "NVP")
+        fake_nvp._CONTROLLERS.clear()
+
+    def test_port_lifecycle(self):
+        self.driver.create_network(self.context, "net", network_id="net1")
+        port = self.driver.create_port(self.context, "net1", port_id="port1")
+        fake = fake_nvp.controller("fake-nvp:80")
+        self.assertEqual(fake.stats()["objects"]["lport"], 1)
+        self.driver.delete_port(self.context, port["uuid"])
+        self.assertEqual(fake.stats()["objects"]["lport"], 0)
+        self.driver.delete_network(self.context, "net1")
+        self.assertEqual(fake.stats()["objects"]["lswitch"], 0)
+
+    def test_errors_surface_as_aiclib_exceptions(self):
+        fake_nvp.controller("fake-nvp:80").error_rate = 1.0
+        with self.assertRaises(aiclib.nvp.ServiceUnavailable):
+            self.driver.create_network(self.context, "net",
+                                       network_id="net1")
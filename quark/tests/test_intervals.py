@@ -0,0 +1,58 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+import netaddr
+
+from quark import intervals
+from quark.tests import test_base
+
+
+class TestIntervals(test_base.TestBase):
+    def test_merge(self):
+        merged = intervals.merge([(5, 6), (1, 2), (3, 3), (10, 12), (11, 20)])
+        self.assertEqual(merged, [(1, 3), (5, 6), (10, 20)])
+
+    def test_difference(self):
+        result = intervals.difference([(0, 10), (20, 30)],
+                                      [(2, 3), (5, 6), (28, 40)])
+        self.assertEqual(result, [(0, 1), (4, 4), (7, 10), (20, 27)])
+
+    def test_difference_spanning(self):
+        result = intervals.difference([(0, 10), (20, 30)], [(5, 25)])
+        self.assertEqual(result, [(0, 4), (26, 30)])
+
+    def test_difference_everything_removed(self):
+        self.assertEqual(intervals.difference([(0, 255)], [(0, 300)]), [])
+
+    def test_clip(self):
+        clipped = intervals.clip([(-5, 2), (10, 12), (250, 300)], 0, 255)
+        self.assertEqual(clipped, [(0, 2), (10, 12), (250, 255)])
+
+    def test_size(self):
+        self.assertEqual(intervals.size([(0, 1), (255, 255)]), 3)
+
+    def test_to_pools(self):
+        cidr = netaddr.IPNetwork("192.168.1.0/24")
+        allocatable = intervals.difference(
+            intervals.from_network(cidr),
+            [(cidr.first, cidr.first + 1), (cidr.last, cidr.last)])
+        self.assertEqual(intervals.to_pools(allocatable, 4),
+                         [dict(start="192.168.1.2", end="192.168.1.254")])
+
+    def test_to_pools_v6(self):
+        cidr = netaddr.IPNetwork("fc00::/64")
+        pools = intervals.to_pools([(cidr.first + 2, cidr.last)], 6)
+        self.assertEqual(pools, [dict(start="fc00::2",
+                                      end="fc00::ffff:ffff:ffff:ffff")])
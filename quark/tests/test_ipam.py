@@ -17,11 +17,13 @@ import contextlib
 import mock
 
 from neutron.common import exceptions
+from neutron import context
 from neutron.db import api as neutron_db_api
 from neutron.openstack.common.db.sqlalchemy import session as neutron_session
 from neutron.openstack.common.notifier import api as notifier_api
 from oslo.config import cfg
 
+from quark.db import api as db_api
 from quark.db import models
 
 import quark.ipam
@@ -161,6 +163,83 @@ class QuarkNewMacAddressAllocation(QuarkIpamBaseTest):
             self.assertEqual(address["address"], 0)
 
 
+class QuarkMacAddressLeasing(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkMacAddressLeasing, self).setUp()
+        cfg.CONF.set_override("mac_lease_size", 4, "QUARK")
+
+    def tearDown(self):
+        super(QuarkMacAddressLeasing, self).tearDown()
+        cfg.CONF.clear_override("mac_lease_size", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, addresses=None, block=None, reclaimed=None):
+        db_mod = "quark.db.api"
+        leases = quark.ipam.MacAddressLeases()
+        with contextlib.nested(
+            mock.patch("quark.ipam.MAC_LEASES", leases),
+            mock.patch("quark.ipam.atexit"),
+            mock.patch("%s.mac_address_find" % db_mod),
+            mock.patch("%s.mac_address_create" % db_mod),
+            mock.patch("%s.mac_address_range_find_allocation_counts" % db_mod),
+            mock.patch("%s.mac_address_range_reserve_block" % db_mod),
+            mock.patch("%s.mac_address_lease_reclaim" % db_mod),
+            mock.patch("%s.mac_address_lease_create" % db_mod),
+            mock.patch("%s.mac_address_lease_renew" % db_mod)
+        ) as (_, _, mac_find, mac_create, range_counts, reserve, reclaim,
+              lease_create, lease_renew):
+            mac_find.side_effect = addresses
+            mac_create.side_effect = lambda context, **kw: kw
+            range_counts.return_value = []
+            reserve.return_value = block
+            reclaim.return_value = reclaimed
+            lease_create.side_effect = lambda context, **kw: dict(id=1, **kw)
+            lease_renew.return_value = True
+            yield leases, reserve, range_counts, lease_renew
+
+    def test_allocate_from_lease(self):
+        with self._stubs(addresses=[None] * 4,
+                         block=(dict(id=2), 16, 19)) as (_, reserve,
+                                                         range_counts, _):
+            first = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            second = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(first["address"], 16)
+            self.assertEqual(second["address"], 17)
+            self.assertEqual(second["mac_address_range_id"], 2)
+            self.assertEqual(reserve.call_count, 1)
+            self.assertFalse(range_counts.called)
+
+    def test_allocate_from_lease_skips_used_address(self):
+        with self._stubs(addresses=[None, dict(address=16), None],
+                         block=(dict(id=2), 16, 19)):
+            address = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(address["address"], 17)
+
+    def test_allocate_from_reclaimed_lease(self):
+        reclaimed = dict(id=1, mac_address_range_id=2, first_address=18,
+                         last_address=19)
+        with self._stubs(addresses=[None, None],
+                         reclaimed=reclaimed) as (_, reserve, _, _):
+            address = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(address["address"], 18)
+            self.assertFalse(reserve.called)
+
+    def test_allocate_exhausted_ranges_falls_back(self):
+        with self._stubs(addresses=[None]) as (_, _, range_counts, _):
+            with self.assertRaises(exceptions.MacAddressGenerationFailure):
+                self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertTrue(range_counts.called)
+
+    def test_release_records_progress(self):
+        with self._stubs(addresses=[None, None],
+                         block=(dict(id=2), 16, 19)) as (leases, _, _,
+                                                         lease_renew):
+            self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            leases.release()
+            self.assertEqual(lease_renew.call_count, 1)
+            self.assertEqual(lease_renew.call_args[0][3], 17)
+
+
 class QuarkMacAddressDeallocation(QuarkIpamBaseTest):
     @contextlib.contextmanager
     def _stubs(self, mac):
@@ -515,7 +594,7 @@ class QuarkNewIPAddressAllocation(QuarkIpamBaseTest):
         ) as (addr_find, subnet_find):
             addr_find.side_effect = addresses
             subnet_find.return_value = subnets
-            yield
+            yield subnet_find
 
     def test_allocate_new_ip_address_in_empty_range(self):
         subnet = dict(id=1, first_ip=0, last_ip=255,
@@ -580,6 +659,23 @@ class QuarkNewIPAddressAllocation(QuarkIpamBaseTest):
             self.assertEqual(address[0]["address"], 2)  # 0 => 2
             self.assertEqual(address[0]["subnet_id"], 1)
 
+    def test_allocate_ip_addresses_counts_batch(self):
+        subnet1 = dict(id=1, first_ip=0, last_ip=255,
+                       cidr="0.0.0.0/24", ip_version=4,
+                       next_auto_assign_ip=100, network=dict(ip_policy=None),
+                       ip_policy=None, policy_excluded_count=0)
+        subnet2 = dict(id=2, first_ip=256, last_ip=511,
+                       cidr="0.0.1.0/24", ip_version=4,
+                       next_auto_assign_ip=356, network=dict(ip_policy=None),
+                       ip_policy=None, policy_excluded_count=0)
+        subnets = [(subnet1, 255), (subnet2, 0)]
+        with self._stubs(subnets=subnets,
+                         addresses=[None] * 4) as subnet_find:
+            addresses = self.ipam.allocate_ip_addresses(self.context, 0,
+                                                        [1, 2], 0)
+            self.assertEqual([a[0]["subnet_id"] for a in addresses], [1, 2])
+            self.assertEqual(subnet_find.call_count, 1)
+
     def test_find_requested_ip_subnet(self):
         subnet1 = dict(id=1, first_ip=0, last_ip=255,
                        cidr="0.0.0.0/24", ip_version=4,
@@ -613,6 +709,347 @@ class QuarkNewIPAddressAllocation(QuarkIpamBaseTest):
                     self.context, 0, 0, 0, ip_address="0.0.0.240")
 
 
+class QuarkIpamFreeRangeIndex(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamFreeRangeIndex, self).setUp()
+        cfg.CONF.set_override("ipam_free_range_index", True, "QUARK")
+
+    def tearDown(self):
+        super(QuarkIpamFreeRangeIndex, self).tearDown()
+        cfg.CONF.clear_override("ipam_free_range_index", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, ranges=None, addresses=None):
+        db_mod = "quark.db.api"
+        with contextlib.nested(
+            mock.patch("%s.ip_free_range_find" % db_mod),
+            mock.patch("%s.ip_free_range_claim" % db_mod),
+            mock.patch("%s.ip_free_range_create" % db_mod),
+            mock.patch("%s.ip_address_find" % db_mod)
+        ) as (range_find, range_claim, range_create, addr_find):
+            range_find.side_effect = ranges
+            range_claim.return_value = True
+            addr_find.return_value = addresses or []
+            yield range_claim, range_create, addr_find
+
+    def _subnet(self, **kwargs):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=0, free_ranges_built=True,
+                      network=dict(ip_policy=None), ip_policy=None)
+        subnet.update(kwargs)
+        return subnet
+
+    def test_allocate_jumps_to_free_range(self):
+        subnet = self._subnet(next_auto_assign_ip=2)
+        free = dict(id=1, subnet_id=1, first_address=100, last_address=200)
+        with self._stubs(ranges=[[free]]) as (range_claim, _, addr_find):
+            next_ip = self.ipam._iterate_until_available_ip(
+                self.context, subnet, 0, None)
+            self.assertEqual(int(next_ip), 100)
+            range_claim.assert_called_once_with(self.context, free, 100)
+            self.assertFalse(addr_find.called)
+            self.assertEqual(subnet["next_auto_assign_ip"],
+                             (0xffff << 32) + 101)
+
+    def test_allocate_starts_at_cursor_inside_range(self):
+        subnet = self._subnet(next_auto_assign_ip=150)
+        free = dict(id=1, subnet_id=1, first_address=100, last_address=200)
+        with self._stubs(ranges=[[free]]) as (range_claim, _, _):
+            next_ip = self.ipam._iterate_until_available_ip(
+                self.context, subnet, 0, None)
+            self.assertEqual(int(next_ip), 150)
+
+    def test_allocate_wraps_around_past_cursor(self):
+        subnet = self._subnet(next_auto_assign_ip=150)
+        free = dict(id=1, subnet_id=1, first_address=10, last_address=20)
+        with self._stubs(ranges=[[free]]):
+            next_ip = self.ipam._iterate_until_available_ip(
+                self.context, subnet, 0, None)
+            self.assertEqual(int(next_ip), 10)
+
+    def test_allocate_retries_lost_claim(self):
+        subnet = self._subnet()
+        free1 = dict(id=1, subnet_id=1, first_address=3, last_address=9)
+        free2 = dict(id=1, subnet_id=1, first_address=4, last_address=9)
+        with self._stubs(ranges=[[free1], [free2]]) as (range_claim, _, _):
+            range_claim.side_effect = [False, True]
+            next_ip = self.ipam._iterate_until_available_ip(
+                self.context, subnet, 0, None)
+            self.assertEqual(int(next_ip), 4)
+
+    def test_allocate_prunes_policy_excluded_addresses(self):
+        subnet = self._subnet()
+        policy = models.IPPolicy.get_ip_policy_rule_set(subnet)
+        free1 = dict(id=1, subnet_id=1, first_address=0, last_address=9)
+        free2 = dict(id=1, subnet_id=1, first_address=1, last_address=9)
+        free3 = dict(id=1, subnet_id=1, first_address=2, last_address=9)
+        with self._stubs(ranges=[[free1], [free2], [free3]]):
+            next_ip = self.ipam._iterate_until_available_ip(
+                self.context, subnet, 0, policy)
+            self.assertEqual(int(next_ip), 2)
+
+    def test_allocate_builds_index(self):
+        subnet = self._subnet(free_ranges_built=False)
+        policy = models.IPPolicy.get_ip_policy_rule_set(subnet)
+        free = dict(id=1, subnet_id=1, first_address=3, last_address=254)
+        with self._stubs(ranges=[[], [free]],
+                         addresses=[dict(address=2)]) as (_, range_create,
+                                                          _):
+            next_ip = self.ipam._iterate_until_available_ip(
+                self.context, subnet, 0, policy)
+            range_create.assert_called_once_with(
+                self.context, subnet_id=1, first_address=3,
+                last_address=254)
+            self.assertTrue(subnet["free_ranges_built"])
+            self.assertEqual(int(next_ip), 3)
+
+    def test_allocate_exhausted_index_fails(self):
+        subnet = self._subnet()
+        addresses = [dict(address=i) for i in xrange(256)]
+        with self._stubs(ranges=[[], [], []], addresses=addresses):
+            with self.assertRaises(exceptions.IpAddressGenerationFailure):
+                self.ipam._iterate_until_available_ip(
+                    self.context, subnet, 0, None)
+
+    def test_allocate_specific_ip_removes_from_index(self):
+        subnet = self._subnet()
+        free = dict(id=1, subnet_id=1, first_address=3, last_address=254)
+        with contextlib.nested(
+            self._stubs(ranges=[[free]]),
+            mock.patch("quark.db.api.subnet_find_allocation_counts")
+        ) as ((range_claim, _, addr_find), subnet_find):
+            addr_find.return_value = None
+            subnet_find.return_value = [(subnet, 0)]
+            self.ipam.allocate_ip_address(self.context, 0, 0, 0,
+                                          ip_address="0.0.0.10")
+            range_claim.assert_called_once_with(self.context, free, 10)
+
+
+class QuarkIpamFreeRangeClaimRace(test_base.TestBase):
+    def setUp(self):
+        super(QuarkIpamFreeRangeClaimRace, self).setUp()
+        cfg.CONF.set_override('connection', 'sqlite://', 'database')
+        neutron_db_api.configure_db()
+        models.BASEV2.metadata.create_all(neutron_session._ENGINE)
+        self.ipam = quark.ipam.QuarkIpamANY()
+        self.other = context.Context('fake', 'fake', is_admin=False)
+        self.subnet = dict(id="subnet1", cidr="0.0.0.0/24")
+        db_api.ip_free_range_create(self.context, subnet_id="subnet1",
+                                    first_address=3, last_address=9)
+        self.context.session.flush()
+
+    def tearDown(self):
+        super(QuarkIpamFreeRangeClaimRace, self).tearDown()
+        neutron_db_api.clear_db()
+
+    def test_lost_claim_rereads_current_ranges(self):
+        # This session has read the range before the other one claims from
+        # it, so its copy of the range is stale by the time it claims.
+        db_api.ip_free_range_find(self.context, subnet_id="subnet1",
+                                  scope=db_api.ALL)
+        won = self.ipam._claim_free_range_ip(self.other, self.subnet, None)
+        self.other.session.flush()
+        lost = self.ipam._claim_free_range_ip(self.context, self.subnet, None)
+        self.assertEqual(int(won), 3)
+        self.assertEqual(int(lost), 4)
+        ranges = db_api.ip_free_range_find(self.other, subnet_id="subnet1",
+                                           scope=db_api.ALL)
+        self.assertEqual([(int(r["first_address"]), int(r["last_address"]))
+                          for r in ranges], [(5, 9)])
+
+    def test_claims_give_up_when_always_lost(self):
+        with mock.patch("quark.db.api.ip_free_range_claim") as claim:
+            claim.return_value = False
+            self.assertIsNone(self.ipam._claim_free_range_ip(
+                self.context, self.subnet, None))
+            self.assertEqual(claim.call_count,
+                             quark.ipam.FREE_RANGE_CLAIM_ATTEMPTS)
+
+    def test_remove_from_free_ranges_gives_up_when_always_lost(self):
+        self.subnet["free_ranges_built"] = True
+        with contextlib.nested(
+            mock.patch("quark.db.api.ip_free_range_claim"),
+            mock.patch.object(self.ipam, "_free_range_index_enabled")
+        ) as (claim, enabled):
+            claim.return_value = False
+            enabled.return_value = True
+            self.ipam._remove_from_free_ranges(self.context, self.subnet, 5)
+            self.assertFalse(self.subnet["free_ranges_built"])
+
+
+class QuarkIpamFreeRangesAllocation(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamFreeRangesAllocation, self).setUp()
+        self.ipam = quark.ipam.QuarkIpamFreeRangesANY()
+
+    @contextlib.contextmanager
+    def _stubs(self, subnets=None, ranges=None, cursor=0):
+        db_mod = "quark.db.api"
+        with contextlib.nested(
+            mock.patch("%s.subnet_find" % db_mod),
+            mock.patch("%s.subnet_find_allocation_counts" % db_mod),
+            mock.patch("%s.ip_free_range_find" % db_mod),
+            mock.patch("%s.ip_free_range_claim" % db_mod),
+            mock.patch("%s.ip_address_find" % db_mod),
+            mock.patch("quark.ipam.random")
+        ) as (subnet_find, alloc_counts, range_find, range_claim, addr_find,
+              random):
+            random.randint.return_value = cursor
+            subnet_find.return_value = subnets
+            range_find.side_effect = ranges
+            range_claim.return_value = True
+            addr_find.return_value = None
+            yield alloc_counts, range_claim
+
+    def _subnet(self, **kwargs):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=0, free_ranges_built=True,
+                      network=dict(ip_policy=None), ip_policy=None)
+        subnet.update(kwargs)
+        return subnet
+
+    def test_allocate_claims_without_locking_subnets(self):
+        subnet = self._subnet()
+        free = dict(id=1, subnet_id=1, first_address=7, last_address=9)
+        with self._stubs(subnets=[subnet],
+                         ranges=[free, [free]]) as (alloc_counts,
+                                                    range_claim):
+            address = self.ipam.allocate_ip_address(self.context, 0, 0, 0)
+            self.assertEqual(address[0]["address"], 7)
+            range_claim.assert_called_once_with(mock.ANY, free, 7)
+            self.assertFalse(alloc_counts.called)
+            self.assertEqual(subnet["next_auto_assign_ip"], 0)
+
+    def test_allocate_skips_exhausted_subnet(self):
+        full = self._subnet(id=1)
+        subnet = self._subnet(id=2, cidr="0.0.1.0/24")
+        free = dict(id=1, subnet_id=2, first_address=263, last_address=263)
+        with self._stubs(subnets=[full, subnet],
+                         ranges=[None, free, [free]]):
+            address = self.ipam.allocate_ip_address(self.context, 0, 0, 0)
+            self.assertEqual(address[0]["subnet_id"], 2)
+            self.assertEqual(address[0]["address"], 263)
+
+    def test_allocate_no_free_ranges_fails(self):
+        with self._stubs(subnets=[self._subnet()], ranges=[None]):
+            with self.assertRaises(exceptions.IpAddressGenerationFailure):
+                self.ipam.allocate_ip_address(self.context, 0, 0, 0)
+
+    def test_iterate_claims_from_random_cursor(self):
+        subnet = self._subnet()
+        free = dict(id=1, subnet_id=1, first_address=7, last_address=90)
+        with self._stubs(ranges=[[free]], cursor=40) as (_, range_claim):
+            next_ip = self.ipam._iterate_until_available_ip(
+                self.context, subnet, 0, None)
+            self.assertEqual(int(next_ip), 40)
+            range_claim.assert_called_once_with(self.context, free, 40)
+
+    def test_iterate_rebuilds_exhausted_index_once(self):
+        subnet = self._subnet()
+        with contextlib.nested(
+            self._stubs(ranges=[[], []]),
+            mock.patch.object(self.ipam, "_ensure_free_ranges")
+        ) as (_, ensure):
+            with self.assertRaises(exceptions.IpAddressGenerationFailure):
+                self.ipam._iterate_until_available_ip(
+                    self.context, subnet, 0, None)
+            ensure.assert_called_once_with(self.context, subnet,
+                                           rebuild=True)
+
+    def test_select_subnet_builds_index_under_lock(self):
+        subnet = self._subnet(free_ranges_built=False)
+        with contextlib.nested(
+            self._stubs(subnets=[subnet], ranges=[dict(id=1)]),
+            mock.patch.object(self.ipam, "_build_free_ranges"),
+            mock.patch.object(self.context.session, "refresh")
+        ) as (_, build, refresh):
+            self.assertEqual(
+                self.ipam.select_subnet(self.context, 0, None), subnet)
+            refresh.assert_called_once_with(subnet, lockmode="update")
+            self.assertTrue(build.called)
+
+    def test_strategies_registered(self):
+        for name in ("ANY_FREE_RANGES", "BOTH_FREE_RANGES",
+                     "BOTH_REQUIRED_FREE_RANGES"):
+            self.assertTrue(quark.ipam.IPAM_REGISTRY.is_valid_strategy(name))
+
+
+class QuarkIPAddressReuseQueue(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIPAddressReuseQueue, self).setUp()
+        cfg.CONF.set_override("ipam_reuse_queue", True, "QUARK")
+
+    def tearDown(self):
+        super(QuarkIPAddressReuseQueue, self).tearDown()
+        cfg.CONF.clear_override("ipam_reuse_queue", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, entries=None, popped=None, addresses=None):
+        db_mod = "quark.db.api"
+        with contextlib.nested(
+            mock.patch("%s.ip_reuse_queue_peek" % db_mod),
+            mock.patch("%s.ip_reuse_queue_pop" % db_mod),
+            mock.patch("%s.ip_reuse_queue_push" % db_mod),
+            mock.patch("%s.ip_address_find" % db_mod),
+            mock.patch("%s.ip_address_update" % db_mod)
+        ) as (peek, pop, push, addr_find, addr_update):
+            peek.side_effect = entries
+            pop.side_effect = popped
+            addr_find.side_effect = addresses
+            addr_update.side_effect = lambda context, address, **kw: address
+            yield peek, push, addr_find
+
+    def _address(self, address=2):
+        return dict(id=1, address=address, version=4,
+                    subnet=dict(cidr="0.0.0.0/24"))
+
+    def test_reallocate_pops_queued_ip(self):
+        entry = dict(id=1, ip_address_id=1)
+        with self._stubs(entries=[[entry]], popped=[True],
+                         addresses=[self._address()]) as (_, _, addr_find):
+            result = self.ipam.attempt_to_reallocate_ip(self.context, 1, 0, 0)
+            self.assertEqual(result[0]["address"], 2)
+            self.assertEqual(addr_find.call_args[1]["id"], [1])
+
+    def test_reallocate_lost_pop_tries_next_entry(self):
+        entries = [dict(id=1, ip_address_id=1), dict(id=2, ip_address_id=2)]
+        with self._stubs(entries=[entries], popped=[False, True],
+                         addresses=[self._address(3)]) as (_, _, addr_find):
+            result = self.ipam.attempt_to_reallocate_ip(self.context, 1, 0, 0)
+            self.assertEqual(result[0]["address"], 3)
+            self.assertEqual(addr_find.call_args[1]["id"], [2])
+
+    def test_reallocate_stale_entry_skipped(self):
+        entry = dict(id=1, ip_address_id=1)
+        with self._stubs(entries=[[entry], []], popped=[True],
+                         addresses=[None]) as (peek, _, _):
+            result = self.ipam.attempt_to_reallocate_ip(self.context, 1, 0, 0)
+            self.assertEqual(result, [])
+            self.assertEqual(peek.call_count, 2)
+
+    def test_reallocate_out_of_range_deleted_elevated(self):
+        entry = dict(id=1, ip_address_id=1)
+        with contextlib.nested(
+            self._stubs(entries=[[entry], []], popped=[True],
+                        addresses=[self._address(300)]),
+            mock.patch("quark.db.api.ip_address_delete")
+        ) as (_, addr_delete):
+            result = self.ipam.attempt_to_reallocate_ip(self.context, 1, 0, 0)
+            self.assertEqual(result, [])
+            self.assertTrue(addr_delete.call_args[0][0].is_admin)
+
+    def test_deallocate_queues_ip(self):
+        port = dict(ip_addresses=[], device_id="foo")
+        addr = dict(ports=[port], tenant_id=1, subnet_id=1,
+                    address_readable=None, created_at=None)
+        port["ip_addresses"].append(addr)
+        with self._stubs() as (_, push, _):
+            self.ipam.deallocate_ip_address(self.context, port)
+            push.assert_called_once_with(self.context, addr)
+
+
 class QuarkIPAddressAllocateDeallocated(QuarkIpamBaseTest):
     @contextlib.contextmanager
     def _stubs(self, ip_find, subnet, address, addresses_found,
@@ -660,6 +1097,18 @@ class QuarkIPAddressAllocateDeallocated(QuarkIpamBaseTest):
             self.assertEqual(len(addr), 0)
         self.context.session.delete = mock.Mock()
 
+    def test_allocate_out_of_range_deleted_elevated(self):
+        subnet = dict(id=1, ip_version=4, next_auto_assign_ip=0,
+                      cidr="0.0.0.0/29")
+        address = dict(id=1, address=254, subnet=subnet)
+        with contextlib.nested(
+            self._stubs(False, subnet, address, [address, None],
+                        sub_found=False),
+            mock.patch("quark.db.api.ip_address_delete")
+        ) as (_, addr_delete):
+            self.ipam.allocate_ip_address(self.context, 0, 0, 0)
+            self.assertTrue(addr_delete.call_args[0][0].is_admin)
+
     def test_allocate_finds_no_deallocated_creates_new_ip(self):
         subnet = dict(id=1, ip_version=4, next_auto_assign_ip=0,
                       cidr="0.0.0.0/24", first_ip=0, last_ip=255,
@@ -727,6 +1176,29 @@ class TestQuarkIpPoliciesIpAllocation(QuarkIpamBaseTest):
             with self.assertRaises(exceptions.IpAddressGenerationFailure):
                 self.ipam.allocate_ip_address(self.context, 0, 0, 0, version=4)
 
+    def test_subnet_full_based_on_stored_policy_count(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=0, network=dict(ip_policy=None),
+                      ip_policy=None, policy_excluded_count=250)
+        with contextlib.nested(
+            self._stubs(subnets=[(subnet, 6)], addresses=[None, None]),
+            mock.patch("quark.db.models.IPPolicy.get_ip_policy_rule_set")
+        ) as (_, rule_set):
+            with self.assertRaises(exceptions.IpAddressGenerationFailure):
+                self.ipam.allocate_ip_address(self.context, 0, 0, 0, version=4)
+            self.assertFalse(rule_set.called)
+
+    def test_policy_count_stored_on_subnet(self):
+        subnet = dict(id=1, first_ip=0, last_ip=255,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=0, network=dict(ip_policy=None),
+                      ip_policy=dict(exclude=
+                                     [dict(offset=0, length=2)]))
+        with self._stubs(subnets=[(subnet, 0)], addresses=[None, None]):
+            self.ipam.allocate_ip_address(self.context, 0, 0, 0, version=4)
+            self.assertEqual(subnet["policy_excluded_count"], 2)
+
     def test_ip_policy_on_subnet(self):
         subnet = dict(id=1, first_ip=0, last_ip=255,
                       cidr="0.0.0.0/24", ip_version=4,
@@ -867,3 +1339,12 @@ class QuarkIPAddressAllocationNotifications(QuarkIpamBaseTest):
                      device_ids=["foo"],
                      created_at=address["created_at"],
                      deleted_at="456"))
+
+    def test_deallocation_notification_does_not_load_ports(self):
+        address = models.IPAddress(tenant_id=1, address=0, created_at="123",
+                                   subnet_id=1, address_readable="0.0.0.0")
+        with self._stubs(dict(), deleted_at="456") as notify:
+            self.ipam._deallocate_ip_address(self.context, address)
+            self.assertNotIn("ports", address.__dict__)
+            payload = notify.call_args[0][4]
+            self.assertEqual(payload["device_ids"], [])
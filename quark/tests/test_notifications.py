@@ -0,0 +1,111 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+import contextlib
+
+import mock
+from oslo.config import cfg
+
+from quark import notifications
+from quark.tests import test_base
+
+
+class TestNotifications(test_base.TestBase):
+    def setUp(self):
+        super(TestNotifications, self).setUp()
+        cfg.CONF.set_override("async_notifications", True, "QUARK")
+        cfg.CONF.set_override("notification_queue_size", 2, "QUARK")
+        self.emitter = notifications.NotificationEmitter()
+
+    def tearDown(self):
+        super(TestNotifications, self).tearDown()
+        cfg.CONF.clear_override("async_notifications", "QUARK")
+        cfg.CONF.clear_override("notification_queue_size", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, transaction=None):
+        session = mock.Mock(transaction=transaction)
+        self.context = mock.Mock(session=session)
+        with contextlib.nested(
+            mock.patch("quark.notifications.EMITTER", self.emitter),
+            mock.patch("eventlet.spawn_n"),
+            mock.patch("sqlalchemy.event.listen"),
+            mock.patch("atexit.register"),
+            mock.patch("neutron.openstack.common.notifier.api.notify")
+        ) as (_, _spawn, _listen, _register, notify):
+            yield session, notify
+
+    def _transaction(self, parent=None, nested=False):
+        return mock.Mock(_parent=parent, nested=nested, is_active=True)
+
+    def test_notify_sync_when_disabled(self):
+        cfg.CONF.set_override("async_notifications", False, "QUARK")
+        with self._stubs() as (_, notify):
+            notifications.notify(self.context, "ip_block.create", {})
+            self.assertEqual(notify.call_count, 1)
+            self.assertEqual(self.emitter.depth(), 0)
+
+    def test_notify_outside_transaction_queues(self):
+        with self._stubs() as (_, notify):
+            notifications.notify(self.context, "ip_block.create", {})
+            self.assertFalse(notify.called)
+            self.assertEqual(self.emitter.depth(), 1)
+            self.emitter.flush()
+            self.assertEqual(notify.call_count, 1)
+            self.assertEqual(self.emitter.sent, 1)
+
+    def test_notify_waits_for_commit(self):
+        transaction = self._transaction()
+        with self._stubs(transaction) as (session, notify):
+            notifications.notify(self.context, "ip_block.create", {})
+            self.assertEqual(self.emitter.depth(), 0)
+            notifications._after_commit(session)
+            self.assertEqual(self.emitter.depth(), 1)
+
+    def test_notify_dropped_on_rollback(self):
+        transaction = self._transaction()
+        with self._stubs(transaction) as (session, notify):
+            notifications.notify(self.context, "ip_block.create", {})
+            notifications._after_soft_rollback(session, transaction)
+            notifications._after_commit(session)
+            self.assertEqual(self.emitter.depth(), 0)
+
+    def test_savepoint_commit_waits_for_outer_commit(self):
+        outer = self._transaction()
+        savepoint = self._transaction(parent=outer, nested=True)
+        sub = self._transaction(parent=savepoint)
+        with self._stubs(sub) as (session, notify):
+            notifications.notify(self.context, "ip_block.create", {})
+            session.transaction = savepoint
+            notifications._after_commit(session)
+            self.assertEqual(self.emitter.depth(), 0)
+            session.transaction = outer
+            notifications._after_commit(session)
+            self.assertEqual(self.emitter.depth(), 1)
+
+    def test_queue_overflow_counts_dropped(self):
+        with self._stubs() as (_, notify):
+            for i in xrange(3):
+                notifications.notify(self.context, "ip_block.create", {})
+            self.assertEqual(self.emitter.depth(), 2)
+            self.assertEqual(self.emitter.dropped, 1)
+
+    def test_send_failure_counted(self):
+        with self._stubs() as (_, notify):
+            notify.side_effect = Exception("boom")
+            notifications.notify(self.context, "ip_block.create", {})
+            self.emitter.flush()
+            self.assertEqual(self.emitter.failed, 1)
+            self.assertEqual(self.emitter.depth(), 0)
@@ -14,7 +14,10 @@
 #  under the License.
 
 import contextlib
+import errno
 import mock
+import socket
+import time
 
 from neutron.db import api as db_api
 import neutron.extensions.securitygroup as sg_ext
@@ -871,3 +874,317 @@ class TestNVPGetConnection(TestNVPDriver):
         with self._stubs(has_conn=True) as aiclib_conn:
             self.driver.get_connection()
             self.assertFalse(aiclib_conn.called)
+
+
+class TestNVPControllerPool(TestNVPDriver):
+    @contextlib.contextmanager
+    def _stubs(self, count=2):
+        controllers = ["192.168.0.%d:443:admin:admin:30:10:2:2" % i
+                       for i in xrange(count)]
+        cfg.CONF.set_override("controller_connection", controllers, "NVP")
+        self.driver.nvp_connections = []
+        self.driver.load_config()
+        with mock.patch("aiclib.nvp.Connection") as aiclib_conn:
+            aiclib_conn.side_effect = lambda *args, **kwargs: mock.Mock()
+            yield aiclib_conn
+        cfg.CONF.clear_override("controller_connection", "NVP")
+
+    def test_get_connection_honors_timeouts(self):
+        with self._stubs(count=1) as aiclib_conn:
+            self.driver.get_connection()
+            aiclib_conn.assert_called_once_with(
+                "https://192.168.0.0:443", username="admin",
+                password="admin", timeout=10, retries=2)
+
+    def test_get_connection_prefers_fewest_in_flight(self):
+        with self._stubs():
+            self.driver.nvp_connections[0]["in_flight"] = 1
+            for i in xrange(2):
+                self.driver.get_connection()
+                self.assertFalse("connection" in
+                                 self.driver.nvp_connections[0])
+
+    def test_get_connection_round_robin(self):
+        with self._stubs():
+            first = self.driver.get_connection()
+            second = self.driver.get_connection()
+            self.assertNotEqual(first, second)
+            self.assertEqual(first, self.driver.get_connection())
+
+    def test_request_fails_over(self):
+        with self._stubs():
+            down, up = self.driver.nvp_connections
+            connection = self.driver.get_connection()
+            self.driver._connect(up)
+            down["action"] = mock.Mock(side_effect=socket.error)
+            up["action"] = mock.Mock(return_value="result")
+            self.assertEqual(connection._action("entity", "GET", "/"),
+                             "result")
+            self.assertFalse(self.driver._controller_available(
+                down, time.time()))
+            stats = self.driver.controller_stats()
+            self.assertEqual(stats[0]["failures"], 1)
+            self.assertEqual(stats[1]["requests"], 1)
+            self.assertEqual(stats[1]["in_flight"], 0)
+            self.assertEqual(self.driver._choose_controller(), up)
+
+    def test_request_post_not_resent_after_send(self):
+        with self._stubs():
+            down, up = self.driver.nvp_connections
+            connection = self.driver.get_connection()
+            self.driver._connect(up)
+            down["action"] = mock.Mock(side_effect=socket.timeout)
+            up["action"] = mock.Mock(return_value="result")
+            with self.assertRaises(socket.timeout):
+                connection._action("entity", "POST", "/ws.v1/lswitch")
+            self.assertFalse(up["action"].called)
+            self.assertFalse(self.driver._controller_available(
+                down, time.time()))
+
+    def test_request_post_fails_over_when_refused(self):
+        with self._stubs():
+            down, up = self.driver.nvp_connections
+            connection = self.driver.get_connection()
+            self.driver._connect(up)
+            down["action"] = mock.Mock(
+                side_effect=socket.error(errno.ECONNREFUSED, "refused"))
+            up["action"] = mock.Mock(return_value="result")
+            self.assertEqual(connection._action("entity", "POST",
+                                                "/ws.v1/lswitch"),
+                             "result")
+
+    def test_request_nvp_error_not_retried(self):
+        with self._stubs():
+            conn = self.driver.nvp_connections[0]
+            connection = self.driver.get_connection()
+            error = Exception()
+            error.code = 404
+            conn["action"] = mock.Mock(side_effect=error)
+            with self.assertRaises(Exception):
+                connection._action("entity", "GET", "/")
+            self.assertEqual(conn["action"].call_count, 1)
+            self.assertTrue(self.driver._controller_available(
+                conn, time.time()))
+
+    def test_unhealthy_controller_probed_when_all_down(self):
+        with self._stubs():
+            first, second = self.driver.nvp_connections
+            first["retry_at"] = time.time() + 10
+            second["retry_at"] = time.time() + 20
+            self.assertEqual(self.driver._choose_controller(), first)
+
+
+class TestNVPDriverBreaker(TestNVPControllerPool):
+    def setUp(self):
+        super(TestNVPDriverBreaker, self).setUp()
+        cfg.CONF.set_override("breaker_enabled", True, "NVP")
+        cfg.CONF.set_override("breaker_window", 2, "NVP")
+        cfg.CONF.set_override("breaker_max_in_flight", 2, "NVP")
+
+    def tearDown(self):
+        super(TestNVPDriverBreaker, self).tearDown()
+        for opt in ("breaker_enabled", "breaker_window",
+                    "breaker_max_in_flight"):
+            cfg.CONF.clear_override(opt, "NVP")
+
+    def _fail(self, connection, conn, error=socket.error):
+        conn["action"] = mock.Mock(side_effect=error)
+        with self.assertRaises(Exception):
+            connection._action("entity", "POST", "/ws.v1/lswitch/1/lport")
+
+    def test_breaker_opens_and_fails_fast(self):
+        with self._stubs(count=1):
+            conn = self.driver.nvp_connections[0]
+            connection = self.driver.get_connection()
+            self._fail(connection, conn)
+            self._fail(connection, conn)
+            conn["action"] = mock.Mock(return_value="result")
+            with self.assertRaises(q_exc.BackendUnavailable):
+                connection._action("entity", "GET", "/ws.v1/lswitch")
+            self.assertFalse(conn["action"].called)
+
+            stats = self.driver.diag_backend(self.context)["breaker"]
+            self.assertEqual(stats["state"], "open")
+            self.assertEqual(stats["limit"], 1)
+            self.assertEqual(stats["operations"]["POST_lport"]["failures"],
+                             2)
+            self.assertEqual(stats["operations"]["GET_lswitch"]["rejected"],
+                             1)
+
+    def test_breaker_probe_closes(self):
+        with self._stubs(count=1):
+            conn = self.driver.nvp_connections[0]
+            connection = self.driver.get_connection()
+            self._fail(connection, conn)
+            self._fail(connection, conn)
+            self.driver.breaker.opened_at = time.time() - 30
+            conn["action"] = mock.Mock(return_value="result")
+            self.assertEqual(connection._action("entity", "GET", "/"),
+                             "result")
+            self.assertEqual(self.driver.breaker.stats()["state"], "closed")
+
+    def test_nvp_errors_do_not_open_breaker(self):
+        with self._stubs(count=1):
+            conn = self.driver.nvp_connections[0]
+            connection = self.driver.get_connection()
+            error = Exception()
+            error.code = 404
+            for i in xrange(3):
+                self._fail(connection, conn, error)
+            self.assertEqual(self.driver.breaker.stats()["state"], "closed")
+
+    def test_in_flight_limit(self):
+        with self._stubs(count=1):
+            conn = self.driver.nvp_connections[0]
+            connection = self.driver.get_connection()
+            self.driver.breaker.in_flight = 2
+            conn["action"] = mock.Mock(return_value="result")
+            with self.assertRaises(q_exc.BackendUnavailable):
+                connection._action("entity", "GET", "/")
+            self.driver.breaker.in_flight = 0
+            self.assertEqual(connection._action("entity", "GET", "/"),
+                             "result")
+
+
+class TestNVPDriverLswitchCache(TestNVPDriver):
+    def setUp(self):
+        super(TestNVPDriverLswitchCache, self).setUp()
+        cfg.CONF.set_override("lswitch_cache_ttl", 60, "NVP")
+        self.driver.load_config()
+
+    def tearDown(self):
+        super(TestNVPDriverLswitchCache, self).tearDown()
+        cfg.CONF.clear_override("lswitch_cache_ttl", "NVP")
+
+    @contextlib.contextmanager
+    def _stubs(self):
+        with mock.patch("%s.get_connection" % self.d_pkg) as get_connection:
+            connection = self._create_connection(has_switches=True)
+            get_connection.return_value = connection
+            yield connection
+
+    def test_create_port_reuses_lswitches(self):
+        with self._stubs() as connection:
+            for i in xrange(2):
+                port = self.driver.create_port(self.context, self.net_id,
+                                               self.port_id)
+                self.assertEqual(port["lswitch"], "abcd")
+            query = connection.lswitch().query()
+            self.assertEqual(query.results.call_count, 1)
+            switches = self.driver.lswitch_cache.get(("tid", self.net_id))
+            status = switches["results"][0]["_relations"]
+            self.assertEqual(status["LogicalSwitchStatus"]["lport_count"], 2)
+
+    def test_delete_port_invalidates_lswitches(self):
+        with self._stubs() as connection:
+            self.driver.create_port(self.context, self.net_id, self.port_id)
+            self.driver.delete_port(self.context, self.lport_uuid,
+                                    lswitch_uuid="abcd")
+            self.assertIsNone(self.driver.lport_cache.get(self.lport_uuid))
+            self.driver.create_port(self.context, self.net_id, self.port_id)
+            query = connection.lswitch().query()
+            self.assertEqual(query.results.call_count, 2)
+
+    def test_lswitch_create_invalidates_network(self):
+        with self._stubs():
+            self.driver.lswitch_cache.set(("tid", self.net_id),
+                                          dict(results=[]))
+            self.driver._lswitch_create(self.context,
+                                        network_id=self.net_id)
+            self.assertIsNone(self.driver.lswitch_cache.get(
+                ("tid", self.net_id)))
+
+    def test_lswitch_from_port_cached(self):
+        with self._stubs() as connection:
+            for i in xrange(2):
+                lswitch = self.driver._lswitch_from_port(self.context,
+                                                         self.port_id)
+                self.assertEqual(lswitch, self.lswitch_uuid)
+            self.assertEqual(connection.lswitch_port().query.call_count, 1)
+
+
+class TestNVPDriverSecurityProfileCache(TestNVPDriver):
+    def setUp(self):
+        super(TestNVPDriverSecurityProfileCache, self).setUp()
+        cfg.CONF.set_override("security_profile_cache_ttl", 60, "NVP")
+        self.driver.load_config()
+        self.driver.limits.update({'max_rules_per_port': 2})
+
+    def tearDown(self):
+        super(TestNVPDriverSecurityProfileCache, self).tearDown()
+        cfg.CONF.clear_override("security_profile_cache_ttl", "NVP")
+
+    def _group(self, group_id, rules=0):
+        return {'uuid': 'profile-%s' % group_id,
+                'tags': [{'scope': 'os_tid', 'tag': 'tid'},
+                         {'scope': 'neutron_group_id', 'tag': group_id}],
+                'logical_port_ingress_rules': [{}] * rules,
+                'logical_port_egress_rules': []}
+
+    @contextlib.contextmanager
+    def _stubs(self, groups):
+        with mock.patch("%s.get_connection" % self.d_pkg) as get_connection:
+            connection = self._create_connection(has_switches=True)
+            profile = mock.Mock()
+            profile.query().results.return_value = {
+                'results': groups, 'result_count': len(groups)}
+            profile.create.return_value = {'uuid': 'profile-3'}
+            connection.securityprofile = mock.Mock(return_value=profile)
+            get_connection.return_value = connection
+            yield profile.query()
+
+    def test_groups_for_port_one_query(self):
+        groups = [self._group(1), self._group(2), self._group(3)]
+        with self._stubs(groups) as query:
+            for i in xrange(2):
+                uuids = self.driver._get_security_groups_for_port(
+                    self.context, [2, 1])
+                self.assertEqual(uuids, ['profile-2', 'profile-1'])
+            self.assertEqual(query.results.call_count, 1)
+
+    def test_groups_for_port_cached_rule_count(self):
+        groups = [self._group(1, rules=1), self._group(2, rules=1)]
+        with self._stubs(groups) as query:
+            self.driver._get_security_groups_for_port(self.context, [1, 2])
+            with self.assertRaises(sg_ext.qexception.InvalidInput):
+                self.driver._get_security_groups_for_port(self.context,
+                                                          [1, 2, 2])
+            self.assertEqual(query.results.call_count, 1)
+
+    def test_groups_for_port_follows_page_cursor(self):
+        with self._stubs([self._group(1)]) as query:
+            query.next.side_effect = [
+                {'results': [self._group(3)], 'page_cursor': 'b'},
+                {'results': [self._group(2)]}]
+            uuids = self.driver._get_security_groups_for_port(
+                self.context, [1, 2])
+            self.assertEqual(uuids, ['profile-1', 'profile-2'])
+            self.assertEqual(query.next.call_count, 2)
+
+    def test_groups_for_port_stops_paging_when_found(self):
+        with self._stubs([self._group(1), self._group(2)]) as query:
+            self.driver._get_security_groups_for_port(self.context, [1, 2])
+            self.assertFalse(query.next.called)
+
+    def test_groups_for_port_missing_group(self):
+        with self._stubs([self._group(1)]) as query:
+            query.next.return_value = None
+            with self.assertRaises(sg_ext.SecurityGroupNotFound):
+                self.driver._get_security_groups_for_port(self.context,
+                                                          [1, 2])
+
+    def test_create_security_group_fills_cache(self):
+        with self._stubs([]) as query:
+            self.driver.create_security_group(self.context, "foo",
+                                              group_id=3)
+            uuids = self.driver._get_security_groups_for_port(self.context,
+                                                              [3])
+            self.assertEqual(uuids, ['profile-3'])
+            self.assertFalse(query.results.called)
+
+    def test_update_security_group_invalidates(self):
+        with self._stubs([self._group(1)]) as query:
+            self.driver._get_security_groups_for_port(self.context, [1])
+            self.driver.update_security_group(self.context, 1, name="bar")
+            self.driver._get_security_groups_for_port(self.context, [1])
+            self.assertEqual(query.results.call_count, 3)
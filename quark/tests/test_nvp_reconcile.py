@@ -0,0 +1,104 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+#  under the License.
+
+from neutron.db import api as db_api
+from neutron.openstack.common.db.sqlalchemy import session as neutron_session
+from oslo.config import cfg
+
+from quark.bench import fake_nvp
+from quark.db import models
+from quark.drivers import optimized_nvp_driver as nvp
+from quark.tests import test_base
+from quark.tools import nvp_reconcile
+
+
+class TestNVPReconcile(test_base.TestBase):
+    def setUp(self):
+        super(TestNVPReconcile, self).setUp()
+        cfg.CONF.set_override("connection", "sqlite://", "database")
+        cfg.CONF.set_override("connection_class",
+                              "quark.bench.fake_nvp.FakeConnection", "NVP")
+        cfg.CONF.set_override("controller_connection",
+                              ["fake-nvp:80:admin:admin:30:10:2:2"], "NVP")
+        db_api.configure_db()
+        models.BASEV2.metadata.create_all(neutron_session._ENGINE)
+        fake_nvp._CONTROLLERS.clear()
+        self.fake = fake_nvp.controller("fake-nvp:80")
+        self.reconciler = nvp_reconcile.Reconciler(
+            nvp.OptimizedNVPDriver(), nvp_reconcile.RateLimiter(0))
+
+        status, self.profile = self.fake.request(
+            "POST", "/ws.v1/security-profile",
+            dict(tags=[dict(scope="neutron_group_id", tag="group1")],
+                 logical_port_ingress_rules=[{}, {}]))
+        status, self.switch = self.fake.request(
+            "POST", "/ws.v1/lswitch",
+            dict(tags=[dict(scope="neutron_net_id", tag="net1")]))
+        status, self.lport = self.fake.request(
+            "POST", "/ws.v1/lswitch/%s/lport" % self.switch["uuid"],
+            dict(tags=[dict(scope="neutron_port_id", tag="port1")],
+                 security_profiles=[self.profile["uuid"]]))
+
+        self.context.session.add(nvp.LSwitch(nvp_id="gone", network_id="net2",
+                                             port_count=3))
+        self.context.session.add(nvp.SecurityProfile(id="group2",
+                                                     nvp_id="gone"))
+        self.context.session.flush()
+
+    def tearDown(self):
+        super(TestNVPReconcile, self).tearDown()
+        cfg.CONF.clear_override("connection_class", "NVP")
+        cfg.CONF.clear_override("controller_connection", "NVP")
+        fake_nvp._CONTROLLERS.clear()
+        db_api.clear_db()
+
+    def test_dry_run_reports(self):
+        report = self.reconciler.reconcile(self.context, dry_run=True)
+        self.assertEqual(report["lswitches"]["missing"],
+                         [self.switch["uuid"]])
+        self.assertEqual(report["lswitches"]["orphaned"], ["gone"])
+        self.assertEqual(report["security_profiles"]["missing"], ["group1"])
+        self.assertEqual(report["security_profiles"]["orphaned"], ["group2"])
+        self.assertEqual(report["lports"]["missing"], [self.lport["uuid"]])
+        self.assertEqual(self.context.session.query(nvp.LSwitch).count(), 1)
+
+    def test_reconcile_repairs(self):
+        self.reconciler.reconcile(self.context)
+        switch = self.context.session.query(nvp.LSwitch).one()
+        self.assertEqual(switch.nvp_id, self.switch["uuid"])
+        self.assertEqual(switch.network_id, "net1")
+        self.assertEqual(switch.port_count, 1)
+        profile = self.context.session.query(nvp.SecurityProfile).one()
+        self.assertEqual(profile.id, "group1")
+        self.assertEqual(profile.rule_count, 2)
+        lport = self.context.session.query(nvp.LSwitchPort).one()
+        self.assertEqual(lport.switch_id, switch.id)
+        self.assertEqual(lport.rule_count, 2)
+
+        report = self.reconciler.reconcile(self.context)
+        self.assertEqual(report["lports"],
+                         dict(missing=[], orphaned=[], wrong=[]))
+        self.assertEqual(report["lswitches"]["port_count"], {})
+
+    def test_orphans_confirmed_before_delete(self):
+        self.reconciler.reconcile(self.context)
+        # NOTE(jkoelker) Pages that miss objects NVP still has must not
+        #                get their rows deleted
+        self.reconciler._query_all = lambda query: {}
+        report = self.reconciler.reconcile(self.context)
+        for name in ("lswitches", "lports", "security_profiles"):
+            self.assertEqual(report[name]["orphaned"], [])
+        self.assertEqual(self.context.session.query(nvp.LSwitchPort).count(),
+                         1)
@@ -16,8 +16,15 @@
 import contextlib
 import mock
 
+from neutron.db import api as db_api
+import neutron.extensions.securitygroup as sg_ext
+from neutron.openstack.common.db.sqlalchemy import session as neutron_session
+from oslo.config import cfg
+
+from quark.bench import fake_nvp
 import quark.db.models
 import quark.drivers.optimized_nvp_driver
+from quark.tests import test_base
 import quark.tests.test_nvp_driver as test_nvp_driver
 
 
@@ -364,6 +371,86 @@ class TestSecurityGroupRules(TestOptimizedNVPDriver):
             ], any_order=True)
 
 
+class TestRuleCounts(TestOptimizedNVPDriver):
+    @contextlib.contextmanager
+    def _stubs(self, profiles=None, count=None):
+        old_query = self.context.session.query
+        query = mock.MagicMock()
+        query.filter.return_value = query
+        query.all.return_value = profiles or []
+        query.scalar.return_value = count
+        self.context.session.query = mock.Mock(return_value=query)
+        yield query
+        self.context.session.query = old_query
+
+    def _profile(self, id, rule_count):
+        profile = quark.drivers.optimized_nvp_driver.SecurityProfile()
+        profile.update(dict(id=id, nvp_id="nvp-%s" % id,
+                            rule_count=rule_count))
+        return profile
+
+    def test_create_security_group_counts_rules(self):
+        with mock.patch("%s.get_connection" % self.d_pkg):
+            self.driver.create_security_group(
+                self.context, "newgroup", group_id=1,
+                port_ingress_rules=[{}], port_egress_rules=[{}, {}])
+            profile = self.context.session.add.call_args[0][0]
+            self.assertEqual(profile.rule_count, 3)
+
+    def test_check_rule_count_per_port(self):
+        with self._stubs(count=4):
+            self.assertEqual(
+                self.driver._check_rule_count_per_port(self.context, 1), 4)
+
+    def test_check_rule_count_per_port_no_ports(self):
+        with self._stubs():
+            self.assertEqual(
+                self.driver._check_rule_count_per_port(self.context, 1), 0)
+
+    def test_check_rule_count_per_port_untracked_ports(self):
+        port = quark.db.models.Port()
+        port.security_groups = [quark.db.models.SecurityGroup(id=1),
+                                quark.db.models.SecurityGroup(id=2)]
+        group = dict(logical_port_ingress_rules=[{}, {}],
+                     logical_port_egress_rules=[{}])
+        with contextlib.nested(
+            self._stubs(count=4),
+            mock.patch("%s._untracked_ports" % self.d_pkg),
+            mock.patch("%s._get_security_group" % self.d_pkg)
+        ) as (query, untracked, get_group):
+            untracked.return_value = [port]
+            get_group.return_value = group
+            self.assertEqual(
+                self.driver._check_rule_count_per_port(self.context, 1), 6)
+
+    def test_lport_set_profiles(self):
+        port = quark.drivers.optimized_nvp_driver.LSwitchPort()
+        with self._stubs(profiles=[self._profile(1, 2),
+                                   self._profile(2, 3)]):
+            self.driver._lport_set_profiles(self.context, port, [1, 2])
+        self.assertEqual(port.rule_count, 5)
+        self.assertEqual(len(port.security_profiles), 2)
+
+    def test_security_profiles(self):
+        with self._stubs(profiles=[self._profile(1, 2)]):
+            profiles = self.driver._security_profiles(self.context, [1])
+        self.assertEqual(profiles, {1: dict(uuid="nvp-1", rule_count=2)})
+
+    def test_security_profiles_not_found(self):
+        with self._stubs(profiles=[self._profile(1, 2)]):
+            with self.assertRaises(sg_ext.SecurityGroupNotFound):
+                self.driver._security_profiles(self.context, [1, 2])
+
+    def test_rule_create_updates_counts(self):
+        with contextlib.nested(
+            mock.patch("quark.drivers.nvp_driver.NVPDriver."
+                       "create_security_group_rule"),
+            self._stubs()
+        ) as (create_rule, query):
+            self.driver.create_security_group_rule(self.context, 1, {})
+            self.assertEqual(query.update.call_count, 2)
+
+
 class TestCreateLswitchOptimized(TestOptimizedNVPDriver):
     def test_create_lswitch_optimized(self):
         self.driver._lswitch_create_optimized(self.context, "public", 1, 1)
@@ -442,3 +529,79 @@ class TestQueryMethods(TestOptimizedNVPDriver):
         with self._stubs() as query_return:
             self.driver._query_security_group(self.context, 1)
             self.assertTrue(query_return.filter.called)
+
+
+class TestLSwitchProvisioner(test_base.TestBase):
+    def setUp(self):
+        super(TestLSwitchProvisioner, self).setUp()
+        cfg.CONF.set_override("connection", "sqlite://", "database")
+        cfg.CONF.set_override("connection_class",
+                              "quark.bench.fake_nvp.FakeConnection", "NVP")
+        cfg.CONF.set_override("controller_connection",
+                              ["fake-nvp:80:admin:admin:30:10:2:2"], "NVP")
+        cfg.CONF.set_override("max_ports_per_switch", 10, "NVP")
+        db_api.configure_db()
+        quark.db.models.BASEV2.metadata.create_all(neutron_session._ENGINE)
+        fake_nvp._CONTROLLERS.clear()
+        self.driver = quark.drivers.optimized_nvp_driver.OptimizedNVPDriver()
+        self.provisioner = self.driver.provisioner
+        self.context.session.add(quark.db.models.Network(
+            id="net1", tenant_id="tid", name="net"))
+        self.context.session.add(quark.drivers.optimized_nvp_driver.LSwitch(
+            nvp_id="switch1", network_id="net1", display_name="net",
+            port_count=5, segment_id=122))
+        self.context.session.flush()
+
+    def tearDown(self):
+        super(TestLSwitchProvisioner, self).tearDown()
+        for opt in ("connection_class", "controller_connection",
+                    "max_ports_per_switch"):
+            cfg.CONF.clear_override(opt, "NVP")
+        fake_nvp._CONTROLLERS.clear()
+        db_api.clear_db()
+
+    def _switches(self):
+        LSwitch = quark.drivers.optimized_nvp_driver.LSwitch
+        return self.context.session.query(LSwitch).\
+            order_by(LSwitch.port_count.desc()).all()
+
+    def test_network_below_high_water_left_alone(self):
+        self.assertEqual(self.provisioner.run_once(self.context), 0)
+        self.assertEqual(len(self._switches()), 1)
+
+    def test_network_past_high_water_provisioned(self):
+        self._switches()[0].port_count = 9
+        self.context.session.flush()
+        self.assertEqual(self.provisioner.networks_near_full(self.context),
+                         [("net1", "tid")])
+        self.assertEqual(self.provisioner.run_once(self.context), 1)
+        full, spare = self._switches()
+        self.assertEqual(spare.port_count, 0)
+        self.assertEqual(spare.segment_id, 122)
+        self.assertEqual(spare.display_name, "net")
+        status, switch = fake_nvp.controller("fake-nvp:80").request(
+            "GET", "/ws.v1/lswitch/%s" % spare.nvp_id)
+        self.assertTrue(dict(scope="os_tid", tag="tid") in switch["tags"])
+
+        self.assertEqual(self.provisioner.run_once(self.context), 0)
+        self.assertEqual(self.driver._lswitch_select_open(
+            self.context, network_id="net1"), spare.nvp_id)
+
+    def test_network_provisioned_elsewhere_skipped(self):
+        with mock.patch.object(self.provisioner,
+                               "networks_near_full") as near_full:
+            near_full.return_value = [("net1", "tid")]
+            self.assertEqual(self.provisioner.run_once(self.context), 0)
+        self.assertEqual(len(self._switches()), 1)
+
+    def test_claim_network_locks_network_row(self):
+        self._switches()[0].port_count = 9
+        self.context.session.flush()
+        with mock.patch("sqlalchemy.orm.Query.with_lockmode",
+                        autospec=True) as with_lockmode:
+            with_lockmode.side_effect = lambda query, mode: query
+            self.assertTrue(self.provisioner._claim_network(self.context,
+                                                            "net1"))
+            self.assertEqual(with_lockmode.call_args[0][1], "update")
+        self.assertFalse(self.provisioner._claim_network(self.context,
+                                                         "net2"))
@@ -18,6 +18,7 @@ import mock
 from neutron.db import api as db_api
 from oslo.config import cfg
 
+from quark.drivers import metrics
 import quark.plugin
 
 from quark.tests import test_base
@@ -54,3 +55,28 @@ class TestQuarkAPIExtensions(TestQuarkPlugin):
             conf.set_override.assert_called_once_with(
                 "api_extensions_path",
                 "apple:banana:carrot")
+
+
+class TestQuarkDiagnoseDrivers(TestQuarkPlugin):
+    def setUp(self):
+        super(TestQuarkDiagnoseDrivers, self).setUp()
+        metrics.METRICS.reset()
+        metrics.METRICS.observe("BASE", "create_port", 0.01)
+        metrics.METRICS.observe("NVP", "create_port", 0.01)
+
+    def tearDown(self):
+        super(TestQuarkDiagnoseDrivers, self).tearDown()
+        metrics.METRICS.reset()
+
+    def test_diagnose_drivers(self):
+        drivers = self.plugin.diagnose_drivers(self.context, "*", {})
+        self.assertEqual(sorted(drivers["drivers"]), ["BASE", "NVP"])
+        drivers = self.plugin.diagnose_drivers(self.context, "NVP", {})
+        self.assertEqual(drivers["drivers"].keys(), ["NVP"])
+        self.assertIn("hit_rate", drivers["ip_policy_cache"])
+
+    def test_dump_driver_metrics(self):
+        dump = self.plugin.dump_driver_metrics(self.context, "BASE")
+        self.assertIn('driver="BASE"', dump)
+        self.assertNotIn('driver="NVP"', dump)
+        self.assertIn("quark_ip_policy_cache_hits_total", dump)
@@ -0,0 +1,53 @@
+# Copyright (c) 2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from quark.tests import test_base
+from quark import utils
+
+
+class TestTTLCache(test_base.TestBase):
+    def test_disabled(self):
+        cache = utils.TTLCache()
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_expires(self):
+        cache = utils.TTLCache(ttl=10)
+        with mock.patch("quark.utils.time") as fake_time:
+            fake_time.time.return_value = 100
+            cache.set("a", 1)
+            self.assertEqual(cache.get("a"), 1)
+            fake_time.time.return_value = 111
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_set(self):
+        cache = utils.TTLCache(ttl=60, maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("a", 3)
+        cache.set("c", 4)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 3)
+        self.assertEqual(cache.get("c"), 4)
+
+    def test_resets_stay_bounded(self):
+        cache = utils.TTLCache(ttl=60, maxsize=2)
+        for i in xrange(100):
+            cache.set("a", i)
+        self.assertTrue(len(cache._order) <= 2 * len(cache._entries) + 16)
+        self.assertEqual(cache.get("a"), 99)
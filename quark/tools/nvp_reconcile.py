@@ -0,0 +1,368 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Reconcile the OptimizedNVPDriver tables with NVP.
+
+Pages through the lswitches, lports and security profiles NVP has for
+neutron, then adds the rows the driver tables are missing, deletes the
+rows NVP no longer knows about and fixes lswitch port counts, lport
+security profiles and rule counts. Rows are only deleted once a second
+lookup confirms NVP does not have them, so objects created while the
+pages were read are left alone.
+"""
+
+import json
+import sys
+import time
+
+from neutron import context as neutron_context
+from neutron.db import api as neutron_db_api
+from neutron.openstack.common import log as logging
+from oslo.config import cfg
+import sqlalchemy as sa
+
+from quark.drivers import optimized_nvp_driver as nvp
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+reconcile_opts = [
+    cfg.BoolOpt("dry_run", default=False,
+                help=_("Report the differences without repairing them.")),
+    cfg.IntOpt("interval", default=0,
+               help=_("Seconds between runs, 0 runs once and exits.")),
+    cfg.IntOpt("page_size", default=1000,
+               help=_("Results requested per NVP query page.")),
+    cfg.FloatOpt("requests_per_second", default=5.0,
+                 help=_("Most requests sent to NVP per second, 0 for no "
+                        "limit.")),
+    cfg.StrOpt("output", default=None,
+               help=_("File to write the JSON report to, stdout if unset."))
+]
+
+_CHUNK = 500
+
+
+class RateLimiter(object):
+    """Spaces calls out to at most rate per second."""
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate or 0
+        self.next_at = 0
+
+    def wait(self):
+        now = time.time()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+            now = self.next_at
+        self.next_at = now + self.interval
+
+
+def _pages(query, limiter, page_size):
+    query.length(page_size)
+    limiter.wait()
+    results = query.results()
+    while True:
+        yield results["results"]
+        if not query.nextpage:
+            break
+        limiter.wait()
+        results = query.next()
+
+
+def _tag(obj, scope):
+    for tag in obj.get("tags", []):
+        if tag["scope"] == scope:
+            return tag["tag"]
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for i in xrange(0, len(ids), _CHUNK):
+        yield ids[i:i + _CHUNK]
+
+
+class Reconciler(object):
+    def __init__(self, driver, limiter, page_size=1000):
+        self.driver = driver
+        self.limiter = limiter
+        self.page_size = page_size
+
+    def _query_all(self, query):
+        objects = {}
+        for page in _pages(query, self.limiter, self.page_size):
+            for obj in page:
+                objects[obj["uuid"]] = obj
+        return objects
+
+    def fetch(self):
+        """Reads every neutron lswitch, lport and profile from NVP."""
+        connection = self.driver.get_connection()
+        query = connection.lswitch().query()
+        query.tagscopes(["neutron_net_id"])
+        lswitches = self._query_all(query)
+
+        query = connection.lswitch_port("*").query()
+        query.tagscopes(["neutron_port_id"])
+        query.relations(["LogicalSwitchConfig"])
+        lports = self._query_all(query)
+
+        query = connection.securityprofile().query()
+        query.tagscopes(["neutron_group_id"])
+        profiles = self._query_all(query)
+        return lswitches, lports, profiles
+
+    def _confirm_gone(self, make_query, uuids):
+        """Returns the uuids a lookup by uuid does not find in NVP."""
+        gone = set()
+        for uuid in uuids:
+            query = make_query()
+            query.uuid(uuid)
+            self.limiter.wait()
+            if not query.results()["result_count"]:
+                gone.add(uuid)
+        return gone
+
+    def reconcile(self, context, dry_run=False):
+        lswitches, lports, profiles = self.fetch()
+        connection = self.driver.get_connection()
+        report = {}
+        with context.session.begin():
+            switch_rows, orphaned = self._reconcile_lswitches(
+                context, connection, lswitches, lports, report, dry_run)
+            profile_rows = self._reconcile_profiles(
+                context, connection, profiles, report, dry_run)
+            self._reconcile_lports(context, connection, lports, switch_rows,
+                                   profile_rows, report, dry_run)
+            if not dry_run:
+                self._delete_lswitches(context, orphaned)
+        return report
+
+    def _reconcile_lswitches(self, context, connection, lswitches, lports,
+                             report, dry_run):
+        rows = dict((row.nvp_id, row)
+                    for row in context.session.query(nvp.LSwitch).all())
+        missing = set(uuid for uuid in lswitches if uuid not in rows)
+        orphaned = self._confirm_gone(
+            lambda: connection.lswitch().query(),
+            set(rows) - set(lswitches))
+
+        counts = dict.fromkeys(lswitches, 0)
+        for lport in lports.values():
+            switch = lport["_relations"]["LogicalSwitchConfig"]["uuid"]
+            if switch in counts:
+                counts[switch] += 1
+        port_counts = dict((uuid, (row.port_count, counts[uuid]))
+                           for uuid, row in rows.items()
+                           if uuid in counts and
+                           row.port_count != counts[uuid])
+
+        report["lswitches"] = dict(missing=sorted(missing),
+                                   orphaned=sorted(orphaned),
+                                   port_count=port_counts)
+        if dry_run:
+            return rows, []
+
+        for uuid in missing:
+            switch = lswitches[uuid]
+            if not _tag(switch, "neutron_net_id"):
+                continue
+            zones = switch.get("transport_zones") or [{}]
+            vlans = zones[0].get("binding_config", {}).get(
+                "vlan_translation") or [{}]
+            rows[uuid] = nvp.LSwitch(
+                nvp_id=uuid, network_id=_tag(switch, "neutron_net_id"),
+                display_name=switch.get("display_name"),
+                port_count=counts[uuid],
+                transport_zone=zones[0].get("zone_uuid"),
+                transport_connector=zones[0].get("transport_type"),
+                segment_id=vlans[0].get("transport"))
+            context.session.add(rows[uuid])
+        for uuid, (_, count) in port_counts.items():
+            rows[uuid].port_count = count
+        # NOTE(jkoelker) the new rows need their ids for the lports
+        context.session.flush()
+        return rows, [rows.pop(uuid).id for uuid in orphaned]
+
+    def _delete_lswitches(self, context, switch_ids):
+        association = nvp.lport_profile_association_table
+        for chunk in _chunks(switch_ids):
+            lport_ids = sa.select([nvp.LSwitchPort.id]).where(
+                nvp.LSwitchPort.switch_id.in_(chunk))
+            context.session.execute(association.delete().where(
+                association.c.lport_id.in_(lport_ids)))
+            context.session.query(nvp.LSwitchPort).\
+                filter(nvp.LSwitchPort.switch_id.in_(chunk)).\
+                delete(synchronize_session=False)
+            context.session.query(nvp.LSwitch).\
+                filter(nvp.LSwitch.id.in_(chunk)).\
+                delete(synchronize_session=False)
+
+    def _reconcile_profiles(self, context, connection, profiles, report,
+                            dry_run):
+        nvp_ids = dict((_tag(profile, "neutron_group_id"), uuid)
+                       for uuid, profile in profiles.items()
+                       if _tag(profile, "neutron_group_id"))
+        rows = dict((row.id, row) for row in
+                    context.session.query(nvp.SecurityProfile).all())
+        missing = set(group_id for group_id in nvp_ids
+                      if group_id not in rows)
+        gone = self._confirm_gone(
+            lambda: connection.securityprofile().query(),
+            set(row.nvp_id for row in rows.values()) -
+            set(nvp_ids.values()))
+        orphaned = set(group_id for group_id, row in rows.items()
+                       if row.nvp_id in gone)
+
+        rule_counts = {}
+        for group_id, row in rows.items():
+            if group_id not in nvp_ids:
+                continue
+            profile = profiles[nvp_ids[group_id]]
+            count = (len(profile.get("logical_port_ingress_rules", [])) +
+                     len(profile.get("logical_port_egress_rules", [])))
+            if row.nvp_id != profile["uuid"] or row.rule_count != count:
+                rule_counts[group_id] = (row.rule_count, count)
+
+        report["security_profiles"] = dict(missing=sorted(missing),
+                                           orphaned=sorted(orphaned),
+                                           rule_count=rule_counts)
+        if dry_run:
+            return rows
+
+        for group_id in missing:
+            profile = profiles[nvp_ids[group_id]]
+            rows[group_id] = nvp.SecurityProfile(
+                id=group_id, nvp_id=profile["uuid"],
+                rule_count=(len(profile.get("logical_port_ingress_rules",
+                                            [])) +
+                            len(profile.get("logical_port_egress_rules",
+                                            []))))
+            context.session.add(rows[group_id])
+        for group_id, (_, count) in rule_counts.items():
+            rows[group_id].nvp_id = nvp_ids[group_id]
+            rows[group_id].rule_count = count
+        association = nvp.lport_profile_association_table
+        for chunk in _chunks(orphaned):
+            context.session.execute(association.delete().where(
+                association.c.profile_id.in_(chunk)))
+            context.session.query(nvp.SecurityProfile).\
+                filter(nvp.SecurityProfile.id.in_(chunk)).\
+                delete(synchronize_session=False)
+        for group_id in orphaned:
+            rows.pop(group_id)
+        return rows
+
+    def _reconcile_lports(self, context, connection, lports, switch_rows,
+                          profile_rows, report, dry_run):
+        rows = dict((row.port_id, row) for row in
+                    context.session.query(nvp.LSwitchPort).all())
+        missing = set(uuid for uuid in lports if uuid not in rows)
+        orphaned = self._confirm_gone(
+            lambda: connection.lswitch_port("*").query(),
+            set(rows) - set(lports))
+
+        profiles_by_nvp_id = dict((row.nvp_id, row)
+                                  for row in profile_rows.values())
+        association = nvp.lport_profile_association_table
+        current = {}
+        for lport_id, profile_id in context.session.execute(
+                sa.select([association.c.lport_id,
+                           association.c.profile_id])):
+            current.setdefault(lport_id, set()).add(profile_id)
+        wrong = {}
+        for uuid, row in rows.items():
+            if uuid not in lports:
+                continue
+            lport = lports[uuid]
+            switch = lport["_relations"]["LogicalSwitchConfig"]["uuid"]
+            profiles = [profiles_by_nvp_id[p]
+                        for p in lport.get("security_profiles", [])
+                        if p in profiles_by_nvp_id]
+            rule_count = sum(p.rule_count or 0 for p in profiles)
+            if ((switch in switch_rows and
+                 row.switch_id != switch_rows[switch].id) or
+                    current.get(row.id, set()) !=
+                    set(p.id for p in profiles) or
+                    row.rule_count != rule_count):
+                wrong[uuid] = (switch, profiles, rule_count)
+
+        report["lports"] = dict(missing=sorted(missing),
+                                orphaned=sorted(orphaned),
+                                wrong=sorted(wrong))
+        if dry_run:
+            return
+
+        for uuid in missing:
+            lport = lports[uuid]
+            switch = lport["_relations"]["LogicalSwitchConfig"]["uuid"]
+            if switch not in switch_rows:
+                LOG.warning("Skipping lport %s on unknown lswitch %s" %
+                            (uuid, switch))
+                continue
+            profiles = [profiles_by_nvp_id[p]
+                        for p in lport.get("security_profiles", [])
+                        if p in profiles_by_nvp_id]
+            row = nvp.LSwitchPort(port_id=uuid,
+                                  switch_id=switch_rows[switch].id,
+                                  security_profiles=profiles,
+                                  rule_count=sum(p.rule_count or 0
+                                                 for p in profiles))
+            context.session.add(row)
+        for uuid, (switch, profiles, rule_count) in wrong.items():
+            if switch in switch_rows:
+                rows[uuid].switch_id = switch_rows[switch].id
+            rows[uuid].security_profiles = profiles
+            rows[uuid].rule_count = rule_count
+        orphan_ids = [rows[uuid].id for uuid in orphaned]
+        for chunk in _chunks(orphan_ids):
+            context.session.execute(association.delete().where(
+                association.c.lport_id.in_(chunk)))
+            context.session.query(nvp.LSwitchPort).\
+                filter(nvp.LSwitchPort.id.in_(chunk)).\
+                delete(synchronize_session=False)
+
+
+def _summary(report):
+    return ", ".join("%s: %d missing, %d orphaned" %
+                     (name, len(diff["missing"]), len(diff["orphaned"]))
+                     for name, diff in sorted(report.items()))
+
+
+def main():
+    CONF.register_cli_opts(reconcile_opts)
+    CONF(sys.argv[1:], project="neutron")
+    logging.setup("quark")
+    neutron_db_api.configure_db()
+    reconciler = Reconciler(nvp.OptimizedNVPDriver(),
+                            RateLimiter(CONF.requests_per_second),
+                            page_size=CONF.page_size)
+    while True:
+        report = reconciler.reconcile(neutron_context.get_admin_context(),
+                                      dry_run=CONF.dry_run)
+        LOG.info("Reconciled NVP, %s" % _summary(report))
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if CONF.output:
+            with open(CONF.output, "w") as f:
+                f.write(output)
+        else:
+            print(output)
+        if not CONF.interval:
+            break
+        time.sleep(CONF.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Recompute the denormalized allocation counters on subnets and MAC address
+ranges from the address tables.
+"""
+
+import sys
+
+from neutron import context as neutron_context
+from neutron.db import api as neutron_db_api
+from neutron.openstack.common import log as logging
+from oslo.config import cfg
+
+from quark.db import api as db_api
+from quark.db import models
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+
+def repair_subnets(context):
+    counts = db_api.ip_address_count_by_subnet(context)
+    repaired = 0
+    for subnet in db_api.subnet_find(context, scope=db_api.ALL):
+        allocated = counts.get(subnet["id"], 0)
+        excluded = models.IPPolicy.get_compiled_ip_policy(subnet).size
+        if (subnet["allocated_count"] != allocated or
+                subnet["policy_excluded_count"] != excluded):
+            LOG.info("Subnet %s counts %s/%s repaired to %s/%s" %
+                     (subnet["id"], subnet["allocated_count"],
+                      subnet["policy_excluded_count"], allocated, excluded))
+            subnet["allocated_count"] = allocated
+            subnet["policy_excluded_count"] = excluded
+            repaired += 1
+    return repaired
+
+
+def repair_mac_address_ranges(context):
+    counts = db_api.mac_address_count_by_range(context)
+    repaired = 0
+    for mac_range in db_api.mac_address_range_find(context, scope=db_api.ALL):
+        allocated = counts.get(mac_range["id"], 0)
+        if mac_range["allocated_count"] != allocated:
+            LOG.info("MAC address range %s count %s repaired to %s" %
+                     (mac_range["id"], mac_range["allocated_count"],
+                      allocated))
+            mac_range["allocated_count"] = allocated
+            repaired += 1
+    return repaired
+
+
+def repair(context):
+    with context.session.begin():
+        subnets = repair_subnets(context)
+        mac_ranges = repair_mac_address_ranges(context)
+    return subnets, mac_ranges
+
+
+def main():
+    CONF(sys.argv[1:], project="neutron")
+    logging.setup("quark")
+    neutron_db_api.configure_db()
+    subnets, mac_ranges = repair(neutron_context.get_admin_context())
+    print("Repaired %d subnet(s) and %d MAC address range(s)" %
+          (subnets, mac_ranges))
+
+
+if __name__ == "__main__":
+    main()
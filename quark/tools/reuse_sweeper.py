@@ -0,0 +1,62 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Keep the deallocated IP address reuse queue filled and free of stale entries.
+"""
+
+import sys
+import time
+
+from neutron import context as neutron_context
+from neutron.db import api as neutron_db_api
+from neutron.openstack.common import log as logging
+from oslo.config import cfg
+
+from quark.db import api as db_api
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+sweeper_opts = [
+    cfg.IntOpt("interval", default=0,
+               help=_("Seconds between sweeps, 0 sweeps once and exits.")),
+    cfg.IntOpt("batch_size", default=1000,
+               help=_("Maximum number of addresses handled per sweep."))
+]
+
+
+def sweep(context, batch_size=None):
+    with context.session.begin():
+        pruned = db_api.ip_reuse_queue_prune(context, limit=batch_size)
+        queued = db_api.ip_reuse_queue_sweep(context, limit=batch_size)
+    LOG.info("Queued %d address(es) for reuse, pruned %d" % (queued, pruned))
+    return queued, pruned
+
+
+def main():
+    CONF.register_cli_opts(sweeper_opts)
+    CONF(sys.argv[1:], project="neutron")
+    logging.setup("quark")
+    neutron_db_api.configure_db()
+    while True:
+        sweep(neutron_context.get_admin_context(), CONF.batch_size)
+        if not CONF.interval:
+            break
+        time.sleep(CONF.interval)
+
+
+if __name__ == "__main__":
+    main()
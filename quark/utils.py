@@ -13,6 +13,9 @@
 # License for the specific language governing permissions and limitations
 #  under the License.
 
+import collections
+import time
+
 from neutron.api.v2 import attributes
 
 
@@ -25,3 +28,69 @@ def pop_param(attrs, param, default=None):
     if attr_specified(val):
         return val
     return default
+
+
+class TTLCache(object):
+    """Bounded in-process cache whose entries expire after ttl seconds.
+
+    A ttl of 0 disables the cache. Once maxsize entries are held the
+    least recently set one is evicted.
+    """
+    def __init__(self, ttl=0, maxsize=0):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # NOTE(jkoelker) No OrderedDict on python 2.6. Each set is stamped
+        #                with a serial and queued, queue entries whose key
+        #                has been set again or dropped since are skipped.
+        self._entries = {}
+        self._order = collections.deque()
+        self._serial = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        self._serial += 1
+        self._entries[key] = (time.time() + self.ttl, value, self._serial)
+        self._order.append((key, self._serial))
+        while self.maxsize and len(self._entries) > self.maxsize:
+            old_key, serial = self._order.popleft()
+            entry = self._entries.get(old_key)
+            if entry is not None and entry[2] == serial:
+                del self._entries[old_key]
+        if len(self._order) > 2 * len(self._entries) + 16:
+            self._compact()
+
+    def _compact(self):
+        live = sorted((entry[2], key)
+                      for key, entry in self._entries.iteritems())
+        self._order = collections.deque((key, serial)
+                                        for serial, key in live)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            return entry[1]
+
+    def invalidate(self, predicate):
+        """Drops every entry for which predicate(key, value) is true."""
+        for key, entry in self._entries.items():
+            if predicate(key, entry[1]):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._order.clear()
+        self.hits = 0
+        self.misses = 0